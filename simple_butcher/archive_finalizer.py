@@ -1,11 +1,30 @@
 import time
 import os
-import json
+import socket
+import stat
 import sys
 from pathlib import Path
 
+# Called by tar as --new-volume-script and by mbuffer as autoload command (-A) with TAPE_FULL as second argument.
+# Kept to the standard library, so it can be started with python -S.
 
 communication_file = sys.argv[1]
+message_type = sys.argv[2] if len(sys.argv) > 2 else "VOLUME"
+
+if os.path.exists(communication_file) and stat.S_ISSOCK(os.stat(communication_file).st_mode):
+    # tar exports the number of the volume it is about to start
+    volume = os.environ.get("TAR_VOLUME", "-")
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(communication_file)
+        s.sendall(f"{message_type} {volume}\n".encode("UTF-8"))
+        reply = s.makefile("r").readline().split()
+
+    if reply != ["ACK", volume]:
+        print(f"Unexpected reply {reply} for volume {volume}", file=sys.stderr)
+        sys.exit(1)
+
+    sys.exit(0)
 
 print(f"Writing to communication file {communication_file}")
 Path(communication_file).touch(exist_ok=False)
@@ -4,12 +4,20 @@ import argparse
 import datetime
 import os
 
-from config import BackupConfig, RestoreConfig, ListBackupConfig, ListFilesConfig
+from config import BackupConfig, RestoreConfig, ListBackupConfig, ListFilesConfig, PlanConfig, BenchConfig, \
+    StatsConfig, RebuildIndexConfig, FindConfig
 from cmd_backup import Backup
+from cmd_bench import Bench, DATASETS
+from cmd_find import Find, MATCH_TYPES
 from cmd_restore import Restore
 from cmd_list_backups import ListBackups
 from cmd_list_files import ListFiles
+from cmd_plan import Plan
+from cmd_rebuild_index import RebuildIndex
+from cmd_stats import Stats
 from cmd_test import Test
+from hashing import HASH_ALGORITHMS
+from virtual_tape import GENERATIONS
 
 logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO, datefmt='%I:%M:%S')
 
@@ -28,20 +36,156 @@ def do():
     backup.add_argument("--tempdir", help="Store tar output", default="./temp")
     backup.add_argument("--tape", help="Tape device", default="/dev/nst0")
     backup.add_argument("--tape-dummy", help="Used for local debugging, if specified the tape isn't used.")
+    backup.add_argument("--span-tapes", help="Fill every tape until the end, the volume continues on the next "
+                                             "tape (needs mbuffer --tapeaware support of the drive)",
+                        action="store_true")
+    backup.add_argument("--fit-confidence", help="Standard deviations of the compression ratio added to the "
+                                                 "predicted size of the next chunk before deciding if it still fits "
+                                                 "on the tape", default=3.0, type=float)
+    backup.add_argument("--tape-fixture", help="Directory with recorded sg_logs.txt and mt_status.txt used instead "
+                                               "of querying the drive, for testing", default=None)
+    backup.add_argument("--metrics-textfile", help="Prometheus textfile the pipeline metrics are written to, e.g. "
+                                                   "into the directory of the node_exporter textfile collector",
+                        default=None)
+    backup.add_argument("--metrics-jsonl", help="JSON lines file the pipeline metrics and events are appended to",
+                        default=None)
+    backup.add_argument("--metrics-interval", help="Seconds between two metric samples", default=10, type=int)
+    backup.add_argument("--tape-writer", help="mbuffer or native: a ring buffer in this process writes to the tape, "
+                                              "byte counts and md5 without parsing the mbuffer log",
+                        default="mbuffer", choices=["mbuffer", "native"])
+    backup.add_argument("--write-buffer", help="GBs of memory buffering the data in front of the tape", default=5,
+                        type=int)
+    backup.add_argument("--write-buffer-start", help="Percent the write buffer is filled before the tape starts "
+                                                     "(again after it ran empty)", default=90, type=int)
+    backup.add_argument("--hash", help="Hashes the uncompressed chunk and the encrypted data on tape while they are "
+                                       "written, can be given more than once", action="append",
+                        choices=HASH_ALGORITHMS)
+    backup.add_argument("--file-hash", help="Hashes the content of every file while it goes through the pipeline, "
+                                            "stored in the catalog", default=None, choices=HASH_ALGORITHMS)
     backup.add_argument("--chunk-size", help="Backups are written in single chunks. Size in GB", default=20, type=int)
     backup.add_argument("--incremental-time", help="If set only includes files modified in the past n days",
                         default=None, required=False, type=int)
+    backup.add_argument("--incremental-index", help="Only includes files that are new or changed (size, mtime, "
+                                                    "ctime, inode) since the last backup of this repository, the "
+                                                    "first backup is a full backup", action="store_true")
+    backup.add_argument("--listed-incremental", help="Use tar --listed-incremental with a snapshot file kept per "
+                                                     "repository (alternative to --incremental-index)",
+                        action="store_true")
+    backup.add_argument("--scan-workers", help="Threads scanning the source directory for file lists",
+                        default=8, type=int)
+    backup.add_argument("--prescan", help="Scan the source before starting tar, so the total size and the ETA of "
+                                          "the backup are known", action="store_true")
     backup.add_argument("--exclude", help="tar exclude option", default=None, required=False, action='append',
                         nargs='+')
     backup.add_argument("--description", help="Additional description for a backup", default="", type=str)
     backup.add_argument("--zstd-level", help="Zstd Compression level", default=5, type=int)
+    backup.add_argument("--staging-chunks", help="Number of tar chunks staged in tempdir, so tar, compression and "
+                                                 "tape writing overlap. 0 processes each chunk synchronously",
+                        default=0, type=int)
+    backup.add_argument("--staging-reserve", help="GBs kept free in tempdir on top of the next chunk before tar "
+                                                  "is allowed to continue", default=5, type=int)
+    backup.add_argument("--streaming", help="tar writes through a fifo directly into zstd/age/mbuffer, chunks are "
+                                            "not written to tempdir", action="store_true")
+    backup.add_argument("--compression-workers", help="Chunks compressed/encrypted in parallel when staging, "
+                                                      "should not be larger than --staging-chunks",
+                        default=1, type=int)
+    backup.add_argument("--zstd-threads", help="Zstd threads per compression worker, 0 splits all cores between "
+                                               "the workers", default=0, type=int)
+    backup.add_argument("--compression-memory", help="Memory budget in GB for all compression workers, limits the "
+                                                     "number of workers at high zstd levels. 0 is unlimited",
+                        default=0, type=int)
+    backup.add_argument("--adaptive-zstd", help="Adapt the zstd level per chunk, so the tape keeps streaming and "
+                                                "otherwise compresses as much as possible", action="store_true")
+    backup.add_argument("--zstd-min-level", help="Lowest level for --adaptive-zstd, negative levels are --fast",
+                        default=-5, type=int)
+    backup.add_argument("--zstd-max-level", help="Highest level for --adaptive-zstd", default=19, type=int)
+    backup.add_argument("--min-tape-speed", help="Minimum streaming speed of the drive in MB/s for --adaptive-zstd",
+                        default=0, type=int)
+    backup.add_argument("--route-incompressible", help="Back up already compressed files (by extension and sampled "
+                                                       "entropy) in separate chunks with the fastest zstd level",
+                        action="store_true")
+    backup.add_argument("--incompressible-zstd-level", help="zstd level for the chunks of already compressed files, "
+                                                            "negative levels are --fast", default=-100, type=int)
+
+    plan = subparsers.add_parser("plan")
+    plan.add_argument("--backup-repository", help="Name of the backup repository", default="default")
+    plan.add_argument("--source", help="Source directory", required=True)
+    plan.add_argument("--tempdir", help="Store temporary files", default="./temp")
+    plan.add_argument("--tape", help="Tape device", default="/dev/nst0")
+    plan.add_argument("--tape-dummy", help="Used for local debugging, if specified the tape isn't used.")
+    plan.add_argument("--tape-buffer", help="GBs left before changing to the next tape", default=10, type=int)
+    plan.add_argument("--incremental-time", help="If set only includes files modified in the past n days",
+                      default=None, required=False, type=int)
+    plan.add_argument("--exclude", help="tar exclude option", default=None, required=False, action='append',
+                      nargs='+')
+    plan.add_argument("--zstd-level", help="Zstd Compression level", default=5, type=int)
+    plan.add_argument("--scan-workers", help="Threads scanning the source directory", default=8, type=int)
+    plan.add_argument("--sample-files", help="Number of files sampled for the compression ratio", default=1000,
+                      type=int)
+    plan.add_argument("--sample-size", help="MBs compressed to estimate ratio and speed", default=256, type=int)
+    plan.add_argument("--tape-capacity", help="Tape capacity in GB if the drive doesn't report it", default=2500,
+                      type=int)
+    plan.add_argument("--tape-speed", help="Tape speed in MB/s, 0 uses the average of the last backup",
+                      default=0, type=int)
+
+    bench = subparsers.add_parser("bench")
+    bench.add_argument("--workdir", help="Directory for datasets, virtual tape and scratch files",
+                       default="./bench")
+    bench.add_argument("--dataset", help="Datasets to run, all by default", default=None, action='append',
+                       choices=list(DATASETS.keys()))
+    bench.add_argument("--password-file", help="Password in plain text as file", default="./password.age")
+    bench.add_argument("--output", help="JSON file for the results", default="./bench.json")
+    bench.add_argument("--scale", help="Multiplies the number of files and the size of the large files, "
+                                       "0.01 is a quick run", default=1.0, type=float)
+    bench.add_argument("--seed", help="Seed of the generated datasets", default=1, type=int)
+    bench.add_argument("--tape-generation", help="LTO generation the virtual tape emulates", default="LTO-6",
+                       choices=list(GENERATIONS.keys()))
+    bench.add_argument("--zstd-level", help="Zstd Compression level", default=5, type=int)
+    bench.add_argument("--scan-workers", help="Threads scanning the source directory", default=8, type=int)
+    bench.add_argument("--backup-args", help="Additional backup options, e.g. \"--streaming\"", default="")
+    bench.add_argument("--stages-only", help="Only measure the single stages, without backup, test and restore",
+                       action="store_true")
+    bench.add_argument("--baseline", help="JSON results of an earlier run to compare with", default=None)
+    bench.add_argument("--regression-threshold", help="Percent of throughput lost before a stage is reported as "
+                                                      "regression", default=10, type=int)
 
     list_backups = subparsers.add_parser("list-backups")
     list_backups.add_argument("--backup-repository", help="Name of the backup repository", default="default")
+    list_backups.add_argument("--since", help="Only backups started on or after this day (YYYY-MM-DD)", default=None)
+    list_backups.add_argument("--until", help="Only backups started on or before this day (YYYY-MM-DD)", default=None)
+    list_backups.add_argument("--type", help="Only full or incremental backups", default=None,
+                              choices=["full", "incremental"])
+    list_backups.add_argument("--tape-serial", help="Only backups on this tape", default=None)
+    list_backups.add_argument("--limit", help="Backups per page, 0 = all", default=0, type=int)
+    list_backups.add_argument("--offset", help="Matching backups to skip, e.g. --limit 20 --offset 20 for the "
+                                               "second page", default=0, type=int)
+
+    find = subparsers.add_parser("find")
+    find.add_argument("pattern", help="Path as in the backup (without leading /), prefix, glob or part of a path")
+    find.add_argument("--backup-repository", help="Name of the backup repository", default="default")
+    find.add_argument("--match", help="How the pattern is compared with the paths, default: glob if the pattern "
+                                      "contains *, ? or [, exact otherwise", default=None, choices=MATCH_TYPES)
+    find.add_argument("--limit", help="Versions shown, 0 = all", default=1000, type=int)
+
+    rebuild_index = subparsers.add_parser("rebuild-index")
+    rebuild_index.add_argument("--backup-repository", help="Name of the backup repository", default="default")
+
+    stats = subparsers.add_parser("stats")
+    stats.add_argument("--backup-repository", help="Name of the backup repository", default="default")
+    stats.add_argument("--last", help="Number of backups to show", default=20, type=int)
+    stats.add_argument("--slow-threshold", help="Tape rates below this percentage of the median are highlighted",
+                       default=80, type=int)
 
     list_files = subparsers.add_parser("list-files")
     list_files.add_argument("--backup-repository", help="Name of the backup repository", default="default")
-    list_files.add_argument("--backup-name", help="Name of the backup to restore, or number", required=True)
+    list_files_backups = list_files.add_mutually_exclusive_group(required=True)
+    list_files_backups.add_argument("--backup-name", help="Name of the backup to restore, or number")
+    list_files_backups.add_argument("--all-backups", help="Search --path in every backup of the repository",
+                                    action="store_true", default=False)
+    list_files.add_argument("--path", help="Only list this file or directory (path as in the backup, without "
+                                           "leading /)", default=None)
+    list_files.add_argument("--workers", help="Processes reading the catalogs with --all-backups, 0 = one per core",
+                            type=int, default=0)
 
     restore = subparsers.add_parser("restore")
     restore.add_argument("--backup-repository", help="Name of the backup repository", default="default")
@@ -54,6 +198,10 @@ def do():
     restore.add_argument("--tape-dummy", help="Used for local debugging, if specified the tape isn't used.")
     restore.add_argument("--exclude", help="tar exclude option", default=None, required=False, action='append',
                          nargs='+')
+    restore.add_argument("--include", help="Only restore this path (as in the backup, without leading /) with "
+                                           "everything below it, or the paths matching this glob (* also matches /). "
+                                           "Only the volumes containing them are read. Can be repeated.",
+                         default=None, action="append")
 
     test = subparsers.add_parser("test")
     test.add_argument("--backup-repository", help="Name of the backup repository", default="default")
@@ -69,10 +217,24 @@ def do():
 
     args = parser.parse_args()
 
+    if args.command == 'backup' and args.streaming and (args.staging_chunks > 0 or args.compression_workers != 1):
+        # the streaming pipeline doesn't stage chunks, the options would be ignored
+        backup.error("--streaming can't be combined with --staging-chunks or --compression-workers")
+
     if args.command == 'backup':
         do_backup(args)
+    elif args.command == 'plan':
+        do_plan(args)
+    elif args.command == 'bench':
+        do_bench(args)
     elif args.command == "list-backups":
         do_list_backup(args)
+    elif args.command == "find":
+        do_find(args)
+    elif args.command == "rebuild-index":
+        do_rebuild_index(args)
+    elif args.command == 'stats':
+        do_stats(args)
     elif args.command == 'list-files':
         do_list_files(args)
     elif args.command == 'restore':
@@ -88,7 +250,10 @@ def do():
 def do_list_files(args):
     config = ListFilesConfig(
         backup_repository=args.backup_repository,
-        backup_name=args.backup_name
+        backup_name=args.backup_name,
+        path=args.path,
+        all_backups=args.all_backups,
+        workers=args.workers
     )
 
     ListFiles(config).do()
@@ -104,7 +269,8 @@ def do_restore(args):
         tempdir=args.tempdir,
         tape=args.tape,
         tape_dummy=args.tape_dummy,
-        excludes=args.exclude
+        excludes=args.exclude,
+        includes=args.include
     )
 
     Restore(config).do()
@@ -140,7 +306,34 @@ def do_backup(args):
         chunk_size=args.chunk_size,
         incremental_time=args.incremental_time,
         excludes=args.exclude,
-        zstd_level=args.zstd_level
+        zstd_level=args.zstd_level,
+        staging_chunks=args.staging_chunks,
+        staging_reserve=args.staging_reserve,
+        streaming=args.streaming,
+        compression_workers=args.compression_workers,
+        zstd_threads=args.zstd_threads,
+        compression_memory=args.compression_memory,
+        adaptive_zstd=args.adaptive_zstd,
+        zstd_min_level=args.zstd_min_level,
+        zstd_max_level=args.zstd_max_level,
+        min_tape_speed=args.min_tape_speed,
+        route_incompressible=args.route_incompressible,
+        incompressible_zstd_level=args.incompressible_zstd_level,
+        incremental_index=args.incremental_index,
+        listed_incremental=args.listed_incremental,
+        scan_workers=args.scan_workers,
+        prescan=args.prescan,
+        span_tapes=args.span_tapes,
+        fit_confidence=args.fit_confidence,
+        tape_fixture=args.tape_fixture,
+        metrics_textfile=args.metrics_textfile,
+        metrics_jsonl=args.metrics_jsonl,
+        metrics_interval=args.metrics_interval,
+        tape_writer=args.tape_writer,
+        write_buffer=args.write_buffer,
+        write_buffer_start=args.write_buffer_start,
+        hashes=args.hash,
+        file_hash=args.file_hash
     )
 
     with open(config.password_file, 'r') as f:
@@ -150,14 +343,90 @@ def do_backup(args):
     Backup(config).do()
 
 
+def do_plan(args):
+    config = PlanConfig(
+        backup_repository=args.backup_repository,
+        source=args.source,
+        tempdir=args.tempdir,
+        tape=args.tape,
+        tape_dummy=args.tape_dummy,
+        tape_buffer=args.tape_buffer,
+        incremental_time=args.incremental_time,
+        excludes=args.exclude,
+        zstd_level=args.zstd_level,
+        scan_workers=args.scan_workers,
+        sample_files=args.sample_files,
+        sample_size=args.sample_size,
+        tape_capacity=args.tape_capacity,
+        tape_speed=args.tape_speed
+    )
+
+    Plan(config).do()
+
+
+def do_bench(args):
+    config = BenchConfig(
+        workdir=args.workdir,
+        datasets=args.dataset if args.dataset else list(DATASETS.keys()),
+        password_file=args.password_file,
+        output=args.output,
+        scale=args.scale,
+        seed=args.seed,
+        tape_generation=args.tape_generation,
+        zstd_level=args.zstd_level,
+        scan_workers=args.scan_workers,
+        backup_args=args.backup_args,
+        stages_only=args.stages_only,
+        baseline=args.baseline,
+        regression_threshold=args.regression_threshold
+    )
+
+    Bench(config).do()
+
+
 def do_list_backup(args):
     config = ListBackupConfig(
         backup_repository=args.backup_repository,
+        since=args.since,
+        until=args.until,
+        backup_type=args.type,
+        tape_serial=args.tape_serial,
+        limit=args.limit,
+        offset=args.offset
     )
 
     ListBackups(config).do()
 
 
+def do_find(args):
+    config = FindConfig(
+        backup_repository=args.backup_repository,
+        pattern=args.pattern,
+        match=args.match,
+        limit=args.limit
+    )
+
+    Find(config).do()
+
+
+def do_rebuild_index(args):
+    config = RebuildIndexConfig(
+        backup_repository=args.backup_repository,
+    )
+
+    RebuildIndex(config).do()
+
+
+def do_stats(args):
+    config = StatsConfig(
+        backup_repository=args.backup_repository,
+        last=args.last,
+        slow_threshold=args.slow_threshold
+    )
+
+    Stats(config).do()
+
+
 def do_identify(args):
     pass
 
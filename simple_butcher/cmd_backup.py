@@ -1,91 +1,147 @@
 import os
 import logging
 import shutil
+import threading
 import time
+from dataclasses import dataclass
 
 from config import BackupConfig
-from common import ArchiveVolumeNumber, tape_performance, get_safe_file_size
-from myzmq import SimpleMq
-from tarwrapper import TarWrapper
+from common import ArchiveVolumeNumber, tape_performance, get_safe_file_size, file_size_format
+from myzmq import SocketMq
+from tarwrapper import TarWrapper, TarLogReader
 from sha256wrapper import Sha256Wrapper
-from compression_zstdage_v2 import ZstdAgeV2
-from tapeinfowrapper import TapeinfoWrapper
+from compression_zstdage_v2 import ZstdAgeV2, PipelineStats, estimate_zstd_memory
+from tape_status import TapeStatus
 from database import BackupRecord, BackupDatabase, BackupDatabaseRepository, DB_ROOT, BackupInfo, \
-    INCREMENTAL_INDEX_FILENAME
+    INCREMENTAL_INDEX_FILENAME, VolumeInfo
 from mbufferwrapper import MBufferWrapper
-from mtstwrapper import MTSTWrapper
 from progressbar import ProgressDisplay, ByteTask
+from staging import StagingQueue, StagedChunk
+from file_router import FileRouter
+from file_state import FileStateIndex
+from zstd_controller import AdaptiveLevelController
+from fit_predictor import TapeFitPredictor
+from tape_span import TapeSpan, TapeSpanListener, TAPE_BLOCK_SIZE
+from mbuffer_log import MBufferLogReader
+from operator_prompt import MainThreadPrompt
+from metrics import PipelineMetrics
+from hashing import VolumeHashes
+from tape_writer import TapeWriter
+from tarindex import parse_tar_line
+
+MBUFFER_LOG_SETTLE_SECONDS = 1  # mbuffer logs its status about every half second
+MBUFFER_LOG_SETTLE_READS = 5
+
+
+@dataclass
+class TarPass:
+    files_from: str = None  # NUL separated list, None backs up the source (or the incremental file list)
+    zstd_level: int = None  # None uses the configured / adaptive level
 
 
 class Backup:
     def __init__(self, config: BackupConfig):
         self.config = config
-        self.com = SimpleMq(config.tempdir + "/tar_archive_done")
+        self.com = SocketMq(config.tempdir + "/tar_archive_done")
         self.pd = ProgressDisplay()
         self.com.cleanup()
         self.tar_output_file = None
         self.tar = TarWrapper(self.pd)
         self.sha256 = Sha256Wrapper()
         self.compression_v2 = ZstdAgeV2(self.pd)
-        self.tapeinfo = TapeinfoWrapper(config)
+        self.tape_status = TapeStatus.from_config(config)
         self.mbuffer = MBufferWrapper(config)
-        self.mtst = MTSTWrapper(config.tape, config.tape_dummy)
+        self.metrics = PipelineMetrics(
+            config.metrics_textfile, config.metrics_jsonl,
+            labels={"repository": config.backup_repository, "backup": config.backup_name},
+            interval=config.metrics_interval
+        )
+        self.compression_v2.metrics = self.metrics
+        self.mbuffer.metrics = self.metrics
+        self.prompt = MainThreadPrompt()  # tape changes requested by the span listener or the tape writer threads
+        self.compression_v2.prompt = self.prompt
         self.database = None
+        self.tape_bar = None
+        self.tape_serial = None
+        self.tape_serials = []
+        self.tape_start_time = None
+        self.zstd_level = config.zstd_level
+        self.level_controller = None
+        self.archive_set = 0
+        self.tar_log_offset = 0
+        self.repository = BackupDatabaseRepository(DB_ROOT, config.backup_repository)
+        self.file_state = None
+        self.source_bytes = 0
+        self.source_bar = None
+        self.fit_predictor = TapeFitPredictor(config.tape_buffer * 1024 * 1024 * 1024, config.fit_confidence)
+        self.span = None  # of the volume currently written to tape
+        self.writing_volume_no = None
+        self.span_listener = None
+        if config.span_tapes and config.tape_dummy is None and config.tape_writer == "native":
+            self.compression_v2.on_end_of_medium = self.handle_end_of_medium
+            self.mbuffer.on_end_of_medium = self.handle_end_of_medium
+        elif config.span_tapes and config.tape_dummy is None:
+            self.span_listener = TapeSpanListener(config.tempdir + "/tape_full", self.handle_tape_full)
+            self.compression_v2.autoload_opts = self.span_listener.autoload_opts()
+            self.mbuffer.autoload_opts = self.span_listener.autoload_opts()
+        if config.adaptive_zstd:
+            self.level_controller = AdaptiveLevelController(
+                config.zstd_level, config.zstd_min_level, config.zstd_max_level,
+                config.min_tape_speed * 1000 * 1000
+            )
 
     def do(self):
         self.database = BackupDatabase(DB_ROOT, self.config.backup_repository, self.config.backup_name)
         self.database.start_backup()
         backup_time_start = time.time()
+        self.metrics.start()
 
-        tape_start_index, _, _ = self.mtst.current_position()
-        base_backup_name = None  # self.prepare_incremental_file(self.database)
+        tape_start_index, _, _ = self.tape_status.position()
+        base_backup_name = None
+        if self.config.listed_incremental:
+            self.prepare_listed_incremental_file()
 
-        self.tar_output_file, tar_process, tar_thread = self.tar.main_backup_full(
-            self.config, None, self.com.communication_file, self.database
-        )
+        tar_passes = self.prepare_tar_passes()
+        self.metrics.add("scan", "bytes_in_total", self.source_bytes)
+        self.metrics.event("scan", seconds=time.time() - backup_time_start, bytes=self.source_bytes)
 
-        tape_size = self.tapeinfo.size_statistics()
-        tape_serial = self.tapeinfo.volume_serial()
+        tape_size = self.tape_status.size_statistics()
+        tape_serial = self.tape_status.volume_serial()
 
         self.pre_backup_hook()
         self.handle_tape_change(is_first_tape=True)
 
-        tape_start_time = time.time()
+        self.tape_start_time = time.time()
         archive_volume_no = ArchiveVolumeNumber(tape_no=0, volume_no=0, block_position=0, bytes_written=0)
-        tape_serials = [tape_serial]
+        self.tape_serial = tape_serial
+        self.tape_serials = [tape_serial]
 
-        tape_bar = self.pd.create_tape_bar(tape_capacity=tape_size.maximum_bytes).__enter__()
-        tape_bar.update(
+        self.tape_bar = self.pd.create_tape_bar(tape_capacity=tape_size.maximum_bytes).__enter__()
+        self.tape_bar.update(
             completed=tape_size.written_bytes,
             postfix=f"serial={tape_serial}, compression-ratio={self.compression_ratio()}, tape_no=0"
         )
+        if self.source_bytes > 0:
+            self.source_bar = self.pd.create_byte_bar("backup", total_bytes=self.source_bytes).__enter__()
 
-        while tar_thread.is_alive():
-            if self.com.wait_for_signal():
-                archive_volume_no, tape_changed = self.handle_archive(archive_volume_no)
-                if tape_changed:
-                    tape_start_time = time.time()
-                    tape_serial = self.tapeinfo.volume_serial()
-                    tape_size = self.tapeinfo.size_statistics()
-                    tape_serials.append(tape_serial)
-                    self.pd.progress.reset(
-                        tape_bar.task_id, total=tape_size.maximum_bytes, postfix=""
-                    )
-
-                tape_size = self.tapeinfo.size_statistics()
-                tape_perf_str = tape_performance(tape_start_time, tape_size)
-                tape_bar.update(
-                    completed=tape_size.written_bytes,
-                    postfix=f"serial={tape_serial}, compression-ratio={self.compression_ratio()}, "
-                            f"tape_no={archive_volume_no.tape_no}, {tape_perf_str}"
-                )
+        if self.span_listener is not None:
+            self.span_listener.start()
+
+        for archive_set, tar_pass in enumerate(tar_passes):
+            archive_volume_no = self.run_tar_pass(archive_volume_no, archive_set, tar_pass)
 
-        if os.path.exists(self.tar_output_file):  # backup also last output file
-            archive_volume_no, tape_changed = self.handle_archive(archive_volume_no, last_archive=True)
+        if self.span_listener is not None:
+            self.span_listener.stop()
 
-        tape_bar.__exit__()
+        self.tape_bar.__exit__()
+        if self.source_bar is not None:
+            self.source_bar.__exit__()
 
         self.post_backup_hook()
+        self.metrics.stop()
+
+        if self.config.listed_incremental:
+            shutil.copy(self.database.tar_incremental_file(), self.repository.listed_incremental_file() + ".new")
 
         self.database.close_backup(BackupInfo(
             time_start=int(backup_time_start),
@@ -97,9 +153,111 @@ class Backup:
             incremental_time=self.config.incremental_time,
             tape_start_index=tape_start_index,
             description=self.config.description,
-            tape_serials=tape_serials
+            tape_serials=self.tape_serials,
+            incremental_mode=self.incremental_mode()
         ))
+        self.commit_incremental_state()
         logging.info("Backup process has finished.")
+        self.com.close()
+
+    def prepare_tar_passes(self) -> ["TarPass"]:
+        """
+        Every pass is a tar run of its own. Normally there is only one, with --route-incompressible the already
+        compressed files are backed up in a second run with the (almost) store only zstd level.
+        """
+        files_from = None
+        if self.config.incremental_index:
+            files_from = self.build_changed_file_list()
+        elif self.config.incremental_time is not None:
+            logging.info(f"Creating list of files that have changed in the last {self.config.incremental_time} days")
+            self.source_bytes = self.tar.build_incremental_file_list(self.config, self.database).bytes
+            files_from = self.database.tar_input_file_list()
+        elif self.config.prescan or self.config.route_incompressible:
+            logging.info(f"Scanning {self.config.source}")
+            self.source_bytes = self.tar.build_file_list(self.config, self.database).bytes
+            files_from = self.database.tar_input_file_list()
+
+        if not self.config.route_incompressible:
+            return [TarPass(files_from=files_from)]
+
+        logging.info(f"Sorting out already compressed files")
+        router = FileRouter(self.database.tar_input_file_list(), self.database.tar_store_file_list())
+        shutil.move(files_from, files_from + ".all")
+        router.route_null_file_list(files_from + ".all")
+        os.remove(files_from + ".all")
+
+        logging.info(
+            f"{router.compressible_files} compressible entries, {router.incompressible_files} already compressed "
+            f"files ({file_size_format(router.incompressible_bytes)})."
+        )
+
+        tar_passes = [TarPass(files_from=router.compressible_list)]
+        if router.incompressible_files > 0:
+            tar_passes.append(TarPass(
+                files_from=router.incompressible_list, zstd_level=self.config.incompressible_zstd_level
+            ))
+        return tar_passes
+
+    def build_changed_file_list(self) -> str:
+        logging.info(f"Comparing {self.config.source} with the file state of the last backup")
+        self.file_state = FileStateIndex(self.repository.file_state_file())
+        excludes = [exclude[0] for exclude in self.config.excludes] if self.config.excludes else []
+        self.file_state.diff(self.config.source, self.database.tar_input_file_list(), excludes)
+        self.source_bytes = self.file_state.changed_bytes
+        logging.info(f"{file_size_format(self.file_state.changed_bytes)} to back up.")
+        return self.database.tar_input_file_list()
+
+    def prepare_listed_incremental_file(self):
+        """
+        tar updates the snapshot file in place, so it works on a copy and the repository snapshot is only replaced
+        once the backup is complete. Without a snapshot tar does a level 0 (full) backup.
+        """
+        if os.path.exists(self.repository.listed_incremental_file()):
+            shutil.copy(self.repository.listed_incremental_file(), self.database.tar_incremental_file())
+
+    def incremental_mode(self) -> str:
+        if self.config.incremental_index:
+            return "index"
+        if self.config.listed_incremental:
+            return "listed"
+        return None
+
+    def commit_incremental_state(self):
+        if self.file_state is not None:
+            self.file_state.commit()
+        if self.config.listed_incremental:
+            os.replace(self.repository.listed_incremental_file() + ".new", self.repository.listed_incremental_file())
+
+    def run_tar_pass(
+            self, archive_volume_no: ArchiveVolumeNumber, archive_set: int, tar_pass: "TarPass"
+    ) -> ArchiveVolumeNumber:
+        self.archive_set = archive_set
+        zstd_level, level_controller = self.zstd_level, self.level_controller
+        if tar_pass.zstd_level is not None:  # fixed level for this pass
+            self.zstd_level, self.level_controller = tar_pass.zstd_level, None
+
+        self.tar_log_offset = get_safe_file_size(self.database.tar_log_file())
+        self.tar_output_file, tar_process, tar_thread = self.tar.main_backup_full(
+            self.config, None, self.com.communication_file, self.database, files_from=tar_pass.files_from
+        )
+
+        if self.config.streaming:
+            archive_volume_no = self.run_streaming(archive_volume_no, tar_thread)
+        elif self.config.staging_chunks > 0:
+            archive_volume_no = self.run_staged(archive_volume_no, tar_thread)
+        else:
+            while tar_thread.is_alive():
+                if self.com.wait_for_signal():
+                    archive_volume_no, tape_changed = self.handle_archive(archive_volume_no)
+                    self.update_tape_status(archive_volume_no, tape_changed)
+
+            if os.path.exists(self.tar_output_file):  # backup also last output file
+                archive_volume_no, tape_changed = self.handle_archive(archive_volume_no, last_archive=True)
+
+        if tar_pass.zstd_level is not None:
+            self.zstd_level, self.level_controller = zstd_level, level_controller
+
+        return archive_volume_no
 
     def pre_backup_hook(self):
         pass
@@ -107,11 +265,340 @@ class Backup:
     def post_backup_hook(self):
         pass
 
+    def record_volume(self, tape_no: int, stats: PipelineStats, count_compression: bool = True):
+        """
+        Stores how the volume was written and lets the adaptive controller choose the zstd level for the next one
+        :param count_compression: False if the compression was already counted (staged chunks)
+        """
+        if self.span is not None:
+            tape_no = self.span.tape_no
+
+        self.database.store_volume(VolumeInfo(
+            tape_no=tape_no,
+            volume_no=stats.volume_no,
+            zstd_level=stats.zstd_level,
+            bytes_read=stats.bytes_read,
+            bytes_written=stats.bytes_written,
+            duration=stats.duration,
+            write_rate=stats.write_rate(),
+            buffer_fill_min=stats.buffer_fill_min,
+            buffer_fill_avg=stats.buffer_fill_avg,
+            archive_set=self.archive_set,
+            tape_serials=self.span.tape_serials if self.span is not None else None,
+            split_bytes=self.span.split_bytes if self.span is not None else None,
+            compression_duration=stats.compression_duration,
+            buffer_empty_events=stats.buffer_empty_events if stats.buffer_fill_samples > 0 else -1,
+            tape_serial=self.span.tape_serials[0] if self.span is not None else self.tape_status.volume_serial(),
+            time_end=time.time(),
+            plain_hashes=stats.hashes.plain,
+            archive_hashes=stats.hashes.archive,
+        ))
+
+        if count_compression:
+            self.count_compression(stats.bytes_read, stats.bytes_written)
+        self.metrics.add("tape", "bytes_in_total", stats.bytes_written)
+        self.metrics.add("tape", "bytes_out_total", stats.bytes_written)
+        self.metrics.add("tape", "volumes_total", 1)
+        self.metrics.add("tape", "buffer_empty_events_total", stats.buffer_empty_events)
+        self.metrics.event(
+            "volume", volume_no=stats.volume_no, tape_no=tape_no, zstd_level=stats.zstd_level,
+            bytes_read=stats.bytes_read, bytes_written=stats.bytes_written, duration=stats.duration,
+            write_rate=stats.write_rate(), buffer_fill_min=stats.buffer_fill_min,
+            buffer_fill_avg=stats.buffer_fill_avg, buffer_empty_events=stats.buffer_empty_events,
+            compression_duration=stats.compression_duration
+        )
+
+        self.fit_predictor.observe(stats.bytes_read, stats.bytes_written, self.archive_set, stats.zstd_level)
+        split_bytes = sum(self.span.split_bytes) if self.span is not None else 0
+        self.tape_status.file_written(stats.bytes_written - split_bytes)
+        if self.source_bar is not None:
+            self.source_bar.update(advance=stats.bytes_read)
+
+        if self.level_controller is not None:
+            self.zstd_level = self.level_controller.next_level(stats)
+
+    def count_tar_volume(self, tar_bytes: int):
+        self.metrics.add("tar", "bytes_out_total", tar_bytes)
+        self.metrics.add("tar", "volumes_total", 1)
+
+    def count_compression(self, bytes_read: int, bytes_written: int):
+        self.metrics.add("compress", "bytes_in_total", bytes_read)
+        self.metrics.add("compress", "bytes_out_total", bytes_written)
+        self.metrics.add("compress", "volumes_total", 1)
+        if self.compression_v2.all_bytes_read > 0:
+            self.metrics.set(
+                "compress", "compression_ratio",
+                self.compression_v2.all_bytes_written / self.compression_v2.all_bytes_read
+            )
+
+    def count_queue_depth(self, staging: StagingQueue):
+        staged, compressed = staging.depth()
+        self.metrics.set("compress", "queue_depth", staged)
+        self.metrics.set("tape", "queue_depth", compressed)
+
     def compression_ratio(self):
         if self.compression_v2.all_bytes_read <= 1:
             return "-"
         return "%.2f" % (self.compression_v2.all_bytes_written / self.compression_v2.all_bytes_read)
 
+    def update_tape_status(self, archive_volume_no: ArchiveVolumeNumber, tape_changed: bool):
+        if tape_changed:
+            self.tape_start_time = time.time()
+            self.tape_serial = self.tape_status.volume_serial()
+            tape_size = self.tape_status.size_statistics()
+            self.tape_serials.append(self.tape_serial)
+            self.pd.progress.reset(
+                self.tape_bar.task_id, total=tape_size.maximum_bytes, postfix=""
+            )
+
+        tape_size = self.tape_status.size_statistics()
+        tape_perf_str = tape_performance(self.tape_start_time, tape_size)
+        self.tape_bar.update(
+            completed=tape_size.written_bytes,
+            postfix=f"serial={self.tape_serial}, compression-ratio={self.compression_ratio()}, "
+                    f"tape_no={archive_volume_no.tape_no}, {tape_perf_str}"
+        )
+
+    def stage_tar_output(self, volume_no: int) -> (str, int):
+        """
+        Move output to new file so the tar process can be executed while compression/enc/tape writing is done
+        """
+        tar_archive_file = self.config.tempdir + "/files.tar.%09i" % volume_no
+        shutil.move(self.tar_output_file, tar_archive_file)
+        return tar_archive_file, get_safe_file_size(tar_archive_file)
+
+    def run_staged(self, archive_volume_no: ArchiveVolumeNumber, tar_thread) -> ArchiveVolumeNumber:
+        """
+        tar, compression/encryption and tape writing run as independent workers connected by a bounded staging
+        queue, so tar only waits if the queue or the scratch drive is full. Several chunks can be compressed in
+        parallel, the tape writer still gets them in volume order.
+        """
+        chunk_bytes = self.config.chunk_size * 1024 * 1024 * 1024
+        reserve_bytes = self.config.staging_reserve * 1024 * 1024 * 1024
+        staging = StagingQueue(self.config.tempdir, self.config.staging_chunks, chunk_bytes + reserve_bytes)
+
+        compression_workers, zstd_threads = self.compression_budget()
+        logging.info(f"Compressing with {compression_workers} workers and {zstd_threads} zstd threads each.")
+
+        workers = [threading.Thread(target=self._tape_writer_worker, args=(staging, archive_volume_no))]
+        for _ in range(compression_workers):
+            workers.append(threading.Thread(target=self._compressor_worker, args=(staging, zstd_threads)))
+        for worker in workers:
+            worker.start()
+
+        try:
+            volume_no = archive_volume_no.volume_no
+            while tar_thread.is_alive():
+                staging.raise_if_failed()
+                self.prompt.serve()
+                if self.com.wait_for_signal():
+                    tar_archive_file, tar_archive_file_size = self.stage_tar_output(volume_no)
+                    staging.put(StagedChunk(volume_no, tar_archive_file, tar_archive_file_size))
+                    self.count_tar_volume(tar_archive_file_size)
+                    self.count_queue_depth(staging)
+                    volume_no += 1
+
+                    with self.metrics.stall("tar"):
+                        while not staging.wait_for_room(timeout=0.5):
+                            self.prompt.serve()
+                    self.com.signal_tar_to_continue()
+
+            if os.path.exists(self.tar_output_file):  # backup also last output file
+                tar_archive_file, tar_archive_file_size = self.stage_tar_output(volume_no)
+                staging.put(StagedChunk(volume_no, tar_archive_file, tar_archive_file_size))
+                self.count_tar_volume(tar_archive_file_size)
+                self.count_queue_depth(staging)
+        finally:
+            staging.close()
+            for worker in workers:
+                while worker.is_alive():  # the tape writer may still need a tape change
+                    self.prompt.serve()
+                    worker.join(timeout=0.5)
+
+        staging.raise_if_failed()
+        return archive_volume_no
+
+    def compression_budget(self) -> (int, int):
+        """
+        Number of parallel compression workers and zstd threads per worker within the configured CPU and memory budget
+        """
+        workers = max(1, self.config.compression_workers)
+        threads = self.config.zstd_threads
+        if threads <= 0:
+            threads = max(1, (os.cpu_count() or 1) // workers)
+
+        if self.config.compression_memory > 0:
+            memory_bytes = self.config.compression_memory * 1024 * 1024 * 1024
+            per_worker = estimate_zstd_memory(self.config.zstd_level, threads)
+            workers = max(1, min(workers, memory_bytes // per_worker))
+
+        return workers, threads
+
+    def _compressor_worker(self, staging: StagingQueue, zstd_threads: int):
+        try:
+            while True:
+                with self.metrics.stall("compress"):
+                    chunk = staging.get()
+                if chunk is None:
+                    return
+                self.count_queue_depth(staging)
+
+                chunk.records = self.tar.get_contents(
+                    ArchiveVolumeNumber(tape_no=-1, volume_no=chunk.volume_no, block_position=0, bytes_written=0),
+                    chunk.tar_file
+                )
+                chunk.zstd_level = self.zstd_level
+                chunk.hashes = VolumeHashes()
+                compression_start = time.time()
+                chunk.compressed_file = self.compression_v2.compress(
+                    self.config, chunk.volume_no, chunk.tar_file, zstd_threads, zstd_level=chunk.zstd_level,
+                    hashes=chunk.hashes
+                )
+                chunk.compression_duration = time.time() - compression_start
+                chunk.compressed_file_size = get_safe_file_size(chunk.compressed_file)
+                self.count_compression(chunk.tar_file_size, chunk.compressed_file_size)
+                staging.put_compressed(chunk)
+                self.count_queue_depth(staging)
+        except BaseException as e:
+            staging.fail(e)
+
+    def _tape_writer_worker(self, staging: StagingQueue, archive_volume_no: ArchiveVolumeNumber):
+        try:
+            while True:
+                with self.metrics.stall("tape"):
+                    chunk = staging.get_compressed()
+                if chunk is None:
+                    return
+                self.count_queue_depth(staging)
+
+                # the chunk is already compressed, so we know exactly how much space it needs
+                tape_changed = False
+                if not self.fit_on_tape(chunk.compressed_file_size, compressed=True):
+                    self.handle_tape_change()
+
+                    archive_volume_no.incr_tape_no()
+                    tape_changed = True
+
+                for record in chunk.records:
+                    record.tape_no = archive_volume_no.tape_no
+
+                self.begin_tape_write(archive_volume_no)
+                stats = PipelineStats(
+                    chunk.volume_no, chunk.zstd_level, bytes_read=chunk.tar_file_size,
+                    bytes_written=chunk.compressed_file_size, compression_duration=chunk.compression_duration,
+                    hashes=chunk.hashes
+                )
+                write_start = time.time()
+                final_archive_hash = self.mbuffer.write(chunk.compressed_file, stats)
+                stats.duration = time.time() - write_start
+                archive_volume_no.bytes_written += chunk.compressed_file_size
+                self.record_volume(archive_volume_no.tape_no, stats, count_compression=False)
+
+                tape_file_number, tape_volume_serial = self.tape_location()
+                records = self.update_backup_records(
+                    chunk.records, final_archive_hash, tape_file_number, tape_volume_serial, chunk.hashes.files
+                )
+                self.database.store(records)
+
+                archive_volume_no.incr_volume_no()
+                staging.done(chunk)
+                self.update_tape_status(archive_volume_no, tape_changed or self.span is not None)
+        except BaseException as e:
+            staging.fail(e)
+
+    def run_streaming(self, archive_volume_no: ArchiveVolumeNumber, tar_thread) -> ArchiveVolumeNumber:
+        """
+        tar writes into a fifo that feeds zstd | age | mbuffer directly. At every volume change the pipeline of the
+        finished volume is collected and a new one (= new tape file) is started before tar continues.
+        """
+        chunk_bytes = self.config.chunk_size * 1024 * 1024 * 1024
+        tar_log = TarLogReader(self.database.tar_log_file(), self.tar_log_offset)
+        first_volume_no = archive_volume_no.volume_no
+
+        tape_changed = self.prepare_streamed_archive(archive_volume_no, chunk_bytes)
+        while tar_thread.is_alive():
+            self.prompt.serve()
+            if self.com.wait_for_signal():
+                with self.metrics.stall("tar"):  # tar waits until the next pipeline reads the fifo
+                    tar_contents = tar_log.get_contents(archive_volume_no)
+                    tape_changed = self.finish_streamed_archive(archive_volume_no, tar_contents, chunk_bytes) \
+                        or tape_changed
+                    tape_changed = self.prepare_streamed_archive(archive_volume_no, chunk_bytes) or tape_changed
+
+                self.com.signal_tar_to_continue()
+                self.update_tape_status(archive_volume_no, tape_changed)
+                tape_changed = False
+
+        self._release_fifo(self.tar_output_file)  # unblocks zstd if tar died before opening the last volume
+
+        # tar is done, the rest of the log is the last volume. All volumes before were exactly chunk_size.
+        tar_contents = tar_log.get_contents(archive_volume_no)
+        last_bytes = chunk_bytes
+        if tar_log.total_bytes_written is not None:
+            last_bytes = max(
+                0, tar_log.total_bytes_written - (archive_volume_no.volume_no - first_volume_no) * chunk_bytes
+            )
+        tape_changed = self.finish_streamed_archive(archive_volume_no, tar_contents, last_bytes) or tape_changed
+        self.update_tape_status(archive_volume_no, tape_changed)
+
+        return archive_volume_no
+
+    def prepare_streamed_archive(self, archive_volume_no: ArchiveVolumeNumber, chunk_bytes: int) -> bool:
+        # The volume doesn't exist yet, so predict a full chunk
+        tape_changed = False
+        if not self.fit_on_tape(chunk_bytes):
+            self.handle_tape_change()
+
+            archive_volume_no.incr_tape_no()
+            tape_changed = True
+
+        self.begin_tape_write(archive_volume_no)
+        self.compression_v2.start_streaming(
+            self.config, archive_volume_no, self.tar_output_file, zstd_level=self.zstd_level
+        )
+        return tape_changed
+
+    def finish_streamed_archive(
+            self, archive_volume_no: ArchiveVolumeNumber, tar_contents: [BackupRecord], bytes_read: int
+    ) -> bool:
+        """
+        :return: True if the volume continued on the next tape
+        """
+        final_archive_hash = self.compression_v2.finish_streaming(self.config, bytes_read)
+        self.count_tar_volume(bytes_read)
+        archive_volume_no.bytes_written = self.compression_v2.all_bytes_written
+        self.record_volume(archive_volume_no.tape_no, self.compression_v2.last_stats)
+
+        hashes = self.compression_v2.last_stats.hashes
+        if hashes.file_names:
+            self.match_offsets(tar_contents, hashes.file_names)
+
+        tape_file_number, tape_volume_serial = self.tape_location()
+        tar_contents = self.update_backup_records(
+            tar_contents, final_archive_hash, tape_file_number, tape_volume_serial, hashes.files
+        )
+        self.database.store(tar_contents)
+
+        archive_volume_no.incr_volume_no()
+        return self.span is not None
+
+    def match_offsets(self, tar_contents: [BackupRecord], file_names: dict):
+        """
+        The tar -vv listing of a streamed volume has no offsets, the hashed members are found again by their name.
+        tar lists the names before removing the leading / of the member names.
+        """
+        offsets = {name: offset for offset, name in file_names.items()}
+        for record in tar_contents:
+            member = parse_tar_line(record.tar_line)
+            if record.offset < 0 and member is not None:
+                record.offset = offsets.get(member.name.lstrip("/"), -1)
+
+    def _release_fifo(self, fifo: str):
+        try:
+            os.close(os.open(fifo, os.O_WRONLY | os.O_NONBLOCK))
+        except OSError:
+            pass  # no reader waiting
+
     def handle_archive(
             self, archive_volume_no: ArchiveVolumeNumber, last_archive: bool = False
     ) -> (ArchiveVolumeNumber, bool):
@@ -122,10 +609,8 @@ class Backup:
         """
         # logging.info("Processing next chunk...")
 
-        # Move output to new file so the tar process can be executed while compression/enc/tape writing is done
-        tar_archive_file = self.config.tempdir + "/files.tar.%09i" % archive_volume_no.volume_no
-        shutil.move(self.tar_output_file, tar_archive_file)
-        tar_archive_file_size = get_safe_file_size(tar_archive_file)
+        tar_archive_file, tar_archive_file_size = self.stage_tar_output(archive_volume_no.volume_no)
+        self.count_tar_volume(tar_archive_file_size)
 
         # Unleash the TAR process to prepare the next file
         if self.com and not last_archive:  # can't signal on last archive, as there is no one listening
@@ -133,7 +618,7 @@ class Backup:
 
         tar_contents = self.tar.get_contents(archive_volume_no, tar_archive_file)
 
-        # Determine if next tape is necessary. Since we don't know the compression ratio yet, we assume the worst.
+        # Determine if next tape is necessary. The compressed size is predicted from the volumes written so far.
         tape_change = False
         if not self.fit_on_tape(tar_archive_file_size):
             self.handle_tape_change()
@@ -148,6 +633,7 @@ class Backup:
             )
         else:
             raise Exception("Unknown compression method: " + self.config.compression)
+        tape_change = tape_change or self.span is not None
         # elif self.config.compression == "zstd_pipe":
         #     self.compress_zstd_pipe(
         #         archive_volume_no, tar_archive_file, tar_archive_file_size, tar_contents
@@ -161,12 +647,14 @@ class Backup:
             self, archive_volume_no: ArchiveVolumeNumber, tar_archive_file: str,
             tar_archive_file_size: float, tar_contents
     ):
-
+        self.begin_tape_write(archive_volume_no)
         final_archive_hash = self.compression_v2.do(
             config=self.config,
             archive_volume_no=archive_volume_no,
-            input_file=tar_archive_file
+            input_file=tar_archive_file,
+            zstd_level=self.zstd_level
         )
+        self.record_volume(archive_volume_no.tape_no, self.compression_v2.last_stats)
 
         if self.config.tape_dummy:
             archive_volume_no.bytes_written += int(tar_archive_file_size)  # fake for no-tape
@@ -180,10 +668,10 @@ class Backup:
         #     f"{file_size_format(self.compression_v2.all_bytes_written)} written = {ratio} "
         # )
 
-        tape_file_number, _, _ = self.mtst.current_position()
-        tape_volume_serial = self.tapeinfo.volume_serial()
+        tape_file_number, tape_volume_serial = self.tape_location()
         tar_contents = self.update_backup_records(
-            tar_contents, final_archive_hash, tape_file_number - 1, tape_volume_serial
+            tar_contents, final_archive_hash, tape_file_number, tape_volume_serial,
+            self.compression_v2.last_stats.hashes.files
         )
         self.database.store(tar_contents)
 
@@ -223,17 +711,79 @@ class Backup:
     #
     #     archive_volume_no.incr_volume_no()
 
+    def begin_tape_write(self, archive_volume_no: ArchiveVolumeNumber):
+        self.span = None
+        self.writing_volume_no = archive_volume_no
+
+    def handle_end_of_medium(self, writer: TapeWriter):
+        """
+        Called by the native tape writer, it already closed the tape file and counted the bytes on the full tape.
+        """
+        self.handle_tape_full(split_bytes=writer.split_bytes[-1])
+
+    def handle_tape_full(self, split_bytes: int = None):
+        """
+        Called (by the span listener) when mbuffer reached the end of the tape in the middle of a volume.
+        """
+        tape_file_number, _, _ = self.tape_status.position(refresh=True)
+        tape_file_number -= 1  # closing the tape file moved the tape behind its file mark
+        if split_bytes is None:
+            split_bytes = self.mbuffer_split_bytes()
+        if self.span is None:
+            self.span = TapeSpan(
+                tape_no=self.writing_volume_no.tape_no, tape_file_number=tape_file_number,
+                tape_serials=[self.tape_status.volume_serial()]
+            )
+        self.span.split_bytes.append(split_bytes)
+        logging.info(
+            f"Tape is full after {file_size_format(self.span.split_bytes[-1])} of volume "
+            f"{self.writing_volume_no.volume_no}, it continues on the next tape."
+        )
+
+        self.handle_tape_change()
+        self.writing_volume_no.incr_tape_no()
+        self.span.tape_serials.append(self.tape_status.volume_serial())
+
+    def mbuffer_split_bytes(self) -> int:
+        """
+        Bytes of the current volume mbuffer wrote to the full tape. Its log counts all bytes of the volume, mbuffer
+        doesn't write while the autoload command runs, so the count settles after the next status line.
+        """
+        log = MBufferLogReader(self.config.tempdir + "/mbuffer.log")
+        bytes_total = log.read().bytes_total
+        for _ in range(MBUFFER_LOG_SETTLE_READS):
+            time.sleep(MBUFFER_LOG_SETTLE_SECONDS)
+            if log.read().bytes_total == bytes_total:
+                break
+            bytes_total = log.bytes_total
+
+        if bytes_total < 0:
+            raise OSError("mbuffer log has no byte count, can't tell where the volume continues on the next tape")
+        previous_tapes = sum(self.span.split_bytes) if self.span is not None else 0
+        return max(0, bytes_total - previous_tapes) // TAPE_BLOCK_SIZE * TAPE_BLOCK_SIZE  # mbuffer writes whole blocks
+
+    def tape_location(self) -> (int, str):
+        """
+        File number and serial of the tape the last written volume starts on
+        """
+        if self.span is not None:
+            return self.span.tape_file_number, self.span.tape_serials[0]
+
+        tape_file_number, _, _ = self.tape_status.position()
+        return tape_file_number - 1, self.tape_status.volume_serial()
+
     def handle_tape_change(self, is_first_tape: bool = False):
         if is_first_tape:
             return
 
-        tape_no_before = self.tapeinfo.volume_serial()
+        tape_no_before = self.tape_status.volume_serial()
         while True:
             logging.warning("Next archive will not fit on tape, please change it and press any key...")
             logging.warning(f"Remove tape {tape_no_before}")
-            input("Press enter key")
+            self.prompt.ask("Press enter key")
 
-            tape_no_after = self.tapeinfo.volume_serial()
+            tape_no_after = self.tape_status.volume_serial(refresh=True)
+            self.metrics.event("tape_change", serial_before=tape_no_before, serial_after=tape_no_after)
             if tape_no_after == tape_no_before:
                 logging.warning(
                     f"Tape serial before {tape_no_before} matches the "
@@ -244,13 +794,16 @@ class Backup:
 
     def update_backup_records(
             self, backup_records: [BackupRecord], archive_hash: (str, str),
-            tape_file_number: int = -1, tape_volume_serial: str = None
+            tape_file_number: int = -1, tape_volume_serial: str = None, file_hashes: dict = None
     ) -> [BackupRecord]:
         for record in backup_records:
             record.hash_type = archive_hash[0]
             record.archive_hash = archive_hash[1]
             record.tape_file_number = tape_file_number
             record.tape_volume_serial = tape_volume_serial
+            if file_hashes is not None and record.offset in file_hashes:
+                record.file_hash_type = self.config.file_hash
+                record.file_hash = file_hashes[record.offset]
 
         return backup_records
 
@@ -258,16 +811,30 @@ class Backup:
         block_size_bytes = 524272  # rough estimate
         return file_size / block_size_bytes
 
-    def fit_on_tape(self, file_size_bytes):
-        if self.config.tape_dummy is not None:
-            return True
+    def fit_on_tape(self, file_size_bytes, compressed: bool = False):
+        """
+        :param compressed: file_size_bytes is the exact size on tape, otherwise the size of the uncompressed chunk
+        """
+        if self.config.tape_dummy is not None or self.config.span_tapes:
+            return True  # with span_tapes the volume continues on the next tape when the tape is full
+
+        needed_bytes = file_size_bytes
+        if not compressed:
+            needed_bytes = self.fit_predictor.predict(file_size_bytes, self.archive_set, self.zstd_level)
 
-        written_bytes = self.tapeinfo.size_statistics().written_bytes
-        remaining_bytes = self.tapeinfo.size_statistics().remaining_bytes
+        # the estimate is good enough unless the tape is nearly full
+        remaining_bytes = self.tape_status.remaining_bytes(
+            refresh_below=2 * needed_bytes + self.fit_predictor.reserve_bytes
+        )
 
-        # on my LTO-6 tapes I can only write until 115GB are remaining, maybe do some --tapeaware on mbuffer?
-        buffer_bytes = self.config.tape_buffer * 1024 * 1024 * 1024
-        return file_size_bytes + buffer_bytes < remaining_bytes
+        fits = self.fit_predictor.fits(needed_bytes, remaining_bytes)
+        if not fits:
+            logging.info(
+                f"Next chunk needs about {file_size_format(needed_bytes)} "
+                f"(ratio {self.fit_predictor.ratio(self.archive_set, self.zstd_level):.2f}), "
+                f"{file_size_format(remaining_bytes)} remaining on tape."
+            )
+        return fits
 
     # def prepare_incremental_file(self, current_backup: BackupDatabase) -> str:
     #     """
@@ -0,0 +1,456 @@
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, asdict
+
+from rich.console import Console
+from rich.table import Table
+
+from compression_zstdage_v2 import zstd_level_args
+from config import BenchConfig
+from database import DB_ROOT
+from exe_paths import TAR, ZSTD, AGE
+from filesystem import ParallelScanner
+from tarindex import TarIndexer
+from virtual_tape import VirtualTape, VIRTUAL_PREFIX, start_device_process, wait_for_device_process
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLI = os.path.join(REPO_ROOT, "simple_butcher", "cli.py")
+RESULT_VERSION = 1
+
+WRITE_BLOCK_SIZE = 1024 * 1024
+TEXT_POOL_SIZE = 16 * 1024 * 1024
+INCOMPRESSIBLE_EXTENSIONS = [".jpg", ".mp4", ".zst", ".mkv"]
+
+STAGES = ["scan", "tar", "index", "zstd", "age", "tape", "backup", "test", "restore"]
+
+
+@dataclass
+class StageResult:
+    seconds: float
+    bytes: int
+    files: int
+    cpu_seconds: float  # bench process and all (finished) child processes
+    scratch_bytes: int  # written to disk, without the tape, -1 if unknown
+    mb_per_s: float = 0
+    files_per_s: float = 0
+
+    def __post_init__(self):
+        if self.seconds > 0:
+            self.mb_per_s = self.bytes / self.seconds / 1000 / 1000
+            self.files_per_s = self.files / self.seconds
+
+
+class StageMeter:
+    """
+    Measures wall time, CPU time and bytes written to disk of everything that happens between start() and stop(),
+    child processes count as soon as they are waited for. Bytes the virtual tape stored are not scratch.
+    """
+
+    def __init__(self, tape_directory: str):
+        self.tape_directory = tape_directory
+
+    def start(self) -> "StageMeter":
+        self._start = time.time()
+        self._cpu = _cpu_seconds()
+        self._written = _written_bytes()
+        self._tape = _directory_bytes(self.tape_directory)
+        return self
+
+    def stop(self, bytes: int, files: int) -> StageResult:
+        seconds = time.time() - self._start
+        scratch = -1
+        if self._written >= 0:
+            tape = _directory_bytes(self.tape_directory) - self._tape
+            scratch = max(0, _written_bytes() - self._written - tape)
+
+        return StageResult(
+            seconds=seconds, bytes=bytes, files=files, cpu_seconds=_cpu_seconds() - self._cpu, scratch_bytes=scratch
+        )
+
+
+class DatasetGenerator:
+    """
+    Deterministic synthetic datasets, the same seed and scale always create the same files. Counts of files (and the
+    size of the large files) are multiplied by the scale, --scale 0.01 is a quick run.
+    """
+
+    def __init__(self, seed: int, scale: float):
+        self.seed = seed
+        self.scale = scale
+        self._text_pool = None
+
+    def generate(self, name: str, directory: str):
+        self.rng = random.Random(f"{self.seed}-{name}")
+        os.makedirs(directory)
+        DATASETS[name](self, directory)
+
+    def small_files(self, directory: str):
+        """
+        Millions of small text files, 1000 per directory
+        """
+        for i in range(self._count(1000 * 1000)):
+            if i % 1000 == 0:
+                sub_directory = os.path.join(directory, "%05i" % (i // 1000))
+                os.makedirs(sub_directory)
+            self._write_text(os.path.join(sub_directory, "file_%07i.txt" % i), self.rng.randint(512, 16 * 1024))
+
+    def huge_files(self, directory: str):
+        """
+        A few huge compressible files
+        """
+        for i in range(4):
+            self._write_text(os.path.join(directory, "huge_%i.log" % i), self._count(4 * 1000 ** 3))
+
+    def incompressible(self, directory: str):
+        """
+        Random data with the extensions of media files, like photos and videos
+        """
+        for i in range(self._count(1000)):
+            extension = INCOMPRESSIBLE_EXTENSIONS[i % len(INCOMPRESSIBLE_EXTENSIONS)]
+            size = self.rng.randint(1, 16) * 1000 ** 2
+            with open(os.path.join(directory, "media_%05i%s" % (i, extension)), "wb") as f:
+                for block in range(0, size, WRITE_BLOCK_SIZE):
+                    f.write(self.rng.randbytes(min(WRITE_BLOCK_SIZE, size - block)))
+
+    def sparse(self, directory: str):
+        """
+        Disk images with holes, 1% of the blocks have data
+        """
+        for i in range(4):
+            size = self._count(4 * 1000 ** 3)
+            with open(os.path.join(directory, "image_%i.img" % i), "wb") as f:
+                f.truncate(size)
+                block_size = min(size, WRITE_BLOCK_SIZE)  # a small --scale makes images below one block
+                for _ in range(max(1, size // block_size // 100)):
+                    f.seek(self.rng.randrange(size // block_size) * block_size)
+                    f.write(self._text(block_size))
+
+    def deep_tree(self, directory: str):
+        """
+        Deep directories with long names, 10 files per directory
+        """
+        for i in range(self._count(10 * 1000)):
+            path = directory
+            for depth in range(self.rng.randint(16, 64)):
+                path = os.path.join(path, "level_%02i_%s" % (depth, "d" * self.rng.randint(1, 32)))
+            os.makedirs(path, exist_ok=True)
+            for j in range(10):
+                self._write_text(os.path.join(path, "leaf_%06i_%i.txt" % (i, j)), self.rng.randint(0, 4096))
+
+    def _count(self, count: int) -> int:
+        return max(1, int(count * self.scale))
+
+    def _write_text(self, file_name: str, size: int):
+        with open(file_name, "wb") as f:
+            for block in range(0, size, WRITE_BLOCK_SIZE):
+                f.write(self._text(min(WRITE_BLOCK_SIZE, size - block)))
+
+    def _text(self, size: int) -> bytes:
+        """
+        Slice of a pool of random words, compresses about as well as logs and source code
+        """
+        if self._text_pool is None:
+            rng = random.Random(self.seed)
+            words = ["".join(rng.choices("abcdefghijklmnopqrstuvwxyz", k=rng.randint(2, 12))) for _ in range(5000)]
+            text = bytearray()
+            while len(text) < TEXT_POOL_SIZE:
+                text += (" ".join(rng.choices(words, k=16)) + "\n").encode("UTF-8")
+            self._text_pool = bytes(text)
+
+        start = self.rng.randrange(len(self._text_pool) - size) if size < len(self._text_pool) else 0
+        return self._text_pool[start:start + size]
+
+
+DATASETS = {
+    "small_files": DatasetGenerator.small_files,
+    "huge_files": DatasetGenerator.huge_files,
+    "incompressible": DatasetGenerator.incompressible,
+    "sparse": DatasetGenerator.sparse,
+    "deep_tree": DatasetGenerator.deep_tree,
+}
+
+
+class Bench:
+    """
+    Throughput benchmark: generates synthetic datasets, measures every stage of the pipeline on its own (scan, tar,
+    index, zstd, age, tape) and then backup, test and restore end to end against the virtual tape. Results are
+    written as JSON, with --baseline the throughput is compared to an earlier run.
+    """
+
+    def __init__(self, config: BenchConfig):
+        self.config = config
+        self.password_file = os.path.abspath(config.password_file)
+        self.workdir = os.path.abspath(config.workdir)
+        self.tape_directory = os.path.join(self.workdir, "tape")
+        self.tape = VIRTUAL_PREFIX + self.tape_directory
+        self.scratch = os.path.join(self.workdir, "scratch")
+        self.meter = StageMeter(self.tape_directory)
+        self.generator = DatasetGenerator(config.seed, config.scale)
+
+    def do(self):
+        baseline = None
+        if self.config.baseline is not None:
+            with open(self.config.baseline, "r") as f:
+                baseline = json.load(f)
+
+        results = self.run()
+
+        output = self.config.output
+        with open(output + ".tmp", "w") as f:
+            json.dump(results, f, indent=2)
+        os.replace(output + ".tmp", output)
+        logging.info(f"Results written to {output}")
+
+        self.print_results(results, baseline)
+
+    def run(self) -> dict:
+        results = {
+            "result_version": RESULT_VERSION,
+            "version": _git_version(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "host": platform.node(),
+            "cpus": os.cpu_count(),
+            "python": platform.python_version(),
+            "scale": self.config.scale,
+            "seed": self.config.seed,
+            "tape_generation": self.config.tape_generation,
+            "zstd_level": self.config.zstd_level,
+            "backup_args": self.config.backup_args,
+            "datasets": dict(),
+        }
+
+        for name in self.config.datasets:
+            results["datasets"][name] = self.run_dataset(name)
+
+        return results
+
+    def run_dataset(self, name: str) -> dict:
+        source = self.prepare_dataset(name)
+        VirtualTape(self.tape_directory).init(self.config.tape_generation, 1)
+        shutil.rmtree(self.scratch, ignore_errors=True)
+        os.makedirs(self.scratch)
+
+        stages = dict()
+        try:
+            stages.update(self.run_stages(source))
+            if not self.config.stages_only:
+                stages.update(self.run_commands(name, source, stages["scan"]["bytes"], stages["scan"]["files"]))
+        finally:
+            shutil.rmtree(self.scratch, ignore_errors=True)
+            shutil.rmtree(self.tape_directory, ignore_errors=True)
+
+        return {
+            "files": stages["scan"]["files"],
+            "bytes": stages["scan"]["bytes"],
+            "stages": stages,
+        }
+
+    def prepare_dataset(self, name: str) -> str:
+        """
+        Datasets are kept in the workdir and reused as long as seed and scale match
+        """
+        source = os.path.join(self.workdir, "datasets", name)
+        marker_file = source + ".json"
+        marker = {"seed": self.config.seed, "scale": self.config.scale}
+
+        if os.path.exists(marker_file):
+            with open(marker_file, "r") as f:
+                if json.load(f) == marker:
+                    return source
+            os.remove(marker_file)
+        shutil.rmtree(source, ignore_errors=True)
+
+        logging.info(f"Generating dataset {name} (scale {self.config.scale})")
+        start = time.time()
+        self.generator.generate(name, source)
+        logging.info(f"Generated dataset {name} in %.0fs" % (time.time() - start))
+
+        with open(marker_file, "w") as f:
+            json.dump(marker, f)
+        return source
+
+    def run_stages(self, source: str) -> dict:
+        """
+        Every stage reads the output of the previous one from the scratch directory, the whole dataset is one tar.
+        """
+        ret = dict()
+        file_list = os.path.join(self.scratch, "file_list")
+        tar_file = os.path.join(self.scratch, "dataset.tar")
+        zstd_file = tar_file + ".zst"
+        age_file = zstd_file + ".age"
+
+        logging.info("Stage scan")
+        meter = self.meter.start()
+        scan = ParallelScanner(self.config.scan_workers, [], None).scan(source, file_list)
+        ret["scan"] = meter.stop(scan.bytes, scan.files)
+
+        logging.info("Stage tar")
+        meter = self.meter.start()
+        self._run([TAR, "cf", tar_file, "--null", "--no-recursion", f"--files-from={file_list}"])
+        ret["tar"] = meter.stop(os.path.getsize(tar_file), scan.files)
+
+        logging.info("Stage index")
+        meter = self.meter.start()
+        with open(tar_file, "rb") as f:
+            members = sum(1 for _ in TarIndexer().iter_members(f))
+        ret["index"] = meter.stop(os.path.getsize(tar_file), members)
+
+        logging.info("Stage zstd")
+        meter = self.meter.start()
+        self._run([ZSTD, *zstd_level_args(self.config.zstd_level), "-T0", "-q", "-f", tar_file, "-o", zstd_file])
+        ret["zstd"] = meter.stop(os.path.getsize(tar_file), scan.files)
+        os.remove(tar_file)
+
+        logging.info("Stage age")
+        meter = self.meter.start()
+        self._run([AGE, "-e", "-i", self.password_file, "-o", age_file, zstd_file])
+        ret["age"] = meter.stop(os.path.getsize(zstd_file), scan.files)
+        os.remove(zstd_file)
+
+        logging.info("Stage tape")
+        meter = self.meter.start()
+        with open(age_file, "rb") as f:
+            wait_for_device_process(start_device_process(self.tape, "write", stdin=f))
+        ret["tape"] = meter.stop(os.path.getsize(age_file), scan.files)
+        os.remove(age_file)
+
+        return {stage: asdict(result) for stage, result in ret.items()}
+
+    def run_commands(self, name: str, source: str, source_bytes: int, files: int) -> dict:
+        """
+        backup, test and restore with the cli into a repository of their own, like an operator would run them
+        """
+        ret = dict()
+        repository = f"bench-{name}-{os.getpid()}"
+        tempdir = os.path.join(self.scratch, "temp")
+        virtual_tape = VirtualTape(self.tape_directory)
+        common_args = ["--backup-repository", repository, "--password-file", self.password_file,
+                       "--tempdir", tempdir, "--tape", self.tape]
+
+        try:
+            virtual_tape.rewind()
+            meter = self.meter.start()
+            self._run_cli(name, ["backup", *common_args, "--source", source,
+                                 "--zstd-level", str(self.config.zstd_level), *shlex.split(self.config.backup_args)])
+            ret["backup"] = meter.stop(source_bytes, files)
+
+            virtual_tape.rewind()
+            meter = self.meter.start()
+            self._run_cli(name, ["test", *common_args, "--backup-name", "0",
+                                 "--dest", os.path.join(self.scratch, "test")])
+            ret["test"] = meter.stop(source_bytes, files)
+
+            virtual_tape.rewind()
+            meter = self.meter.start()
+            self._run_cli(name, ["restore", *common_args, "--backup-name", "0",
+                                 "--dest", os.path.join(self.scratch, "restore")])
+            ret["restore"] = meter.stop(source_bytes, files)
+        finally:
+            shutil.rmtree(os.path.join(REPO_ROOT, DB_ROOT, repository), ignore_errors=True)
+
+        return {stage: asdict(result) for stage, result in ret.items()}
+
+    def print_results(self, results: dict, baseline: dict = None):
+        table = Table(title=f"Bench {results['version']}, scale {results['scale']}")
+        table.add_column("Dataset")
+        table.add_column("Stage")
+        table.add_column("MB/s", justify="right")
+        table.add_column("files/s", justify="right")
+        table.add_column("CPU s", justify="right")
+        table.add_column("Scratch MB", justify="right")
+        if baseline is not None:
+            table.add_column(f"vs {baseline['version']}", justify="right")
+
+        for name, dataset in results["datasets"].items():
+            for stage in STAGES:
+                if stage not in dataset["stages"]:
+                    continue
+
+                result = dataset["stages"][stage]
+                row = [
+                    name, stage, "%.1f" % result["mb_per_s"], "%.0f" % result["files_per_s"],
+                    "%.1f" % result["cpu_seconds"],
+                    "%.0f" % (result["scratch_bytes"] / 1000 / 1000) if result["scratch_bytes"] >= 0 else "-"
+                ]
+                if baseline is not None:
+                    row.append(self.compare(name, stage, result, baseline))
+                table.add_row(*row)
+
+        Console().print(table)
+
+    def compare(self, name: str, stage: str, result: dict, baseline: dict) -> str:
+        before = baseline.get("datasets", dict()).get(name, dict()).get("stages", dict()).get(stage)
+        rate = "mb_per_s" if result["bytes"] > 0 else "files_per_s"
+        if before is None or before[rate] <= 0:
+            return "-"
+
+        change = result[rate] / before[rate] - 1
+        if change < -self.config.regression_threshold / 100:
+            logging.warning(f"Regression in {name}/{stage}: %+.0f%% throughput" % (change * 100))
+            return "[red]%+.0f%%[/red]" % (change * 100)
+        return "%+.0f%%" % (change * 100)
+
+    def _run(self, cmd: [str]):
+        process = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            raise OSError(process.stderr)
+
+    def _run_cli(self, name: str, args: [str]):
+        log_file = os.path.join(self.workdir, f"{name}_{args[0]}.log")
+        logging.info(f"Stage {args[0]}, output in {log_file}")
+        with open(log_file, "w") as log:
+            # archive_finalizer.py is called relative to the repository root
+            process = subprocess.run(
+                [sys.executable, CLI, *args], cwd=REPO_ROOT, stdin=subprocess.DEVNULL, stdout=log,
+                stderr=subprocess.STDOUT
+            )
+        if process.returncode != 0:
+            raise OSError(f"{args[0]} failed, see {log_file}")
+
+
+def _cpu_seconds() -> float:
+    ret = 0.0
+    for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]:
+        usage = resource.getrusage(who)
+        ret += usage.ru_utime + usage.ru_stime
+    return ret
+
+
+def _written_bytes() -> int:
+    """
+    Bytes this process and its waited for children caused to be written to disk, -1 without /proc
+    """
+    try:
+        with open("/proc/self/io", "r") as f:
+            for line in f:
+                if line.startswith("write_bytes:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return -1
+
+
+def _directory_bytes(directory: str) -> int:
+    ret = 0
+    for root, _, files in os.walk(directory):
+        for file in files:
+            ret += os.path.getsize(os.path.join(root, file))
+    return ret
+
+
+def _git_version() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"], cwd=REPO_ROOT, stderr=subprocess.DEVNULL
+        ).decode("UTF-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
@@ -0,0 +1,61 @@
+import datetime
+
+from rich.console import Console
+from rich.table import Table
+
+from common import file_size_format
+from config import FindConfig
+from database import BackupDatabaseRepository, DB_ROOT
+
+MATCH_TYPES = ["exact", "prefix", "glob", "substring"]
+
+
+class Find:
+    """
+    Searches the files of all backups of the repository in the find index and shows every version with the tape and
+    volume it is on, e.g. to choose what to restore
+    """
+
+    def __init__(self, config: FindConfig):
+        self.config = config
+        self.repository = BackupDatabaseRepository(DB_ROOT, self.config.backup_repository)
+
+    def do(self):
+        match = self.config.match
+        if match is None:
+            match = "glob" if any(c in self.config.pattern for c in "*?[") else "exact"
+
+        index = self.repository.find_index()
+        limit = self.config.limit
+        found = index.find(self.config.pattern, match, limit + 1 if limit > 0 else 0)
+
+        table = Table(title=f"Files matching {self.config.pattern} ({match})")
+        table.add_column("Path", overflow="fold")
+        table.add_column("Backup", no_wrap=True)
+        table.add_column("Size", justify="right")
+        table.add_column("Modified", no_wrap=True)
+        table.add_column("Tape Serial", no_wrap=True)
+        table.add_column("Tape File", justify="right")
+        table.add_column("Volume", justify="right")
+
+        for f in found[:limit] if limit > 0 else found:
+            table.add_row(
+                f.path + "/" if f.type == "5" else f.path,
+                f.backup_name,
+                file_size_format(f.size) if f.type != "5" else "-",
+                datetime.datetime.fromtimestamp(f.mtime).strftime("%Y-%m-%d %H:%M"),
+                f.tape_volume_serial or "-",
+                str(f.tape_file_number) if f.tape_file_number is not None and f.tape_file_number >= 0 else "-",
+                str(f.volume_no)
+            )
+
+        console = Console()
+        console.print(table)
+        if 0 < limit < len(found):
+            console.print(f"Only the first {limit} versions are shown (--limit).")
+
+        missing = set(self.repository.list_backups()) - set(index.backup_names())
+        if missing:
+            console.print(
+                f"[yellow]{len(missing)} backups are not in the find index, rebuild-index adds them.[/yellow]"
+            )
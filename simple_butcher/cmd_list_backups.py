@@ -1,6 +1,8 @@
+import datetime
+
 from common import file_size_format
 from config import ListBackupConfig
-from database import BackupRecord, BackupDatabase, BackupDatabaseRepository, DB_ROOT
+from database import BackupRecord, BackupDatabase, BackupDatabaseRepository, DB_ROOT, BackupInfo
 
 from rich.console import Console
 from rich.table import Table
@@ -22,14 +24,18 @@ class ListBackups:
         table.add_column("Description")
         table.add_column("Tape Serials")
 
-        no = 0
-        all_backups = self.repository.list_backups()
-        for backup_dir in all_backups:
-            bi = self.repository.read_backup_info(backup_dir)
+        all_backups = self.repository.read_backup_index()
+        backups = [(no, name, bi) for no, (name, bi) in enumerate(all_backups) if self.matches(bi)]
+        shown = backups[self.config.offset:]
+        if self.config.limit > 0:
+            shown = shown[:self.config.limit]
 
+        for no, backup_dir, bi in shown:
             hours = "%.02fh" % ((bi.time_end - bi.time_start) / 60.0 / 60.0)
 
             reference_backup = "Full" if bi.incremental_time is None else f"Inc - {bi.incremental_time} days"
+            if bi.incremental_mode is not None:
+                reference_backup = f"Inc - {bi.incremental_mode}"
             # if bi.base_backup is not None:
             #     reference_backup = f"{bi.base_backup} ({self._find_no(all_backups, bi.base_backup)})"
 
@@ -47,10 +53,33 @@ class ListBackups:
                 bi.description,
                 tape_serials
             )
-            no += 1
 
         console = Console()
         console.print(table)
+        if len(shown) < len(all_backups):
+            console.print(
+                f"Showing {len(shown)} of {len(backups)} matching backups ({len(all_backups)} in the repository)."
+            )
+
+    def matches(self, bi: BackupInfo) -> bool:
+        """
+        Filters of the config, the numbers in the No column stay those of the unfiltered list (for --backup-name)
+        """
+        day = datetime.date.fromtimestamp(bi.time_start)
+        if self.config.since is not None and day < datetime.date.fromisoformat(self.config.since):
+            return False
+        if self.config.until is not None and day > datetime.date.fromisoformat(self.config.until):
+            return False
+
+        incremental = bi.incremental_time is not None or bi.incremental_mode is not None
+        if self.config.backup_type == "full" and incremental:
+            return False
+        if self.config.backup_type == "incremental" and not incremental:
+            return False
+
+        if self.config.tape_serial is not None and self.config.tape_serial not in (bi.tape_serials or []):
+            return False
+        return True
 
     def _find_no(self, all_backups, needle):
         if needle is None:
@@ -1,8 +1,10 @@
-import json
+import functools
+import os
 
 from common import file_size_format
 from config import ListFilesConfig
 from database import BackupRecord, BackupDatabase, BackupDatabaseRepository, DB_ROOT
+from tarindex import parse_tar_line
 
 from rich.console import Console
 from rich.table import Table
@@ -14,14 +16,47 @@ class ListFiles:
         self.repository = BackupDatabaseRepository(DB_ROOT, self.config.backup_repository)
 
     def do(self):
-        backup_info, backup_database = self.repository.open_backup(self.config.backup_name)
+        if self.config.all_backups:
+            self.list_all_backups()
+            return
 
-        with open(backup_database.database_file(), "r") as f:
-            line = f.readline()
-            while line:
-                record = BackupRecord.from_json(json.loads(line))
+        backup_info, backup_database = self.repository.open_backup(self.config.backup_name)
 
-                print(record.tar_line)
-                line = f.readline()
+        for record in _matching_records(backup_database, self.config.path):
+            print(record.tar_line)
 
         backup_database.close()
+
+    def list_all_backups(self):
+        if self.config.path is None:
+            raise ValueError("--all-backups needs --path")
+
+        scan = functools.partial(_matching_lines, path=self.config.path)
+        results = self.repository.scan_backups(self.repository.list_backups(), scan, self.config.workers or None)
+        for backup_name, lines in results:
+            for line in lines:
+                print(f"{backup_name} {line}")
+
+
+def _matching_records(backup_database: BackupDatabase, path: str):
+    if path is not None and os.path.exists(backup_database.catalog_file()):
+        return backup_database.catalog().lookup(path)
+
+    return (record for record in backup_database.read_records() if path is None or _below(record, path))
+
+
+def _matching_lines(backup_database: BackupDatabase, path: str) -> [str]:
+    """
+    Runs in the worker processes of BackupDatabaseRepository.scan_backups, only the matches travel back
+    """
+    return [record.tar_line for record in _matching_records(backup_database, path)]
+
+
+def _below(record: BackupRecord, path: str) -> bool:
+    """
+    Filter for catalogs without path index
+    """
+    member = parse_tar_line(record.tar_line)
+    name = member.name.rstrip("/") if member is not None else record.tar_line
+    path = path.lstrip("/").rstrip("/")
+    return name == path or name.startswith(path + "/")
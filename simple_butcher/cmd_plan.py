@@ -0,0 +1,230 @@
+import logging
+import os
+import random
+import subprocess
+import threading
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+
+from rich.console import Console
+from rich.table import Table
+
+from common import file_size_format
+from compression_zstdage_v2 import zstd_level_args
+from config import PlanConfig
+from database import BackupDatabase, BackupDatabaseRepository, DB_ROOT
+from exe_paths import ZSTD
+from filesystem import ParallelScanner
+from tapeinfowrapper import TapeinfoWrapper
+
+TAR_HEADER_BYTES = 1024  # header and (average) padding per file
+DEFAULT_TAPE_SPEED = 160 * 1000 * 1000  # LTO-6, if there is no backup history
+SAMPLE_BLOCK_SIZE = 1024 * 1024
+
+
+@dataclass
+class PlanEstimate:
+    files: int
+    directories: int
+    source_bytes: int
+    sampled_bytes: int
+    compression_ratio: float
+    compressed_bytes: int
+    compressor_rate: float  # bytes/s of source data
+    tape_rate: float  # bytes/s written to tape
+    first_tape_bytes: int  # usable on the loaded tape
+    tape_bytes: int  # usable on every further tape
+    tapes: int
+    duration: float  # seconds
+
+
+class Plan:
+    """
+    Estimates a backup run before it starts: scans the source, compresses a size weighted random sample of it at the
+    configured zstd level and derives the number of tapes and the duration from the tape capacity and the compressor
+    and tape rates.
+    """
+
+    def __init__(self, config: PlanConfig):
+        self.config = config
+        self.tapeinfo = TapeinfoWrapper(config)
+        self.repository = BackupDatabaseRepository(DB_ROOT, config.backup_repository)
+
+    def do(self):
+        estimate = self.estimate()
+        self.print_estimate(estimate)
+
+    def estimate(self) -> PlanEstimate:
+        os.makedirs(self.config.tempdir, exist_ok=True)
+        file_list = self.config.tempdir + "/plan_file_list"
+
+        logging.info(f"Scanning {self.config.source}")
+        modified_after = None
+        if self.config.incremental_time is not None:
+            modified_after = time.time() - self.config.incremental_time * 24 * 60 * 60
+        excludes = [exclude[0] for exclude in self.config.excludes] if self.config.excludes else []
+        scan = ParallelScanner(self.config.scan_workers, excludes, modified_after).scan(self.config.source, file_list)
+
+        sample = self.sample_files(file_list)
+        os.remove(file_list)
+
+        logging.info(f"Compressing a sample of {len(sample)} files with zstd {self.config.zstd_level}")
+        sampled_bytes, compressed_sample_bytes, duration = self.compress_sample(sample)
+
+        ratio = compressed_sample_bytes / sampled_bytes if sampled_bytes > 0 else 1.0
+        tar_bytes = scan.bytes + (scan.files + scan.directories) * TAR_HEADER_BYTES
+        compressed_bytes = int(tar_bytes * ratio)
+        compressor_rate = sampled_bytes / duration if duration > 0 else 0
+
+        first_tape_bytes, tape_bytes = self.tape_capacity()
+        tapes = 1
+        if compressed_bytes > first_tape_bytes:
+            tapes += -(-(compressed_bytes - first_tape_bytes) // tape_bytes)  # ceil
+
+        tape_rate = self.tape_rate()
+        duration = compressed_bytes / tape_rate
+        if compressor_rate > 0:
+            duration = max(duration, tar_bytes / compressor_rate)
+
+        return PlanEstimate(
+            files=scan.files,
+            directories=scan.directories,
+            source_bytes=scan.bytes,
+            sampled_bytes=sampled_bytes,
+            compression_ratio=ratio,
+            compressed_bytes=compressed_bytes,
+            compressor_rate=compressor_rate,
+            tape_rate=tape_rate,
+            first_tape_bytes=first_tape_bytes,
+            tape_bytes=tape_bytes,
+            tapes=tapes,
+            duration=duration,
+        )
+
+    def sample_files(self, file_list: str) -> [(bytes, int)]:
+        """
+        Uniform random sample (reservoir) of the scanned files with their sizes, the list is read only once.
+        """
+        reservoir = []
+        seen = 0
+        with open(file_list, "rb") as f:
+            rest = b""
+            for data in iter(lambda: f.read(1024 * 1024), b""):
+                *paths, rest = (rest + data).split(b"\0")
+                for path in paths:
+                    seen += 1
+                    if len(reservoir) < self.config.sample_files:
+                        reservoir.append(path)
+                    else:
+                        i = random.randrange(seen)
+                        if i < self.config.sample_files:
+                            reservoir[i] = path
+
+        ret = []
+        for path in reservoir:
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if st.st_size > 0 and not os.path.islink(path) and os.path.isfile(path):
+                ret.append((path, st.st_size))
+        return ret
+
+    def compress_sample(self, sample: [(bytes, int)]) -> (int, int, float):
+        """
+        Every file contributes blocks from random offsets in proportion to its size, so the ratio of the whole stream
+        is weighted like the source.
+
+        :return: sampled bytes, compressed bytes, seconds
+        """
+        sample_budget = self.config.sample_size * 1024 * 1024
+        total_size = sum(size for _, size in sample)
+        if total_size == 0:
+            return 0, 0, 0
+
+        zstd = subprocess.Popen(
+            [ZSTD, *zstd_level_args(self.config.zstd_level), "-T0", "-c"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+
+        sampled = [0]
+
+        def feed():
+            try:
+                for path, size in sample:
+                    share = min(size, max(SAMPLE_BLOCK_SIZE, sample_budget * size // total_size))
+                    with open(path, "rb") as f:
+                        while share > 0:
+                            block = min(share, SAMPLE_BLOCK_SIZE)
+                            f.seek(random.randrange(max(1, size - block + 1)))
+                            data = f.read(block)
+                            if not data:
+                                break
+                            zstd.stdin.write(data)
+                            sampled[0] += len(data)
+                            share -= block
+            except OSError as e:
+                logging.warning(f"Sampling stopped: {e}")
+            finally:
+                zstd.stdin.close()
+
+        start = time.time()
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+
+        compressed = 0
+        for data in iter(lambda: zstd.stdout.read(1024 * 1024), b""):
+            compressed += len(data)
+        feeder.join()
+        if zstd.wait() != 0:
+            raise OSError("zstd failed while compressing the sample")
+
+        return sampled[0], compressed, time.time() - start
+
+    def tape_capacity(self) -> (int, int):
+        reserve = self.config.tape_buffer * 1024 * 1024 * 1024
+        size = self.tapeinfo.size_statistics()
+
+        maximum_bytes = size.maximum_bytes
+        if maximum_bytes <= 0:  # no tape or dummy
+            maximum_bytes = self.config.tape_capacity * 1000 * 1000 * 1000
+        remaining_bytes = size.remaining_bytes if size.remaining_bytes >= 0 else maximum_bytes
+
+        return max(0, remaining_bytes - reserve), max(1, maximum_bytes - reserve)
+
+    def tape_rate(self) -> float:
+        """
+        Configured tape speed or the average write rate of the last backup of the repository
+        """
+        if self.config.tape_speed > 0:
+            return self.config.tape_speed * 1000 * 1000
+
+        if os.path.exists(self.repository.backup_repository_dir()):
+            for backup_name in self.repository.list_backups():
+                database = BackupDatabase(DB_ROOT, self.config.backup_repository, backup_name)
+                rates = [v.write_rate for v in database.read_volumes() if v.write_rate > 0]
+                if rates:
+                    return sum(rates) / len(rates)
+
+        return DEFAULT_TAPE_SPEED
+
+    def print_estimate(self, estimate: PlanEstimate):
+        table = Table(title=f"Plan for {self.config.source}")
+        table.add_column("")
+        table.add_column("Estimate", no_wrap=True)
+
+        table.add_row("Source", f"{estimate.files} files, {estimate.directories} directories, "
+                                f"{file_size_format(estimate.source_bytes)}")
+        table.add_row("Sample", file_size_format(estimate.sampled_bytes))
+        table.add_row("Compression ratio", "%.2f" % estimate.compression_ratio)
+        table.add_row("Compressed size", file_size_format(estimate.compressed_bytes))
+        table.add_row("Usable on loaded tape", file_size_format(estimate.first_tape_bytes))
+        table.add_row("Usable per tape", file_size_format(estimate.tape_bytes))
+        table.add_row("Tapes", str(estimate.tapes))
+        table.add_row("Compressor rate", file_size_format(estimate.compressor_rate) + "/s")
+        table.add_row("Tape rate", file_size_format(estimate.tape_rate) + "/s")
+        table.add_row("Duration", str(timedelta(seconds=int(estimate.duration))) + " (without tape changes)")
+
+        console = Console()
+        console.print(table)
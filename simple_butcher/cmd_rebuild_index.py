@@ -0,0 +1,22 @@
+import logging
+
+from config import RebuildIndexConfig
+from database import BackupDatabaseRepository, DB_ROOT
+
+
+class RebuildIndex:
+    """
+    Writes the backup index and the find index of the repository again from the backups, for repositories from before
+    the indexes or after backups were deleted or copied in by hand
+    """
+
+    def __init__(self, config: RebuildIndexConfig):
+        self.config = config
+        self.repository = BackupDatabaseRepository(DB_ROOT, self.config.backup_repository)
+
+    def do(self):
+        backups = self.repository.rebuild_backup_index()
+        logging.info(f"Indexed {backups} backups in {self.repository.backup_index_file()}")
+
+        backups = self.repository.rebuild_find_index()
+        logging.info(f"Indexed the files of {backups} backups in {self.repository.find_index_file()}")
@@ -1,27 +1,28 @@
+import fnmatch
 import os
 import logging
 import shutil
 import time
-import json
 
 from config import RestoreConfig
 from common import ArchiveVolumeNumber, compression_info, file_size_format, report_performance
-from myzmq import SimpleMq
+from myzmq import SocketMq
 from tarwrapper import TarWrapper
 from sha256wrapper import Sha256Wrapper
 from decompression_zstdage_v2 import DecompressionZstdAgeV2
 from tapeinfowrapper import TapeinfoWrapper
 from database import BackupRecord, BackupDatabase, BackupDatabaseRepository, DB_ROOT, BackupInfo, \
-    INCREMENTAL_INDEX_FILENAME
+    INCREMENTAL_INDEX_FILENAME, ManifestVolume
 from mbufferwrapper import MBufferWrapper
 from mtstwrapper import MTSTWrapper
 from progressbar import ProgressDisplay, ByteTask
+from tarindex import NO_DATA_TYPES, TarMember, parse_tar_line
 
 
 class Restore:
     def __init__(self, config: RestoreConfig):
         self.config = config
-        self.com = SimpleMq(config.tempdir + "/tar_archive_done")
+        self.com = SocketMq(config.tempdir + "/tar_archive_done")
         self.com.cleanup()
         self.tar_output_file = None
         self.pd = ProgressDisplay()
@@ -34,25 +35,35 @@ class Restore:
         self.database = None
 
     def do(self):
+        if self.config.includes:
+            self.restore_selected()
+            return
+
         backup_info, database = self.load_database()
 
         # --> advise user to load correct tape
         # --> fast forward to correct position on tape
         # self.mtst.move_to_file(backup_info.first_volume_no)
 
-        tape_vol_map, max_volumes = self.count_volumes(backup_info, database)
-        logging.info(f"Restoring {max_volumes} volumes from {len(tape_vol_map.keys())} tapes.")
+        volumes = {v.volume_no: v for v in database.read_manifest()}
+        max_volumes = max(volumes.keys(), default=0)
+        logging.info(f"Restoring {len(volumes)} volumes from {len({v.tape_no for v in volumes.values()})} tapes.")
         archive_volume_no = ArchiveVolumeNumber(0, 0, 0, 0)
         tar_thread = None
         tar_input_file = self.config.tempdir + "/tar_file"
         while archive_volume_no.volume_no <= max_volumes:
-            output_file = self.decompression_v2.do(self.config, archive_volume_no)
+            tape_parts = volumes[archive_volume_no.volume_no].tape_parts() \
+                if archive_volume_no.volume_no in volumes else 1
+            output_file = self.decompression_v2.do(
+                self.config, archive_volume_no, tape_parts, lambda: self.change_tape_within_volume(archive_volume_no)
+            )
             archive_volume_no.incr_volume_no()
             logging.info(f"Archive {archive_volume_no.volume_no} loaded from Tape.")
 
             shutil.move(output_file, tar_input_file)
 
-            if tar_thread is None:
+            if tar_thread is None or not tar_thread.is_alive():
+                # first volume, or the previous tar run is done and a new archive set starts
                 tar_thread = self.tar.restore_full(self.config, self.com.communication_file, tar_input_file)
             else:
                 logging.info("Signaling tar to continue...")
@@ -63,41 +74,191 @@ class Restore:
                 if self.com.wait_for_signal():
                     break
 
-            if self.should_change_tape(archive_volume_no, tape_vol_map):
+            if self.should_change_tape(archive_volume_no, volumes):
                 input("Change tape!")
                 archive_volume_no.incr_tape_no()
 
         logging.info("Restoration done.")
         database.close()
+        self.com.close()
+
+    def restore_selected(self):
+        """
+        Reads only the volumes with members matching config.includes, and the volumes files continue in, positions the
+        tape on each and extracts only the matching members
+        """
+        backup_info, database = self.load_database()
+        volumes = {v.volume_no: v for v in database.read_manifest()}
+
+        selected = self.select_members(database)
+        if not selected:
+            logging.warning(f"Nothing in the backup matches {', '.join(self.config.includes)}.")
+            database.close()
+            self.com.close()
+            return
+
+        volume_nos = self.add_continuations(selected, volumes, database.last_members())
+        runs = _consecutive_runs(volume_nos, volumes)
+        logging.info(
+            f"Restoring {sum(len(members) for members in selected.values())} members from {len(volume_nos)} of "
+            f"{len(volumes)} volumes on {len({volumes[v].tape_no for v in volume_nos})} tapes."
+        )
+
+        archive_volume_no = ArchiveVolumeNumber(0, 0, 0, 0)
+        for run in runs:
+            members = [member for v in run for member in selected.get(v, dict()).values()]
+            self.restore_run(run, members, volumes, archive_volume_no)
+            self.check_restored(members)
+
+        logging.info("Restoration done.")
+        database.close()
+        self.com.close()
+
+    def select_members(self, database: BackupDatabase) -> dict:
+        """
+        volume_no -> {name: TarMember} of the members matching config.includes, by the volume they start in
+        """
+        selected = dict()
+        for record in _matching_records(database, self.config.includes):
+            member = parse_tar_line(record.tar_line)
+            if member is not None and member.type not in ("M", "V"):
+                selected.setdefault(record.volume_no, dict())[member.name] = member
+        return selected
+
+    def add_continuations(self, selected: dict, volumes: dict, last_members: dict) -> [int]:
+        """
+        The selected volumes and the volumes their files continue in: only the last member of a volume can be split
+        by tar -M, it continues in the following volumes of the same archive set until one has a member of its own
+        """
+        volume_nos = set(selected.keys())
+        for volume_no, members in selected.items():
+            last = members.get(last_members.get(volume_no))
+            if last is None or last.type in NO_DATA_TYPES:
+                continue
+
+            next_no = volume_no + 1
+            while next_no in volumes and volumes[next_no].archive_set == volumes[volume_no].archive_set:
+                volume_nos.add(next_no)
+                if last_members.get(next_no, last.name) != last.name:
+                    break
+                next_no += 1
+
+        return sorted(volume_nos)
+
+    def restore_run(
+            self, run: [int], members: [TarMember], volumes: dict, archive_volume_no: ArchiveVolumeNumber
+    ):
+        """
+        One tar process for consecutive volumes, stopped when it asks for the volume after the last one
+        """
+        members_file = self.config.tempdir + "/tar_members"
+        with open(members_file, "w") as f:
+            for member in members:
+                f.write((member.name.rstrip("/") or member.name) + "\0")
+
+        tar_input_file = self.config.tempdir + "/tar_file"
+        tar_process = None
+        for volume_no in run:
+            volume = volumes[volume_no]
+            self.load_volume(volume, archive_volume_no)
+            output_file = self.decompression_v2.do(
+                self.config, archive_volume_no, volume.tape_parts(),
+                lambda: self.change_tape_within_volume(archive_volume_no)
+            )
+            logging.info(f"Archive {volume_no} loaded from Tape.")
+
+            shutil.move(output_file, tar_input_file)
+
+            if tar_process is None or tar_process.poll() is not None:
+                tar_process = self.tar.restore_members(
+                    self.config, self.com.communication_file, tar_input_file, members_file
+                )
+            else:
+                logging.info("Signaling tar to continue...")
+                self.com.signal_tar_to_continue()
+
+            logging.info("Waiting for tar to finish...")
+            while tar_process.poll() is None:
+                if self.com.wait_for_signal():
+                    break
+
+        if tar_process.poll() is None:
+            self.com.reject()  # the next volume isn't selected
+        tar_process.wait()
+        if tar_process.returncode != 0:
+            logging.info(f"tar stopped with {tar_process.returncode} after volume {run[-1]}, checking the files...")
 
-    def should_change_tape(self, archive_volume_no: ArchiveVolumeNumber, tape_vol_map: dict) -> bool:
-        vol_no = archive_volume_no.volume_no
-        for tn in tape_vol_map:
-            vols = tape_vol_map[tn]
-            if vol_no in vols and archive_volume_no.tape_no != tn:
-                return True
-        return False
+    def load_volume(self, volume: ManifestVolume, archive_volume_no: ArchiveVolumeNumber):
+        if volume.tape_no != archive_volume_no.tape_no:
+            input(f"Volume {volume.volume_no} is on tape {volume.tape_serial or volume.tape_no}. Change tape!")
+            archive_volume_no.tape_no = volume.tape_no
+        archive_volume_no.volume_no = volume.volume_no
+
+        if volume.tape_file_number is not None and volume.tape_file_number >= 0:
+            self.mtst.skip_to_file(volume.tape_file_number)
+
+    def check_restored(self, members: [TarMember]):
+        missing = []
+        for member in members:
+            path = os.path.join(self.config.dest, member.name)
+            if not os.path.lexists(path):
+                missing.append(member.name)
+            elif member.type == "0" and os.path.getsize(path) != member.size:
+                missing.append(f"{member.name} ({os.path.getsize(path)} of {member.size} bytes)")
+
+        if missing:
+            raise OSError(f"{len(missing)} members weren't restored: {', '.join(missing[:10])}")
+
+    def change_tape_within_volume(self, archive_volume_no: ArchiveVolumeNumber):
+        input(f"Volume {archive_volume_no.volume_no} continues on the next tape. Change tape!")
+        archive_volume_no.incr_tape_no()
+
+    def should_change_tape(self, archive_volume_no: ArchiveVolumeNumber, volumes: dict) -> bool:
+        volume = volumes.get(archive_volume_no.volume_no)
+        return volume is not None and volume.tape_no != archive_volume_no.tape_no
 
     def load_database(self) -> (BackupInfo, BackupDatabase):
         backup_repository = BackupDatabaseRepository(DB_ROOT, self.config.backup_repository)
         return backup_repository.open_backup(self.config.backup_name)
 
-    def count_volumes(self, backup_info: BackupInfo, database: BackupDatabase) -> (dict, int):
-        volume_map = dict()
-        max_volume_no = 0
-        with open(database.database_file(), "r") as f:
-            line = f.readline()
-            while line:
-                record = BackupRecord.from_json(json.loads(line))
-                tn, vn = record.tape_no, record.volume_no
 
-                if tn not in volume_map:
-                    volume_map[tn] = list()
+def _matching_records(database: BackupDatabase, includes: [str]):
+    """
+    Records of the paths (with everything below) or globs, through the path index if the backup has a catalog
+    """
+    if os.path.exists(database.catalog_file()):
+        catalog = database.catalog()
+        for include in includes:
+            yield from catalog.glob(include) if _is_glob(include) else catalog.lookup(include)
+        return
+
+    for record in database.read_records():
+        member = parse_tar_line(record.tar_line)
+        if member is not None and any(_include_matches(member.name, include) for include in includes):
+            yield record
+
+
+def _is_glob(include: str) -> bool:
+    return any(c in include for c in "*?[")
+
 
-                volume_map[tn].append(vn)
-                if vn > max_volume_no:
-                    max_volume_no = vn
+def _include_matches(name: str, include: str) -> bool:
+    name = name[2:] if name.startswith("./") else name
+    name, include = name.rstrip("/"), include.lstrip("/").rstrip("/")
+    if _is_glob(include):
+        return fnmatch.fnmatchcase(name, include)
+    return name == include or name.startswith(include + "/")
 
-                line = f.readline()
 
-        return volume_map, max_volume_no
+def _consecutive_runs(volume_nos: [int], volumes: dict) -> [[int]]:
+    """
+    Splits the sorted volume numbers where one is skipped or a new archive set (tar run) starts
+    """
+    runs = []
+    for volume_no in volume_nos:
+        if runs and runs[-1][-1] == volume_no - 1 and \
+                volumes[volume_no].archive_set == volumes[runs[-1][-1]].archive_set:
+            runs[-1].append(volume_no)
+        else:
+            runs.append([volume_no])
+    return runs
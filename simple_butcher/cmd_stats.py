@@ -0,0 +1,167 @@
+import statistics
+from dataclasses import dataclass, field
+
+from rich.console import Console
+from rich.table import Table
+
+from common import file_size_format
+from config import StatsConfig
+from database import BackupDatabase, BackupDatabaseRepository, DB_ROOT, VolumeInfo
+
+
+@dataclass
+class VolumeSummary:
+    volumes: int = 0
+    bytes_read: int = 0
+    bytes_written: int = 0
+    compression_duration: float = 0
+    tape_duration: float = 0
+    write_rate_min: float = -1
+    buffer_fill_min: int = -1
+    buffer_fill_avg_sum: float = 0
+    buffer_fill_volumes: int = 0
+    buffer_empty_events: int = -1  # -1 if no volume knows it
+    time_end: float = 0
+    rates: [float] = field(default_factory=list)  # tape write rate per volume
+
+    def add(self, volume: VolumeInfo):
+        self.volumes += 1
+        self.bytes_read += volume.bytes_read
+        self.bytes_written += volume.bytes_written
+        self.compression_duration += volume.compression_duration if volume.compression_duration >= 0 \
+            else volume.duration
+        self.tape_duration += volume.duration
+        self.time_end = max(self.time_end, volume.time_end)
+
+        if volume.write_rate > 0:
+            self.rates.append(volume.write_rate)
+            if self.write_rate_min < 0 or volume.write_rate < self.write_rate_min:
+                self.write_rate_min = volume.write_rate
+        if volume.buffer_fill_min >= 0:
+            if self.buffer_fill_min < 0 or volume.buffer_fill_min < self.buffer_fill_min:
+                self.buffer_fill_min = volume.buffer_fill_min
+            self.buffer_fill_avg_sum += volume.buffer_fill_avg
+            self.buffer_fill_volumes += 1
+        if volume.buffer_empty_events >= 0:
+            self.buffer_empty_events = max(0, self.buffer_empty_events) + volume.buffer_empty_events
+
+    def compression_ratio(self) -> float:
+        return self.bytes_written / self.bytes_read if self.bytes_read > 0 else -1
+
+    def compression_rate(self) -> float:
+        return self.bytes_read / self.compression_duration if self.compression_duration > 0 else -1
+
+    def write_rate(self) -> float:
+        return self.bytes_written / self.tape_duration if self.tape_duration > 0 else -1
+
+    def buffer_fill_avg(self) -> float:
+        return self.buffer_fill_avg_sum / self.buffer_fill_volumes if self.buffer_fill_volumes > 0 else -1
+
+
+class Stats:
+    """
+    Performance history of the last backups of a repository from the volumes they wrote: compression and tape rates,
+    mbuffer fill and underruns per backup, and the same per tape. A tape getting slower than the others or the
+    compression rate falling over time (scratch drive, CPU) shows up here before it breaks the backup window.
+    """
+
+    def __init__(self, config: StatsConfig):
+        self.config = config
+        self.repository = BackupDatabaseRepository(DB_ROOT, self.config.backup_repository)
+
+    def do(self):
+        backups = list(reversed(self.repository.list_backups()[:self.config.last]))  # oldest first, like a trend
+        summaries = dict()
+        tapes = dict()
+        for backup_name in backups:
+            summary = VolumeSummary()
+            for volume in BackupDatabase(DB_ROOT, self.config.backup_repository, backup_name).read_volumes():
+                summary.add(volume)
+                tapes.setdefault(volume.tape_serial or "-", VolumeSummary()).add(volume)
+            summaries[backup_name] = summary
+
+        all_rates = [rate for summary in summaries.values() for rate in summary.rates]
+        median_rate = statistics.median(all_rates) if all_rates else -1
+
+        self.print_backups(summaries, median_rate)
+        self.print_tapes(tapes, median_rate)
+
+    def print_backups(self, summaries: dict, median_rate: float):
+        table = Table(title=f"Performance of the last {len(summaries)} backups")
+        table.add_column("Name", no_wrap=True)
+        table.add_column("Volumes", justify="right")
+        table.add_column("Read", justify="right")
+        table.add_column("Written", justify="right")
+        table.add_column("Ratio", justify="right")
+        table.add_column("Compression", justify="right")
+        table.add_column("Tape", justify="right")
+        table.add_column("Tape min", justify="right")
+        table.add_column("Buffer min/avg", justify="right")
+        table.add_column("Underruns", justify="right")
+
+        for backup_name, summary in summaries.items():
+            table.add_row(
+                backup_name,
+                str(summary.volumes),
+                file_size_format(summary.bytes_read),
+                file_size_format(summary.bytes_written),
+                _format(summary.compression_ratio(), "%.2f"),
+                _format_rate(summary.compression_rate()),
+                self._format_tape_rate(summary.write_rate(), median_rate),
+                self._format_tape_rate(summary.write_rate_min, median_rate),
+                _format_buffer(summary),
+                _format(summary.buffer_empty_events, "%i"),
+            )
+
+        Console().print(table)
+
+    def print_tapes(self, tapes: dict, median_rate: float):
+        table = Table(title="Tapes")
+        table.add_column("Serial", no_wrap=True)
+        table.add_column("Volumes", justify="right")
+        table.add_column("Written", justify="right")
+        table.add_column("Tape", justify="right")
+        table.add_column("Tape min", justify="right")
+        table.add_column("Buffer min/avg", justify="right")
+        table.add_column("Underruns", justify="right")
+
+        for serial, summary in sorted(tapes.items(), key=lambda t: t[1].time_end):
+            table.add_row(
+                serial,
+                str(summary.volumes),
+                file_size_format(summary.bytes_written),
+                self._format_tape_rate(summary.write_rate(), median_rate),
+                self._format_tape_rate(summary.write_rate_min, median_rate),
+                _format_buffer(summary),
+                _format(summary.buffer_empty_events, "%i"),
+            )
+
+        Console().print(table)
+        if median_rate > 0:
+            Console().print(
+                f"Median tape rate {file_size_format(median_rate)}/s, "
+                f"rates below {self.config.slow_threshold}% of it are red."
+            )
+
+    def _format_tape_rate(self, rate: float, median_rate: float) -> str:
+        if rate <= 0:
+            return "-"
+
+        ret = _format_rate(rate)
+        if median_rate > 0 and rate < median_rate * self.config.slow_threshold / 100:
+            return f"[red]{ret}[/red]"
+        return ret
+
+
+def _format(value, fmt: str) -> str:
+    return fmt % value if value >= 0 else "-"
+
+
+def _format_rate(rate: float) -> str:
+    return file_size_format(rate) + "/s" if rate > 0 else "-"
+
+
+def _format_buffer(summary: VolumeSummary) -> str:
+    if summary.buffer_fill_min < 0:
+        return "-"
+    return "%i%% / %.0f%%" % (summary.buffer_fill_min, summary.buffer_fill_avg())
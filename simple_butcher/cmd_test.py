@@ -3,17 +3,17 @@ import logging
 import shutil
 import subprocess
 import time
-import json
 
 from config import RestoreConfig
 from common import ArchiveVolumeNumber, compression_info, file_size_format, report_performance
-from myzmq import SimpleMq
+from myzmq import SocketMq
 from tarwrapper import TarWrapper
 from sha256wrapper import Sha256Wrapper
 from decompression_zstdage_v2 import DecompressionZstdAgeV2
 from tapeinfowrapper import TapeinfoWrapper
 from database import BackupRecord, BackupDatabase, BackupDatabaseRepository, DB_ROOT, BackupInfo, \
-    INCREMENTAL_INDEX_FILENAME
+    INCREMENTAL_INDEX_FILENAME, ManifestVolume
+from hashing import MultiHash, PUMP_BLOCK_SIZE
 from mbufferwrapper import MBufferWrapper
 from mtstwrapper import MTSTWrapper
 from progressbar import ProgressDisplay, ByteTask
@@ -28,7 +28,7 @@ class Test:
 
     def __init__(self, config: RestoreConfig):
         self.config = config
-        self.com = SimpleMq(config.tempdir + "/tar_archive_done")
+        self.com = SocketMq(config.tempdir + "/tar_archive_done")
         self.com.cleanup()
         self.tar_output_file = None
         self.pd = ProgressDisplay()
@@ -47,22 +47,23 @@ class Test:
         # --> fast forward to correct position on tape
         # self.mtst.move_to_file(backup_info.first_volume_no)
 
-        tape_vol_map, max_volumes = self.count_volumes(backup_info, database)
-        logging.info(f"Testing {max_volumes} volumes from {len(tape_vol_map.keys())} tapes.")
+        volumes = {v.volume_no: v for v in database.read_manifest()}
+        max_volumes = max(volumes.keys(), default=0)
+        logging.info(f"Testing {len(volumes)} volumes from {len({v.tape_no for v in volumes.values()})} tapes.")
         archive_volume_no = ArchiveVolumeNumber(0, 0, 0, 0)
         # tar_thread = None
         # tar_input_file = self.config.tempdir + "/tar_file"
         while archive_volume_no.volume_no <= max_volumes:
-            output_file = self.decompression_v2.do(self.config, archive_volume_no)
+            volume = volumes.get(archive_volume_no.volume_no)
+            tape_parts = volume.tape_parts() if volume is not None else 1
+            output_file = self.decompression_v2.do(
+                self.config, archive_volume_no, tape_parts, lambda: self.change_tape_within_volume(archive_volume_no)
+            )
             archive_volume_no.incr_volume_no()
             logging.info(f"Archive {archive_volume_no.volume_no} loaded from Tape.")
 
             # output_file is zstd
-            zstd_process = subprocess.Popen([ZSTD, "-t", output_file])
-            output_stdout, output_stderr = zstd_process.communicate()
-
-            if zstd_process.returncode != 0:
-                raise OSError(output_stderr)
+            self.test_archive(output_file, volume)
 
             os.remove(output_file)
 
@@ -79,41 +80,48 @@ class Test:
             #     if self.com.wait_for_signal():
             #         break
 
-            if self.should_change_tape(archive_volume_no, tape_vol_map):
+            if self.should_change_tape(archive_volume_no, volumes):
                 input("Change tape!")
                 archive_volume_no.incr_tape_no()
 
         logging.info("Restoration done.")
         database.close()
+        self.com.close()
 
-    def should_change_tape(self, archive_volume_no: ArchiveVolumeNumber, tape_vol_map: dict) -> bool:
-        vol_no = archive_volume_no.volume_no
-        for tn in tape_vol_map:
-            vols = tape_vol_map[tn]
-            if vol_no in vols and archive_volume_no.tape_no != tn:
-                return True
-        return False
+    def test_archive(self, output_file: str, volume: ManifestVolume):
+        """
+        zstd -t, or if the backup hashed the chunks (backup --hash) decompress and compare with the hashes
+        """
+        if volume is None or not volume.plain_hashes:
+            zstd_process = subprocess.Popen([ZSTD, "-t", output_file])
+            output_stdout, output_stderr = zstd_process.communicate()
+
+            if zstd_process.returncode != 0:
+                raise OSError(output_stderr)
+            return
+
+        hashes = MultiHash(volume.plain_hashes.keys())
+        zstd_process = subprocess.Popen([ZSTD, "-d", "-c", output_file], stdout=subprocess.PIPE)
+        for block in iter(lambda: zstd_process.stdout.read(PUMP_BLOCK_SIZE), b""):
+            hashes.update(block)
+        output_stdout, output_stderr = zstd_process.communicate()
+
+        if zstd_process.returncode != 0:
+            raise OSError(output_stderr)
+        if hashes.hexdigests() != volume.plain_hashes:
+            raise OSError(
+                f"Volume {volume.volume_no} doesn't match its hashes: {hashes.hexdigests()} != {volume.plain_hashes}"
+            )
+        logging.info(f"Volume {volume.volume_no} matches its {', '.join(volume.plain_hashes)} hash.")
+
+    def change_tape_within_volume(self, archive_volume_no: ArchiveVolumeNumber):
+        input(f"Volume {archive_volume_no.volume_no} continues on the next tape. Change tape!")
+        archive_volume_no.incr_tape_no()
+
+    def should_change_tape(self, archive_volume_no: ArchiveVolumeNumber, volumes: dict) -> bool:
+        volume = volumes.get(archive_volume_no.volume_no)
+        return volume is not None and volume.tape_no != archive_volume_no.tape_no
 
     def load_database(self) -> (BackupInfo, BackupDatabase):
         backup_repository = BackupDatabaseRepository(DB_ROOT, self.config.backup_repository)
         return backup_repository.open_backup(self.config.backup_name)
-
-    def count_volumes(self, backup_info: BackupInfo, database: BackupDatabase) -> (dict, int):
-        volume_map = dict()
-        max_volume_no = 0
-        with open(database.database_file(), "r") as f:
-            line = f.readline()
-            while line:
-                record = BackupRecord.from_json(json.loads(line))
-                tn, vn = record.tape_no, record.volume_no
-
-                if tn not in volume_map:
-                    volume_map[tn] = list()
-
-                volume_map[tn].append(vn)
-                if vn > max_volume_no:
-                    max_volume_no = vn
-
-                line = f.readline()
-
-        return volume_map, max_volume_no
@@ -1,8 +1,9 @@
 import logging
 import os
 import subprocess
+import threading
 import time
-import re
+from dataclasses import dataclass, field
 
 from base_wrapper import Wrapper
 from config import BackupConfig
@@ -14,6 +15,74 @@ from database import BackupRecord
 from exe_paths import ZSTD, AGE, TEE, MBUFFER, SHA256SUM, MD5SUM
 from compression import Compression
 from progressbar import ProgressDisplay, ByteTask
+from hashing import HashingPump, VolumeHashes
+from mbuffer_log import MBufferLogReader
+from metrics import PipelineMetrics
+from operator_prompt import MainThreadPrompt
+from tape_writer import TapeWriter, TapeWriterProcess
+from virtual_tape import is_virtual, start_device_process, wait_for_device_process
+
+# window log zstd uses for large inputs, by compression level (1..22)
+ZSTD_WINDOW_LOG = [19, 20, 21, 21, 21, 21, 22, 22, 22, 22, 22, 22, 22, 22, 22, 22, 23, 23, 23, 25, 26, 27]
+ZSTD_MAX_LEVEL = 19  # without --ultra
+
+
+@dataclass
+class PipelineStats:
+    volume_no: int
+    zstd_level: int
+    bytes_read: int = 0
+    bytes_written: int = 0
+    duration: float = 0
+    buffer_fill_min: int = -1
+    buffer_fill_avg: float = -1
+    buffer_fill_samples: int = 0
+    buffer_empty_events: int = 0  # drive underruns, the drive stops and repositions (shoe-shining)
+    compression_duration: float = -1  # -1: compression and tape writing were one pipeline (duration)
+    md5: str = None  # of the data written to tape
+    hashes: VolumeHashes = field(default_factory=VolumeHashes)  # with config.hashes / config.file_hash
+    _buffer_filled: bool = False
+    _buffer_empty: bool = False
+
+    def add_buffer_sample(self, buffer_percent: int):
+        if buffer_percent < 0:
+            return
+
+        # the buffer is empty before it fills the first time and after the input ended, only an empty buffer that
+        # fills up again is an underrun
+        if buffer_percent > 0:
+            if self._buffer_empty:
+                self.buffer_empty_events += 1
+            self._buffer_filled, self._buffer_empty = True, False
+        elif self._buffer_filled:
+            self._buffer_empty = True
+
+        if self.buffer_fill_samples == 0 or buffer_percent < self.buffer_fill_min:
+            self.buffer_fill_min = buffer_percent
+        self.buffer_fill_avg = (self.buffer_fill_avg * self.buffer_fill_samples + buffer_percent) \
+            / (self.buffer_fill_samples + 1)
+        self.buffer_fill_samples += 1
+
+    def add_tape_writer(self, writer: TapeWriter):
+        """
+        Takes the exact numbers of a finished TapeWriter instead of the samples
+        """
+        self.bytes_written = writer.bytes_written
+        self.md5 = writer.md5
+        self.buffer_fill_min = writer.buffer_fill_min
+        self.buffer_fill_avg = writer.buffer_fill_avg
+        self.buffer_fill_samples = writer.buffer_fill_samples
+        self.buffer_empty_events = writer.underruns
+        if writer.hashes:
+            self.hashes.archive = writer.hashes
+
+    def write_rate(self) -> float:
+        """
+        bytes/s that went to the tape
+        """
+        if self.duration <= 0:
+            return 0
+        return self.bytes_written / self.duration
 
 
 class ZstdAgeV2(Compression):
@@ -27,8 +96,20 @@ class ZstdAgeV2(Compression):
         self.all_bytes_read = 0
         self.all_bytes_written = 0
         self.pd = pd
-
-    def do(self, config: BackupConfig, archive_volume_no: ArchiveVolumeNumber, input_file: str) -> (str, str):
+        self._stream = None
+        self._lock = threading.Lock()
+        self.last_stats = None  # of the last pipeline that wrote to tape
+        self.autoload_opts = []  # mbuffer options to continue on the next tape at the end of the tape
+        self._device_process = None  # write end of a virtual tape
+        self.metrics = PipelineMetrics()
+        self.tape_writer = None  # with config.tape_writer == "native", created on first use
+        self.on_end_of_medium = None  # called by the native tape writer to continue on the next tape
+        self.prompt = MainThreadPrompt()  # answered while the main thread waits for the pipeline
+
+    def do(
+            self, config: BackupConfig, archive_volume_no: ArchiveVolumeNumber, input_file: str, zstd_level: int = None
+    ) -> (str, str):
+        zstd_level = config.zstd_level if zstd_level is None else zstd_level
         output_file = config.tempdir + "/%09i.tar.zst.age" % archive_volume_no.volume_no
 
         original_size = get_safe_file_size(input_file)
@@ -38,169 +119,344 @@ class ZstdAgeV2(Compression):
             os.remove(output_file)
 
         mbuffer_log = config.tempdir + "/mbuffer.log"
+        if os.path.exists(mbuffer_log):
+            os.remove(mbuffer_log)
         # ---
-        zstd_process = subprocess.Popen(
-            [ZSTD, f"-{config.zstd_level}", "-T0", input_file, "--stdout"], stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT
+        zstd_process, plain_pump = self._start_zstd(
+            config, [*zstd_level_args(zstd_level), "-T0"], input_file, stderr=subprocess.STDOUT
+        )
+        age_process = subprocess.Popen(
+            [AGE, "-e", "-i", config.password_file], stdin=zstd_process.stdout, stdout=subprocess.PIPE
+        )
+
+        output_process, archive_pump = self._start_output_process(config, age_process, output_file, mbuffer_log)
+
+        start_piping = time.time()
+        self.last_stats = PipelineStats(archive_volume_no.volume_no, zstd_level, bytes_read=original_size)
+
+        self._watch_output_process(
+            config, archive_volume_no.volume_no, output_process, output_file, mbuffer_log, original_size,
+            self.last_stats
+        )
+
+        output_stdout, output_stderr = output_process.communicate()
+
+        if output_process.returncode != 0:
+            raise OSError(output_stderr)
+        wait_for_device_process(self._device_process)
+        self._collect_hashes(self.last_stats.hashes, plain_pump, archive_pump)
+
+        # logging.info("C/E/xxx done with " + report_performance_bytes(start_piping, bytes_written))
+        self.all_bytes_written += self.last_stats.bytes_written
+        self.last_stats.duration = time.time() - start_piping
+
+        os.remove(input_file)
+
+        if self.last_stats.md5 is None:
+            return "None", "-"
+
+        return "md5sum", self.last_stats.md5.replace(" *-", "")
+
+    def start_streaming(
+            self, config: BackupConfig, archive_volume_no: ArchiveVolumeNumber, input_fifo: str, zstd_level: int = None
+    ):
+        """
+        Starts zstd | age | mbuffer reading the volume tar writes into the fifo, no chunk is written to the tempdir.
+        The pipeline ends when tar closes the volume, finish_streaming() collects the result.
+        """
+        output_file = config.tempdir + "/%09i.tar.zst.age" % archive_volume_no.volume_no
+        mbuffer_log = config.tempdir + "/mbuffer.log"
+
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        if os.path.exists(mbuffer_log):
+            os.remove(mbuffer_log)
+
+        zstd_level = config.zstd_level if zstd_level is None else zstd_level
+        zstd_process, plain_pump = self._start_zstd(
+            config, [*zstd_level_args(zstd_level), "-T0"], input_fifo, stderr=subprocess.PIPE
         )
         age_process = subprocess.Popen(
             [AGE, "-e", "-i", config.password_file], stdin=zstd_process.stdout, stdout=subprocess.PIPE
         )
+        zstd_process.stdout.close()
+        output_process, archive_pump = self._start_output_process(config, age_process, output_file, mbuffer_log)
+        if archive_pump is None and not isinstance(output_process, TapeWriterProcess):
+            age_process.stdout.close()  # unless the pump or the native tape writer read it in this process
+
+        stats = PipelineStats(archive_volume_no.volume_no, zstd_level)
+        watch_thread = threading.Thread(
+            target=self._watch_output_process,
+            args=(
+                config, archive_volume_no.volume_no, output_process, output_file, mbuffer_log,
+                config.chunk_size * 1024 * 1024 * 1024, stats
+            )
+        )
+        watch_thread.start()
+
+        self._stream = (
+            zstd_process, output_process, watch_thread, output_file, mbuffer_log, stats, time.time(), plain_pump,
+            archive_pump
+        )
+
+    def finish_streaming(self, config: BackupConfig, bytes_read: int) -> (str, str):
+        """
+        Waits until the current streaming pipeline has written everything to tape.
+        :param bytes_read: size of the tar volume that went through the pipeline
+        """
+        zstd_process, output_process, watch_thread, output_file, mbuffer_log, stats, start_piping, plain_pump, \
+            archive_pump = self._stream
+        self._stream = None
+
+        while watch_thread.is_alive():  # a tape change during the volume is asked for on the main thread
+            self.prompt.serve()
+            watch_thread.join(timeout=0.1)
+        _, zstd_stderr = zstd_process.communicate()
+        output_stdout, output_stderr = output_process.communicate()
+
+        if zstd_process.returncode != 0:
+            raise OSError(zstd_stderr)
+        if output_process.returncode != 0:
+            raise OSError(output_stderr)
+        wait_for_device_process(self._device_process)
+        self._collect_hashes(stats.hashes, plain_pump, archive_pump)
+
+        self.all_bytes_read += bytes_read
+        self.last_stats = stats
+        stats.bytes_read = bytes_read
+        stats.duration = time.time() - start_piping
+        self.all_bytes_written += stats.bytes_written
+        if stats.md5 is None:
+            return "None", "-"
+
+        return "md5sum", stats.md5.replace(" *-", "")
+
+    def is_streaming(self) -> bool:
+        return self._stream is not None
 
+    def _start_zstd(
+            self, config: BackupConfig, zstd_args: [str], input_file: str, stderr
+    ) -> (subprocess.Popen, HashingPump):
+        """
+        zstd reads the input itself, or from a HashingPump if the uncompressed chunk or its files are hashed
+        """
+        if not config.hashes and config.file_hash is None:
+            zstd_process = subprocess.Popen(
+                [ZSTD, *zstd_args, input_file, "--stdout"], stdout=subprocess.PIPE, stderr=stderr
+            )
+            return zstd_process, None
+
+        read_fd, write_fd = os.pipe()
+        zstd_process = subprocess.Popen(
+            [ZSTD, *zstd_args, "-", "--stdout"], stdin=read_fd, stdout=subprocess.PIPE, stderr=stderr
+        )
+        os.close(read_fd)
+        pump = HashingPump(input_file, open(write_fd, "wb"), config.hashes, config.file_hash)
+        return zstd_process, pump.start()
+
+    def _collect_hashes(self, hashes: VolumeHashes, plain_pump: HashingPump, archive_pump: HashingPump):
+        if plain_pump is not None:
+            plain_pump.join()
+            hashes.plain = plain_pump.hashes() or None
+            hashes.files = plain_pump.file_hashes()
+            hashes.file_names = plain_pump.file_names()
+        if archive_pump is not None:
+            archive_pump.join()
+            hashes.archive = archive_pump.hashes()
+
+    def _start_output_process(
+            self, config: BackupConfig, age_process: subprocess.Popen, output_file: str, mbuffer_log: str
+    ) -> (subprocess.Popen, HashingPump):
+        """
+        :return: the process writing to tape and the pump hashing the encrypted data in front of it (or None)
+        """
+        if config.tape_writer == "native" and config.tape_dummy is None:
+            return self._start_tape_writer(config, age_process), None  # the tape writer hashes itself
+
+        if not config.hashes:
+            return self._start_output_command(config, age_process.stdout, output_file, mbuffer_log), None
+
+        read_fd, write_fd = os.pipe()
+        output_process = self._start_output_command(config, read_fd, output_file, mbuffer_log)
+        os.close(read_fd)
+        return output_process, HashingPump(age_process.stdout, open(write_fd, "wb"), config.hashes).start()
+
+    def _start_tape_writer(self, config: BackupConfig, age_process: subprocess.Popen) -> TapeWriterProcess:
+        output = config.tape
+        self._device_process = None
+        if is_virtual(config.tape):
+            read_fd, output = os.pipe()  # the writer closes it when it is done
+            self._device_process = start_device_process(config.tape, "write", stdin=read_fd)
+            os.close(read_fd)
+
+        if self.tape_writer is None:
+            self.tape_writer = TapeWriter.from_config(config)
+        self.tape_writer.on_end_of_medium = self.on_end_of_medium
+        return TapeWriterProcess(self.tape_writer, age_process.stdout, output)
+
+    def _start_output_command(
+            self, config: BackupConfig, stdin, output_file: str, mbuffer_log: str
+    ) -> subprocess.Popen:
         if config.tape_dummy is not None:
             # output_process = subprocess.Popen(
             #     f" > {output_file}", shell=True, stdin=age_process.stdout, stdout=subprocess.PIPE,
             #     stderr=subprocess.PIPE
             # )
             # the above method doesn't work on newer macos/python, the method below seems to be slower.
-            output_process = subprocess.Popen(
-                ["/bin/dd", "bs=512K", f"of={output_file}"], stdin=age_process.stdout, stdout=subprocess.PIPE,
+            return subprocess.Popen(
+                ["/bin/dd", "bs=512K", f"of={output_file}"], stdin=stdin, stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE
             )
-        else:
-            output_process = subprocess.Popen(
-                [
-                    MBUFFER, "-P", "90", "-l", mbuffer_log, "-q", "-m", "5G", "-o", config.tape, "-s",
-                    "512k", "--md5", "--tapeaware"
-                ],
-                stdin=age_process.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-            )
-
-        start_piping = time.time()
 
+        tape, stdout = config.tape, subprocess.PIPE
+        self._device_process = None
+        if is_virtual(config.tape):
+            read_fd, stdout = os.pipe()
+            self._device_process = start_device_process(config.tape, "write", stdin=read_fd)
+            os.close(read_fd)
+            tape = "-"
+
+        output_process = subprocess.Popen(
+            [
+                MBUFFER, "-P", str(config.write_buffer_start), "-l", mbuffer_log, "-q", "-m",
+                f"{config.write_buffer}G", "-o", tape, "-s", "512k", "--md5", "--tapeaware", *self.autoload_opts
+            ],
+            stdin=stdin, stdout=stdout, stderr=subprocess.PIPE
+        )
+        if self._device_process is not None:
+            os.close(stdout)
+        return output_process
+
+    def _watch_output_process(
+            self, config: BackupConfig, volume_no: int, output_process: subprocess.Popen, output_file: str,
+            mbuffer_log: str, total_bytes: int, stats: "PipelineStats"
+    ):
+        """
+        Follows the progress until the output process ends, afterwards stats has the bytes written and the md5
+        """
+        log = MBufferLogReader(mbuffer_log)
+        self.metrics.set("compress", "zstd_level", stats.zstd_level)
+        last_sample, last_bytes = time.time(), 0
         with self.pd.create_byte_bar(
-                "C/E", total_bytes=original_size, postfix=f"archive_no={archive_volume_no.volume_no}"
+                "C/E", total_bytes=total_bytes, postfix=f"archive_no={volume_no}"
         ) as p:
             while True:
+                done = output_process.poll() is not None  # read the log once more after the end
                 if config.tape_dummy is not None:
                     bytes_written, _ = self.get_file_size(output_file)
+                elif isinstance(output_process, TapeWriterProcess):
+                    writer = output_process.writer
+                    bytes_written = writer.bytes_written
+                    seconds = max(time.time() - last_sample, 0.001)
+                    self.metrics.tape_sample(
+                        writer.buffer_percent(), int((bytes_written - last_bytes) / seconds), seconds
+                    )
+                    last_sample, last_bytes = time.time(), bytes_written
                 else:
-                    bytes_written, _ = self.parse_mbuffer_progress_log(mbuffer_log)
+                    bytes_written, buffer_percent = log.read().progress()
+                    stats.add_buffer_sample(buffer_percent)
+                    self.metrics.tape_sample(log.buffer_percent, log.out_rate, time.time() - last_sample)
+                    last_sample = time.time()
 
                 p.update(completed=bytes_written)
+                if done:
+                    break
+                self.prompt.serve()
                 time.sleep(0.1)
 
-                if output_process.poll() is not None:
-                    break
+        stats.bytes_written = bytes_written
+        stats.md5 = log.md5
+        if isinstance(output_process, TapeWriterProcess) and output_process.returncode == 0:
+            stats.add_tape_writer(output_process.writer)
 
-        output_stdout, output_stderr = output_process.communicate()
+    def compress(
+            self, config: BackupConfig, volume_no: int, input_file: str, threads: int = 0, zstd_level: int = None,
+            hashes: VolumeHashes = None
+    ) -> str:
+        """
+        Compresses and encrypts the chunk into a staging file instead of streaming it to tape. Used by the staged
+        backup, where the tape writer picks up the file later. Can be called from several threads.
+        :param hashes: gets the hashes of the chunk, the native tape writer hashes the encrypted data itself
+        """
+        output_file = config.tempdir + "/%09i.tar.zst.age" % volume_no
 
-        if output_process.returncode != 0:
-            raise OSError(output_stderr)
+        original_size = get_safe_file_size(input_file)
+        zstd_level = config.zstd_level if zstd_level is None else zstd_level
 
-        bytes_written, _ = self.parse_mbuffer_progress_log(mbuffer_log)
-        # logging.info("C/E/xxx done with " + report_performance_bytes(start_piping, bytes_written))
-        self.all_bytes_written += bytes_written
+        if os.path.exists(output_file):
+            os.remove(output_file)
 
-        os.remove(input_file)
+        zstd_process, plain_pump = self._start_zstd(
+            config, [*zstd_level_args(zstd_level), f"-T{threads}"], input_file, stderr=subprocess.PIPE
+        )
+        archive_pump = None
+        if config.hashes and config.tape_writer != "native":
+            age_process = subprocess.Popen(
+                [AGE, "-e", "-i", config.password_file], stdin=zstd_process.stdout, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE
+            )
+            archive_pump = HashingPump(age_process.stdout, open(output_file, "wb"), config.hashes).start()
+        else:
+            age_process = subprocess.Popen(
+                [AGE, "-e", "-i", config.password_file, "-o", output_file], stdin=zstd_process.stdout,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            )
+        zstd_process.stdout.close()  # age owns the pipe now, zstd gets SIGPIPE if age dies
 
-        hash_out = self.parse_mbuffer_md5(mbuffer_log)
-        if hash_out is None:
-            return "None", "-"
+        with self.pd.create_byte_bar(
+                "C/E", total_bytes=original_size, postfix=f"archive_no={volume_no}"
+        ) as p:
+            while True:
+                p.update(completed=get_safe_file_size(output_file))
+                time.sleep(0.1)
 
-        return "md5sum", hash_out.replace(" *-", "")
+                if age_process.poll() is not None:
+                    break
 
-    def parse_mbuffer_progress_log(self, mbuffer_log: str) -> (int, int):
-        # mbuffer: in @  164 MiB/s, out @  164 MiB/s, 3102 MiB total, buffer  99% full
-        # summary: 5119 MiByte in 37.0sec - average of  138 MiB/s
-        try:
-            with open(mbuffer_log, "r") as f:
-                lines = f.readlines()
+        # stdout belongs to the pump, communicate() would read from it
+        age_stderr = age_process.stderr.read()
+        age_process.wait()
+        _, zstd_stderr = zstd_process.communicate()
 
-            if len(lines) <= 0:
-                return -1, -1
+        if zstd_process.returncode != 0:
+            raise OSError(zstd_stderr)
+        if age_process.returncode != 0:
+            raise OSError(age_stderr)
+        self._collect_hashes(hashes if hashes is not None else VolumeHashes(), plain_pump, archive_pump)
 
-            for line in reversed(lines):
-                if "buffer" in line:
-                    s = re.search(
-                        ", +([\\d.]+) +MiB total, buffer +([\\d.]+)% full", line, re.IGNORECASE
-                    )
-                    if s:
-                        bytes_written = int(float(s.group(1)) * 1024 * 1024)
-                        buffer_percent = int(s.group(2))
-                        return bytes_written, buffer_percent
-                    s = re.search(
-                        ", +([\\d.]+) +GiB total, buffer +([\\d.]+)% full", line, re.IGNORECASE
-                    )
-                    if s:
-                        bytes_written = int(float(s.group(1)) * 1024 * 1024 * 1024)
-                        buffer_percent = int(s.group(2))
-                        return bytes_written, buffer_percent
-        except:
-            pass
+        with self._lock:
+            self.all_bytes_read += original_size
+            self.all_bytes_written += get_safe_file_size(output_file)
 
-        return -1, -1
+        os.remove(input_file)
+
+        return output_file
 
     def get_file_size(self, file) -> (int, int):
         """
-        Mimics the output of parse_mbuffer_progress_log
+        Mimics the output of MBufferLogReader.progress()
         """
         return get_safe_file_size(file), -1
 
-    def parse_mbuffer_md5(self, mbuffer_log: str) -> (str):
-        # MD5 hash: 289067bcd5472f102e946f8b71c7729b
-        try:
-            with open(mbuffer_log, "r") as f:
-                lines = f.readlines()
-
-                for line in lines:
-                    if line.startswith("MD5 hash:"):
-                        return line.replace("MD5 hash:", "").strip()
-        except:
-            pass
-
-        return None
-
-    # def parse_mbuffer_summary_log(self, mbuffer_log: str) -> (int, int):
-    #     # mbuffer: in @  164 MiB/s, out @  164 MiB/s, 3102 MiB total, buffer  99% full
-    #     # summary: 5119 MiByte in 37.0sec - average of  138 MiB/s
-    #     try:
-    #         with open(mbuffer_log, "r") as f:
-    #             temp = f.readlines()
-    #
-    #         if len(temp) <= 0:
-    #             return -1, -1
-    #
-    #         last_line = temp[-1]
-    #
-    #         if "summary" in last_line:
-    #             s = re.search(
-    #                 "summary: +(\\d+) +MiByte in", last_line, re.IGNORECASE
-    #             )
-    #             if s:
-    #                 bytes_written = int(s.group(1)) * 1000 * 1000
-    #                 return bytes_written, -1
-    #     except:
-    #         pass
-    #
-    #     return -1, -1
-
     def overall_compression_ratio(self) -> float:
         return self.all_bytes_read / float(self.all_bytes_written)
 
 
-if __name__ == '__main__':
-    print(ZstdAgeV2(None).parse_mbuffer_summary_log("../mbuffer.log"))
-    # config = BackupConfig(
-    #     backup_repository="",
-    #     backup_name="",
-    #     description="",
-    #     compression="",
-    #     source="",
-    #     password_file="../password.age",
-    #     tape_buffer=0,
-    #     tempdir="../temp/",
-    #     tape="",
-    #     tape_dummy="../temp/blah",
-    #     chunk_size=0,
-    #     incremental_time=0,
-    #     excludes=None
-    # )
-    # # config: BackupConfig, archive_volume_no: ArchiveVolumeNumber, input_file: str
-    # ZstdAgeV2().do(
-    #     config,
-    #     archive_volume_no=ArchiveVolumeNumber(
-    #         tape_no=0, volume_no=0, block_position=0, bytes_written=0
-    #     ),
-    #     input_file="../temp_src/blah1"
-    # )
+def zstd_level_args(level: int) -> [str]:
+    """
+    Levels below 1 are zstd's --fast levels, levels above 19 need --ultra or zstd caps them at 19
+    """
+    if level < 1:
+        return [f"--fast={max(1, -level)}"]
+    if level > ZSTD_MAX_LEVEL:
+        return ["--ultra", f"-{level}"]
+    return [f"-{level}"]
+
+
+def estimate_zstd_memory(level: int, threads: int) -> int:
+    """
+    Rough upper bound of the memory zstd needs for compressing with the given level and threads: every thread holds
+    about six windows (input job, overlap and match state).
+    """
+    window_log = ZSTD_WINDOW_LOG[min(max(level, 1), len(ZSTD_WINDOW_LOG)) - 1]
+    return max(1, threads) * 6 * (1 << window_log)
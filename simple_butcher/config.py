@@ -17,6 +17,33 @@ class BackupConfig:
     incremental_time: int
     excludes: [str]
     zstd_level: int = 5
+    staging_chunks: int = 0  # 0 = compress and write each chunk synchronously
+    staging_reserve: int = 5  # GB
+    streaming: bool = False  # tar -> fifo -> zstd/age/mbuffer, no chunks in tempdir
+    compression_workers: int = 1  # chunks compressed in parallel when staging
+    zstd_threads: int = 0  # per worker, 0 = all cores split between the workers
+    compression_memory: int = 0  # GB for all workers, 0 = unlimited
+    adaptive_zstd: bool = False  # adapt zstd_level per chunk to the mbuffer fill level
+    zstd_min_level: int = -5  # negative levels are --fast
+    zstd_max_level: int = 19
+    min_tape_speed: int = 0  # MB/s
+    route_incompressible: bool = False  # already compressed files go into their own chunks
+    incompressible_zstd_level: int = -100  # --fast=100, close to storing
+    incremental_index: bool = False  # back up files changed since the last backup of the repository
+    listed_incremental: bool = False  # tar --listed-incremental with the snapshot of the repository
+    scan_workers: int = 8  # threads scanning the source for file lists
+    prescan: bool = False  # scan the source before tar, gives the progress a total
+    span_tapes: bool = False  # fill every tape, volumes continue on the next tape
+    fit_confidence: float = 3.0  # standard deviations of the compression ratio added when predicting chunk sizes
+    tape_fixture: str = None  # directory with recorded sg_logs / mt-st output instead of the drive
+    metrics_textfile: str = None  # prometheus textfile, e.g. for the node_exporter textfile collector
+    metrics_jsonl: str = None  # JSON lines file with metric samples and events
+    metrics_interval: int = 10  # seconds
+    tape_writer: str = "mbuffer"  # or "native", the TapeWriter in this process
+    write_buffer: int = 5  # GB of memory in front of the tape
+    write_buffer_start: int = 90  # percent the buffer is filled before writing starts
+    hashes: [str] = None  # algorithms hashing the uncompressed chunk and the data on tape while it streams
+    file_hash: str = None  # algorithm hashing the content of every file in the chunks
 
 
 @dataclass
@@ -30,17 +57,82 @@ class RestoreConfig:
     tape: str
     tape_dummy: str
     excludes: [str]
+    includes: [str] = None  # only these paths (and everything below) or globs, read only the volumes they are in
+
+
+@dataclass
+class PlanConfig:
+    backup_repository: str
+    source: str
+    tempdir: str
+    tape: str
+    tape_dummy: str
+    tape_buffer: int  # GB
+    incremental_time: int
+    excludes: [str]
+    zstd_level: int = 5
+    scan_workers: int = 8
+    sample_files: int = 1000
+    sample_size: int = 256  # MB
+    tape_capacity: int = 2500  # GB, if the drive doesn't report it
+    tape_speed: int = 0  # MB/s, 0 = average of the last backup
+
+
+@dataclass
+class BenchConfig:
+    workdir: str  # datasets, virtual tape and scratch files
+    datasets: [str]
+    password_file: str
+    output: str  # JSON results
+    scale: float = 1.0  # multiplies the number of files and the size of the large files
+    seed: int = 1
+    tape_generation: str = "LTO-6"  # speed of the virtual tape
+    zstd_level: int = 5
+    scan_workers: int = 8
+    backup_args: str = ""  # passed on to backup, e.g. "--streaming"
+    stages_only: bool = False  # skip backup, test and restore
+    baseline: str = None  # JSON results of an earlier run
+    regression_threshold: int = 10  # percent
 
 
 @dataclass
 class ListBackupConfig:
     backup_repository: str
+    since: str = None  # YYYY-MM-DD, backups started on or after this day
+    until: str = None  # YYYY-MM-DD, backups started on or before this day
+    backup_type: str = None  # "full" or "incremental"
+    tape_serial: str = None  # backups on this tape
+    limit: int = 0  # backups per page, 0 = all
+    offset: int = 0  # backups skipped after filtering
+
+
+@dataclass
+class FindConfig:
+    backup_repository: str
+    pattern: str
+    match: str = None  # "exact", "prefix", "glob" or "substring", None = glob if pattern has wildcards, else exact
+    limit: int = 1000  # versions shown, 0 = all
+
+
+@dataclass
+class RebuildIndexConfig:
+    backup_repository: str
+
+
+@dataclass
+class StatsConfig:
+    backup_repository: str
+    last: int = 20  # backups
+    slow_threshold: int = 80  # percent of the median tape rate
 
 
 @dataclass
 class ListFilesConfig:
     backup_repository: str
     backup_name: str
+    path: str = None  # only this file or directory
+    all_backups: bool = False  # search path in every backup of the repository
+    workers: int = 0  # processes reading the catalogs with all_backups, 0 = one per core
 
 
 @dataclass
@@ -1,17 +1,102 @@
 import logging
+import concurrent.futures
 import dataclasses
 import json
 import os
 import shutil
+import signal
+import sqlite3
 import subprocess
+from contextlib import contextmanager
 from exe_paths import ZSTD
+from tarindex import TarIndexer, TarMember, parse_tar_line
 
 ZSTD_COMPRESSION = '{zstd} -5 -T0 {in_file}'
 ZSTD_DECOMPRESSION = '{zstd} -d {in_file}'
 DB_ROOT = "./db"
 INCREMENTAL_INDEX_FILENAME = "incremental_index"
+FILE_STATE_FILENAME = "file_state.zst"
 TAR_LOG_FILE = "tar.log"
 TAR_INPUT_FILE_LIST = "tar_input_file_list"
+TAR_STORE_FILE_LIST = "tar_store_file_list"
+VOLUMES_FILENAME = "volumes.jsonl"
+MANIFEST_FILENAME = "manifest.jsonl"
+BACKUP_INDEX_FILENAME = "backups.jsonl"
+FIND_INDEX_FILENAME = "find.sqlite"
+CATALOG_FILENAME = "catalog.sqlite"
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS volumes (
+    volume_no INTEGER PRIMARY KEY,
+    tape_no INTEGER NOT NULL,
+    tape_file_number INTEGER,
+    tape_volume_serial TEXT,
+    hash_type TEXT,
+    archive_hash TEXT
+);
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    volume_no INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    type TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    mode INTEGER NOT NULL,
+    uid INTEGER NOT NULL,
+    gid INTEGER NOT NULL,
+    uname TEXT NOT NULL,
+    gname TEXT NOT NULL,
+    link_name TEXT,
+    device TEXT,
+    continued_at INTEGER,
+    file_hash_type TEXT,
+    file_hash TEXT,
+    tar_line TEXT
+);
+CREATE INDEX IF NOT EXISTS files_path ON files (path);
+"""
+FIND_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    backup_id INTEGER PRIMARY KEY,
+    backup_name TEXT NOT NULL UNIQUE,
+    time_start INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS paths (
+    path_id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS paths_trigram USING fts5(
+    path, content='paths', content_rowid='path_id', tokenize='trigram case_sensitive 1'
+);
+CREATE TRIGGER IF NOT EXISTS paths_insert AFTER INSERT ON paths BEGIN
+    INSERT INTO paths_trigram (rowid, path) VALUES (new.path_id, new.path);
+END;
+CREATE TABLE IF NOT EXISTS versions (
+    backup_id INTEGER NOT NULL,
+    path_id INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    volume_no INTEGER NOT NULL,
+    tape_volume_serial TEXT,
+    tape_file_number INTEGER
+);
+CREATE INDEX IF NOT EXISTS versions_path ON versions (path_id);
+CREATE INDEX IF NOT EXISTS versions_backup ON versions (backup_id);
+"""
+# ./ of tar -C <dir> . and the / of directories are left out, so all backups use the same paths
+FIND_INDEX_CATALOG_PATH = "rtrim(CASE WHEN files.path LIKE './%' THEN substr(files.path, 3) ELSE files.path END, '/')"
+FIND_INDEX_CATALOG_FILES = "files.type NOT IN ('M', 'V', '?')"  # no continuations, volume labels, unparsed lines
+FIND_INDEX_QUERY = "SELECT backups.backup_name, paths.path, versions.type, versions.size, versions.mtime, " \
+                   "versions.volume_no, versions.tape_volume_serial, versions.tape_file_number FROM versions " \
+                   "JOIN paths ON paths.path_id = versions.path_id " \
+                   "JOIN backups ON backups.backup_id = versions.backup_id " \
+                   "WHERE versions.path_id IN ({paths}) ORDER BY paths.path, backups.time_start DESC LIMIT ?"
+CATALOG_FILE_COLUMNS = "volume_no, offset, path, type, size, mtime, mode, uid, gid, uname, gname, link_name, " \
+                       "device, continued_at, file_hash_type, file_hash, tar_line"
+CATALOG_RECORD_QUERY = f"SELECT {CATALOG_FILE_COLUMNS}, tape_no, tape_file_number, tape_volume_serial, hash_type, " \
+                       "archive_hash FROM files JOIN volumes USING (volume_no)"
 
 
 @dataclasses.dataclass
@@ -23,9 +108,15 @@ class BackupRecord:
     tar_line: str
     tape_file_number: int = -1
     tape_volume_serial: str = ""
+    offset: int = -1  # of the member inside the (uncompressed) tar chunk
+    file_hash: str = None  # of the file content (backup --file-hash)
+    file_hash_type: str = None
+    member: TarMember = None  # parsed header if the chunk was indexed, only tar_line is kept in json
 
     def to_json(self):
-        return json.dumps(dataclasses.asdict(self))
+        j = dataclasses.asdict(self)
+        del j["member"]
+        return json.dumps(j)
 
     @staticmethod
     def from_json(j):
@@ -37,9 +128,89 @@ class BackupRecord:
             tar_line=j['tar_line'],
             tape_file_number=j['tape_file_number'] if 'tape_file_number' in j else None,
             tape_volume_serial=j['tape_volume_serial'] if 'tape_volume_serial' in j else None,
+            offset=j['offset'] if 'offset' in j else -1,
+            file_hash=j['file_hash'] if 'file_hash' in j else None,
+            file_hash_type=j['file_hash_type'] if 'file_hash_type' in j else None,
         )
 
 
+@dataclasses.dataclass
+class VolumeInfo:
+    tape_no: int
+    volume_no: int
+    zstd_level: int
+    bytes_read: int  # uncompressed tar chunk
+    bytes_written: int  # compressed and encrypted, on tape
+    duration: float  # seconds the compression/tape pipeline took
+    write_rate: float = -1  # bytes/s to tape
+    buffer_fill_min: int = -1  # % of the mbuffer memory buffer
+    buffer_fill_avg: float = -1
+    archive_set: int = 0  # tar run the volume belongs to, every set is its own multi-volume archive
+    tape_serials: [str] = None  # only set if the volume spans tapes: all tapes it is on, in order
+    split_bytes: [int] = None  # bytes of a spanning volume on every tape but the last
+    compression_duration: float = -1  # seconds zstd/age took, if they ran before the tape write (staged)
+    buffer_empty_events: int = -1  # mbuffer ran empty while writing: drive underruns / shoe-shining
+    tape_serial: str = None  # tape the volume starts on
+    time_end: float = 0  # when the volume was on tape
+    plain_hashes: dict = None  # algorithm -> hex digest of the uncompressed tar chunk (backup --hash)
+    archive_hashes: dict = None  # algorithm -> hex digest of the compressed and encrypted data on tape
+
+    def compression_ratio(self) -> float:
+        if self.bytes_read <= 0:
+            return -1
+        return self.bytes_written / self.bytes_read
+
+    def compression_rate(self) -> float:
+        """
+        bytes/s of uncompressed data through zstd/age
+        """
+        duration = self.compression_duration if self.compression_duration >= 0 else self.duration
+        if duration <= 0:
+            return -1
+        return self.bytes_read / duration
+
+    def tape_parts(self) -> int:
+        return len(self.tape_serials) if self.tape_serials else 1
+
+    def to_json(self):
+        return json.dumps(dataclasses.asdict(self))
+
+    @staticmethod
+    def from_json(j):
+        field_names = {f.name for f in dataclasses.fields(VolumeInfo)}
+        return VolumeInfo(**{k: v for k, v in j.items() if k in field_names})
+
+
+@dataclasses.dataclass
+class ManifestVolume:
+    """
+    One line of the manifest, everything restore and test need to know about a volume without reading the catalog
+    """
+    volume_no: int
+    tape_no: int
+    tape_serial: str = None  # tape the volume starts on
+    tape_file_number: int = -1
+    bytes_read: int = -1  # uncompressed tar chunk
+    bytes_written: int = -1  # compressed and encrypted, on tape
+    hash_type: str = None
+    archive_hash: str = None
+    files: int = 0  # records in the catalog
+    tape_serials: [str] = None  # only set if the volume spans tapes
+    plain_hashes: dict = None  # algorithm -> hex digest of the uncompressed tar chunk (backup --hash)
+    archive_set: int = 0  # tar run the volume belongs to
+
+    def tape_parts(self) -> int:
+        return len(self.tape_serials) if self.tape_serials else 1
+
+    def to_json(self):
+        return json.dumps(dataclasses.asdict(self))
+
+    @staticmethod
+    def from_json(j):
+        field_names = {f.name for f in dataclasses.fields(ManifestVolume)}
+        return ManifestVolume(**{k: v for k, v in j.items() if k in field_names})
+
+
 @dataclasses.dataclass
 class BackupInfo:
     time_start: int
@@ -52,6 +223,7 @@ class BackupInfo:
     tape_start_index: int
     description: str = ""
     tape_serials: [str] = None
+    incremental_mode: str = None  # "index" / "listed", time based incrementals only set incremental_time
 
     def to_json(self):
         return json.dumps(dataclasses.asdict(self))
@@ -69,6 +241,7 @@ class BackupInfo:
             incremental_time=j['incremental_time'] if 'incremental_time' in j else None,
             description=j['description'] if 'description' in j else "",
             tape_serials=j['tape_serials'] if 'tape_serials' in j else None,
+            incremental_mode=j['incremental_mode'] if 'incremental_mode' in j else None,
         )
 
 
@@ -79,9 +252,7 @@ class BackupDatabase:
         self.backup_name = str(backup_name).replace(":", "")
 
     def open(self):
-        db_file = self.database_file() + ".zst"
-        if os.path.exists(db_file):
-            _decompress_file(db_file)
+        pass  # read_records() streams the catalog, nothing is decompressed in advance
 
         # tar_file = self.tar_incremental_file() + ".zst"
         # if os.path.exists(tar_file):
@@ -91,8 +262,17 @@ class BackupDatabase:
         return self.database_dir + "/" + self.backup_repository + "/" + self.backup_name
 
     def database_file(self) -> str:
+        """
+        Catalog of backups before the SQLite catalog
+        """
         return self.backup_db_dir() + "/contents.jsonl"
 
+    def catalog_file(self) -> str:
+        return self.backup_db_dir() + f"/{CATALOG_FILENAME}"
+
+    def catalog(self) -> "Catalog":
+        return Catalog(self.catalog_file())
+
     def tar_incremental_file(self) -> str:
         return self.backup_db_dir() + f"/{INCREMENTAL_INDEX_FILENAME}"
 
@@ -102,19 +282,135 @@ class BackupDatabase:
     def tar_input_file_list(self) -> str:
         return self.backup_db_dir() + f"/{TAR_INPUT_FILE_LIST}"
 
+    def tar_store_file_list(self) -> str:
+        return self.backup_db_dir() + f"/{TAR_STORE_FILE_LIST}"
+
     def info_file(self) -> str:
         return self.backup_db_dir() + "/info.json"
 
+    def volumes_file(self) -> str:
+        return self.backup_db_dir() + f"/{VOLUMES_FILENAME}"
+
+    def manifest_file(self) -> str:
+        return self.backup_db_dir() + f"/{MANIFEST_FILENAME}"
+
     def start_backup(self):
         os.makedirs(self.backup_db_dir(), exist_ok=True)
-        with open(self.database_file(), "a+") as f:
-            pass  # just create file
+        self.catalog().create()
 
     def store(self, records: [BackupRecord]):
-        with open(self.database_file(), "a+") as f:
-            for record in records:
-                f.write(record.to_json())
+        self.catalog().store(records)
+
+    def read_records(self):
+        """
+        All records of the backup as generator, from the catalog or the contents.jsonl(.zst) of older backups. The
+        compressed file is decompressed while reading, stopping early (closing the generator) stops zstd.
+        """
+        if os.path.exists(self.catalog_file()):
+            yield from self.catalog().records()
+            return
+
+        if not os.path.exists(self.database_file() + ".zst"):
+            with open(self.database_file(), "rb") as f:
+                yield from _parse_records(f)
+            return
+
+        reader = subprocess.Popen(
+            [ZSTD, "-q", "-d", "-c", self.database_file() + ".zst"], stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        try:
+            yield from _parse_records(reader.stdout)
+        finally:
+            reader.stdout.close()
+            reader.kill()
+            reader.wait()
+
+        if reader.returncode not in (0, -signal.SIGKILL):
+            raise OSError(reader.stderr.read())
+
+    def store_volume(self, volume: VolumeInfo):
+        with open(self.volumes_file(), "a+") as f:
+            f.write(volume.to_json())
+            f.write(os.linesep)
+
+    def read_volumes(self) -> [VolumeInfo]:
+        ret = []
+        if not os.path.exists(self.volumes_file()):
+            return ret
+
+        with open(self.volumes_file(), "r") as f:
+            for line in f:
+                if line.strip():
+                    ret.append(VolumeInfo.from_json(json.loads(line)))
+        return ret
+
+    def read_manifest(self) -> [ManifestVolume]:
+        """
+        The volumes of the backup in order. Backups closed before the manifest existed get it built from the catalog.
+        """
+        if not os.path.exists(self.manifest_file()):
+            return self.build_manifest()
+
+        with open(self.manifest_file(), "r") as f:
+            return [ManifestVolume.from_json(json.loads(line)) for line in f if line.strip()]
+
+    def write_manifest(self):
+        manifest = self.build_manifest()
+        with open(self.manifest_file() + ".tmp", "w") as f:
+            for volume in manifest:
+                f.write(volume.to_json())
                 f.write(os.linesep)
+        os.replace(self.manifest_file() + ".tmp", self.manifest_file())
+
+    def build_manifest(self) -> [ManifestVolume]:
+        """
+        Joins the volumes of the catalog (tape position and hash, file count) with volumes.jsonl (sizes, tapes of
+        spanning volumes). Only catalogs without SQLite are read record by record, still with one entry per volume.
+        """
+        manifest = dict()
+        if os.path.exists(self.catalog_file()):
+            for volume in self.catalog().volumes():
+                manifest[volume.volume_no] = volume
+        else:
+            for record in self.read_records():
+                volume = manifest.get(record.volume_no)
+                if volume is None:
+                    volume = manifest[record.volume_no] = ManifestVolume(
+                        volume_no=record.volume_no,
+                        tape_no=record.tape_no,
+                        tape_serial=record.tape_volume_serial or None,
+                        tape_file_number=record.tape_file_number,
+                        hash_type=record.hash_type,
+                        archive_hash=record.archive_hash
+                    )
+                volume.files += 1
+
+        for info in self.read_volumes():
+            volume = manifest.get(info.volume_no)
+            if volume is None:  # no file starts in this volume
+                volume = manifest[info.volume_no] = ManifestVolume(volume_no=info.volume_no, tape_no=info.tape_no)
+            volume.tape_serial = volume.tape_serial or info.tape_serial
+            volume.bytes_read = info.bytes_read
+            volume.bytes_written = info.bytes_written
+            volume.tape_serials = info.tape_serials
+            volume.plain_hashes = info.plain_hashes
+            volume.archive_set = info.archive_set
+
+        return [manifest[volume_no] for volume_no in sorted(manifest)]
+
+    def last_members(self) -> dict:
+        """
+        volume_no -> name of the last member in the volume, only this one can continue in the next volume (tar -M)
+        """
+        if os.path.exists(self.catalog_file()):
+            return self.catalog().last_members()
+
+        ret = dict()
+        for record in self.read_records():
+            member = parse_tar_line(record.tar_line)
+            if member is not None and member.type != "V":
+                ret[record.volume_no] = member.name
+        return ret
 
     def close(self):
         if os.path.exists(self.database_file()) and os.path.exists(self.database_file() + ".zst"):
@@ -126,11 +422,19 @@ class BackupDatabase:
             logging.info("Writing backup information file...")
             f.write(backup_info.to_json())
 
+        logging.info("Writing volume manifest...")
+        self.write_manifest()
+        repository = BackupDatabaseRepository(self.database_dir, self.backup_repository)
+        repository.add_to_backup_index(self.backup_name, backup_info)
+        logging.info("Adding files to the find index...")
+        repository.find_index().add_backup(self.backup_name, backup_info.time_start, self)
+
         to_compress = [
             self.database_file(),
             self.tar_incremental_file(),
             self.tar_log_file(),
-            self.tar_input_file_list()
+            self.tar_input_file_list(),
+            self.tar_store_file_list()
         ]
 
         for file in to_compress:
@@ -139,6 +443,237 @@ class BackupDatabase:
                 _compress_file(file)
 
 
+class Catalog:
+    """
+    The files of one backup in SQLite: parsed tar members with their volume and offset inside the chunk, the tape,
+    tape file and hash only once per volume. The path index makes looking up a file or directory independent of the
+    number of files in the backup.
+
+    Records read back have the tar_line formatted from the stored fields (like tar tvf, mtime in minutes), only lines
+    that couldn't be parsed are stored as they are.
+    """
+
+    def __init__(self, catalog_file: str):
+        self.catalog_file = catalog_file
+
+    def create(self):
+        with self._connect() as connection:
+            connection.executescript(CATALOG_SCHEMA)
+
+    def store(self, records: [BackupRecord]):
+        """
+        Adds the records of one or more volumes, volumes already stored are replaced by the latest values
+        """
+        volumes = dict()
+        rows = []
+        for record in records:
+            volumes[record.volume_no] = (
+                record.volume_no, record.tape_no, record.tape_file_number, record.tape_volume_serial,
+                record.hash_type, record.archive_hash
+            )
+            rows.append(_file_row(record))
+
+        with self._connect() as connection:
+            connection.executemany("INSERT OR REPLACE INTO volumes VALUES (?, ?, ?, ?, ?, ?)", volumes.values())
+            connection.executemany(
+                f"INSERT INTO files ({CATALOG_FILE_COLUMNS}) VALUES ({', '.join('?' * 17)})", rows
+            )
+
+    def records(self):
+        """
+        All records in the order they were stored, as generator
+        """
+        yield from self._query(f"{CATALOG_RECORD_QUERY} ORDER BY id")
+
+    def lookup(self, path: str):
+        """
+        Records of the path and, if it is a directory, everything below it. Paths are stored like tar stores them,
+        without leading /.
+        """
+        path = path.lstrip("/").rstrip("/")
+        conditions, parameters = [], []
+        for name in (path, "./" + path):  # tar -C <dir> . stores ./<path>
+            # everything between "name/" and "name0" ('0' follows '/') is below the directory, all use the index
+            conditions.append("path = ? OR path = ? OR (path >= ? AND path < ?)")
+            parameters.extend((name, name + "/", name + "/", name + "0"))
+        yield from self._query(
+            f"{CATALOG_RECORD_QUERY} WHERE {' OR '.join(conditions)} ORDER BY id", tuple(parameters)
+        )
+
+    def glob(self, pattern: str):
+        """
+        Records of the paths matching the glob pattern (* also matches /), compared without leading ./ and trailing /
+        """
+        yield from self._query(
+            f"{CATALOG_RECORD_QUERY} WHERE {FIND_INDEX_CATALOG_PATH} GLOB ? ORDER BY id", (_find_path(pattern),)
+        )
+
+    def last_members(self) -> dict:
+        with self._connect() as connection:
+            # the bare column path is taken from the row with MAX(id)
+            rows = connection.execute("SELECT volume_no, path, MAX(id) FROM files WHERE type != 'V' GROUP BY volume_no")
+            return {volume_no: path for volume_no, path, _ in rows}
+
+    def volumes(self) -> [ManifestVolume]:
+        with self._connect() as connection:
+            files = dict(connection.execute("SELECT volume_no, COUNT(*) FROM files GROUP BY volume_no"))
+            return [
+                ManifestVolume(
+                    volume_no=volume_no,
+                    tape_no=tape_no,
+                    tape_serial=tape_volume_serial or None,
+                    tape_file_number=tape_file_number,
+                    hash_type=hash_type,
+                    archive_hash=archive_hash,
+                    files=files.get(volume_no, 0)
+                )
+                for volume_no, tape_no, tape_file_number, tape_volume_serial, hash_type, archive_hash
+                in connection.execute("SELECT * FROM volumes ORDER BY volume_no")
+            ]
+
+    def count_files(self) -> int:
+        with self._connect() as connection:
+            return connection.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def _query(self, query: str, parameters: tuple = ()):
+        with self._connect() as connection:
+            indexer = TarIndexer()
+            for row in connection.execute(query, parameters):
+                yield _record(indexer, row)
+
+    @contextmanager
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Commits at the end of the block, unless it failed, and closes the connection
+        """
+        connection = sqlite3.connect(self.catalog_file)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+
+@dataclasses.dataclass
+class FoundFile:
+    backup_name: str
+    path: str
+    type: str  # tar type flag
+    size: int
+    mtime: int
+    volume_no: int
+    tape_volume_serial: str
+    tape_file_number: int
+
+
+class FindIndex:
+    """
+    The files of all backups of a repository in one SQLite file for find. Every path is stored once with its
+    versions (backup, size, mtime, volume and tape), the unique index on the paths answers exact and prefix searches,
+    an FTS5 trigram index on them glob and substring searches, without opening the catalog of any backup.
+
+    Backups are added when they are closed, rebuild-index adds all of them again.
+    """
+
+    def __init__(self, index_file: str):
+        self.index_file = index_file
+
+    def create(self):
+        with self._connect() as connection:
+            connection.executescript(FIND_INDEX_SCHEMA)
+
+    def add_backup(self, backup_name: str, time_start: int, database: "BackupDatabase"):
+        """
+        Adds the files of the backup, from its SQLite catalog with one statement or record by record from the
+        contents.jsonl(.zst) of older backups. A backup added again replaces its earlier versions.
+        """
+        with self._connect() as connection:
+            connection.executescript(FIND_INDEX_SCHEMA)
+            with_catalog = os.path.exists(database.catalog_file())
+            if with_catalog:
+                connection.execute("ATTACH DATABASE ? AS catalog", (database.catalog_file(),))
+
+            self._remove(connection, backup_name)
+            backup_id = connection.execute(
+                "INSERT INTO backups (backup_name, time_start) VALUES (?, ?)", (backup_name, time_start)
+            ).lastrowid
+
+            if with_catalog:
+                connection.execute(
+                    f"INSERT OR IGNORE INTO paths (path) SELECT DISTINCT {FIND_INDEX_CATALOG_PATH} "
+                    f"FROM catalog.files AS files WHERE {FIND_INDEX_CATALOG_FILES} AND {FIND_INDEX_CATALOG_PATH} != ''"
+                )
+                connection.execute(
+                    f"INSERT INTO versions SELECT ?, paths.path_id, files.type, files.size, files.mtime, "
+                    f"files.volume_no, volumes.tape_volume_serial, volumes.tape_file_number "
+                    f"FROM catalog.files AS files JOIN paths ON paths.path = {FIND_INDEX_CATALOG_PATH} "
+                    f"LEFT JOIN catalog.volumes AS volumes ON volumes.volume_no = files.volume_no "
+                    f"WHERE {FIND_INDEX_CATALOG_FILES}",
+                    (backup_id,)
+                )
+            else:
+                self._add_records(connection, backup_id, database.read_records())
+
+    def remove_backup(self, backup_name: str):
+        with self._connect() as connection:
+            connection.executescript(FIND_INDEX_SCHEMA)
+            self._remove(connection, backup_name)
+
+    def backup_names(self) -> [str]:
+        if not os.path.exists(self.index_file):
+            return []
+
+        with self._connect() as connection:
+            return [backup_name for backup_name, in connection.execute("SELECT backup_name FROM backups")]
+
+    def find(self, pattern: str, match: str, limit: int = 0) -> [FoundFile]:
+        """
+        Every version of the matching paths, sorted by path and newest backup first
+        :param match: "exact" (the path), "prefix" (paths starting with pattern), "glob" (like the shell, * also
+            matches /) or "substring"
+        """
+        if not os.path.exists(self.index_file):
+            return []
+
+        paths, parameters = _find_paths_query(pattern, match)
+        with self._connect() as connection:
+            rows = connection.execute(FIND_INDEX_QUERY.format(paths=paths), parameters + (limit or -1,))
+            return [FoundFile(*row) for row in rows]
+
+    def _remove(self, connection: sqlite3.Connection, backup_name: str):
+        connection.execute(
+            "DELETE FROM versions WHERE backup_id IN (SELECT backup_id FROM backups WHERE backup_name = ?)",
+            (backup_name,)
+        )
+        connection.execute("DELETE FROM backups WHERE backup_name = ?", (backup_name,))
+
+    def _add_records(self, connection: sqlite3.Connection, backup_id: int, records):
+        rows = []
+        for record in records:
+            member = record.member or parse_tar_line(record.tar_line)
+            if member is None or member.type in ("M", "V") or not _find_path(member.name):
+                continue
+            rows.append((
+                _find_path(member.name), backup_id, member.type, member.size, int(member.mtime), record.volume_no,
+                record.tape_volume_serial, record.tape_file_number
+            ))
+
+        connection.executemany("INSERT OR IGNORE INTO paths (path) VALUES (?)", ((row[0],) for row in rows))
+        connection.executemany(
+            "INSERT INTO versions SELECT ?, path_id, ?, ?, ?, ?, ?, ? FROM paths WHERE path = ?",
+            (row[1:] + row[:1] for row in rows)
+        )
+
+    @contextmanager
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.index_file)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+
 class BackupDatabaseRepository:
     def __init__(self, database_dir, backup_repository):
         self.database_dir = database_dir
@@ -147,7 +682,102 @@ class BackupDatabaseRepository:
     def backup_repository_dir(self) -> str:
         return self.database_dir + "/" + self.backup_repository
 
-    def list_backups(self):
+    def file_state_file(self) -> str:
+        return self.backup_repository_dir() + f"/{FILE_STATE_FILENAME}"
+
+    def listed_incremental_file(self) -> str:
+        return self.backup_repository_dir() + f"/{INCREMENTAL_INDEX_FILENAME}"
+
+    def backup_index_file(self) -> str:
+        return self.backup_repository_dir() + f"/{BACKUP_INDEX_FILENAME}"
+
+    def find_index_file(self) -> str:
+        return self.backup_repository_dir() + f"/{FIND_INDEX_FILENAME}"
+
+    def find_index(self) -> FindIndex:
+        return FindIndex(self.find_index_file())
+
+    def rebuild_find_index(self) -> int:
+        """
+        Adds every backup of the backup index to a new find index and replaces the old one with it
+        :return: number of backups in the index
+        """
+        index_file = self.find_index_file() + ".tmp"
+        if os.path.exists(index_file):
+            os.remove(index_file)
+
+        index = FindIndex(index_file)
+        index.create()
+        backups = self.read_backup_index()
+        for backup_name, backup_info in reversed(backups):
+            logging.info(f"Adding backup {backup_name} to the find index...")
+            database = BackupDatabase(self.database_dir, self.backup_repository, backup_name)
+            index.add_backup(backup_name, backup_info.time_start, database)
+
+        os.replace(index_file, self.find_index_file())
+        return len(backups)
+
+    def list_backups(self) -> [str]:
+        """
+        Names of the closed backups, newest first
+        """
+        return [backup_name for backup_name, backup_info in self.read_backup_index()]
+
+    def read_backup_index(self) -> [(str, BackupInfo)]:
+        """
+        (name, info) of the closed backups, newest first. One file read instead of a directory listing and an
+        info.json per backup, repositories without index (before it existed) are still scanned.
+        """
+        if not os.path.exists(self.backup_index_file()):
+            return [(backup_name, self.read_backup_info(backup_name)) for backup_name in self.scan_backup_dirs()]
+
+        backups = dict()
+        with open(self.backup_index_file(), "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    logging.warning(f"Skipping damaged line in {self.backup_index_file()}, rebuild-index repairs it")
+                    continue
+                backups[entry["backup_name"]] = BackupInfo.from_json(entry["info"])  # the last entry of a backup wins
+
+        return [(backup_name, backups[backup_name]) for backup_name in sorted(backups, reverse=True)]
+
+    def add_to_backup_index(self, backup_name: str, backup_info: BackupInfo):
+        """
+        Appends the backup to a copy of the index and replaces the index with it, readers see the old or the new
+        index but never a half written line (also on NFS, where O_APPEND isn't atomic).
+        """
+        if not os.path.exists(self.backup_index_file()):
+            self.rebuild_backup_index()  # finds this backup by its info.json as well
+            return
+
+        index_file = self.backup_index_file()
+        shutil.copyfile(index_file, index_file + ".tmp")
+        with open(index_file + ".tmp", "a") as f:
+            f.write(_backup_index_line(backup_name, backup_info))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(index_file + ".tmp", index_file)
+
+    def rebuild_backup_index(self) -> int:
+        """
+        Writes the index from the info.json of every backup, e.g. after backups were deleted
+        :return: number of backups in the index
+        """
+        backup_names = self.scan_backup_dirs()
+        index_file = self.backup_index_file()
+        with open(index_file + ".tmp", "w") as f:
+            for backup_name in reversed(backup_names):  # oldest first, like they were appended
+                f.write(_backup_index_line(backup_name, self.read_backup_info(backup_name)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(index_file + ".tmp", index_file)
+        return len(backup_names)
+
+    def scan_backup_dirs(self) -> [str]:
         backups = os.listdir(self.backup_repository_dir())
         backups.sort(reverse=True)
 
@@ -158,6 +788,23 @@ class BackupDatabaseRepository:
 
         return filtered_backups
 
+    def scan_backups(self, backup_names: [str], scan, workers: int = None):
+        """
+        Runs scan(database) for every backup in worker processes, the catalogs of the backups are independent.
+        Yields (backup_name, result) in the order of backup_names, stopping early cancels the backups not started.
+        :param scan: module level function (or functools.partial of one), it is pickled to the workers
+        """
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        try:
+            futures = [
+                executor.submit(_scan_backup, scan, self.database_dir, self.backup_repository, backup_name)
+                for backup_name in backup_names
+            ]
+            for backup_name, future in zip(backup_names, futures):
+                yield backup_name, future.result()
+        finally:
+            executor.shutdown(cancel_futures=True)
+
     def read_backup_info(self, backup_dir: str) -> BackupInfo:
         info_file = self.backup_repository_dir() + "/" + backup_dir + "/info.json"
         with open(info_file, "r") as f:
@@ -185,6 +832,104 @@ class BackupDatabaseRepository:
         return backup_info, database
 
 
+def _backup_index_line(backup_name: str, backup_info: BackupInfo) -> str:
+    return json.dumps({"backup_name": backup_name, "info": dataclasses.asdict(backup_info)}) + os.linesep
+
+
+def _find_path(name: str) -> str:
+    """
+    Path like the find index stores it: without leading / or ./ and trailing /
+    """
+    name = name.lstrip("/")
+    if name.startswith("./"):
+        name = name[2:]
+    return name.rstrip("/")
+
+
+def _find_paths_query(pattern: str, match: str) -> (str, tuple):
+    """
+    Query for the path_id of the matching paths in the find index, with its parameters
+    """
+    if match == "exact":
+        return "SELECT path_id FROM paths WHERE path = ?", (_find_path(pattern),)
+
+    if match == "prefix":
+        prefix = pattern.lstrip("/")
+        if not prefix:
+            return "SELECT path_id FROM paths", ()
+        # everything from prefix up to (not including) the prefix with its last character incremented
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        return "SELECT path_id FROM paths WHERE path >= ? AND path < ?", (prefix, upper)
+
+    if match == "glob":
+        # the trigram index is used for the literal parts of the pattern (at least three characters)
+        return "SELECT rowid FROM paths_trigram WHERE path GLOB ?", (_find_path(pattern),)
+
+    if match == "substring":
+        if len(pattern) < 3:  # shorter than a trigram, all paths are compared
+            return "SELECT path_id FROM paths WHERE instr(path, ?) > 0", (pattern,)
+        return "SELECT rowid FROM paths_trigram WHERE paths_trigram MATCH ?", ('"' + pattern.replace('"', '""') + '"',)
+
+    raise ValueError(f"Unknown match {match}")
+
+
+def _scan_backup(scan, database_dir: str, backup_repository: str, backup_name: str):
+    return scan(BackupDatabase(database_dir, backup_repository, backup_name))
+
+
+def _parse_records(lines):
+    for line in lines:
+        if line.strip():
+            yield BackupRecord.from_json(json.loads(line))
+
+
+def _file_row(record: BackupRecord) -> tuple:
+    member = record.member
+    if member is None:  # tar tvf or tar -vv listing, user/group names hide the ids and mtime has only minutes
+        member = parse_tar_line(record.tar_line)
+    if member is None:  # keep what tar printed
+        return (
+            record.volume_no, record.offset, record.tar_line, "?", 0, 0, 0, 0, 0, "", "", None, None, None,
+            record.file_hash_type, record.file_hash, record.tar_line
+        )
+
+    device = f"{member.devmajor},{member.devminor}" if member.type in ("3", "4") else None
+    return (
+        record.volume_no, record.offset, member.name, member.type, member.size, int(member.mtime), member.mode,
+        member.uid, member.gid, member.uname, member.gname, member.link_name or None, device,
+        member.continued_at if member.type == "M" else None, record.file_hash_type, record.file_hash, None
+    )
+
+
+def _record(indexer: TarIndexer, row: tuple) -> BackupRecord:
+    volume_no, offset, path, type_flag, size, mtime, mode, uid, gid, uname, gname, link_name, device, \
+        continued_at, file_hash_type, file_hash, tar_line, tape_no, tape_file_number, tape_volume_serial, \
+        hash_type, archive_hash = row
+
+    if tar_line is None:
+        member = TarMember(
+            offset=offset, type=type_flag, name=path, size=size, mode=mode, mtime=mtime, uid=uid, gid=gid,
+            uname=uname, gname=gname, link_name=link_name or "",
+            continued_at=continued_at if continued_at is not None else -1
+        )
+        if device is not None:
+            member.devmajor, member.devminor = (int(n) for n in device.split(","))
+        tar_line = indexer.tar_line(member)
+
+    return BackupRecord(
+        tape_no=tape_no,
+        volume_no=volume_no,
+        archive_hash=archive_hash,
+        hash_type=hash_type,
+        tar_line=tar_line,
+        tape_file_number=tape_file_number,
+        tape_volume_serial=tape_volume_serial,
+        offset=offset,
+        file_hash=file_hash,
+        file_hash_type=file_hash_type,
+    )
+
+
 def _compress_file(input_file: str):
     compression_cmd = ZSTD_COMPRESSION.format(
         zstd=ZSTD,
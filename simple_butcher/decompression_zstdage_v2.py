@@ -1,14 +1,17 @@
 import logging
 import os
+import shutil
 import subprocess
+import threading
 import time
-import re
 
 from config import RestoreConfig
 from common import ArchiveVolumeNumber, file_size_format, report_performance_bytes
 from database import BackupRecord
 from exe_paths import ZSTD, AGE, TEE, MBUFFER, SHA256SUM, MD5SUM
 from compression import Compression
+from mbuffer_log import MBufferLogReader
+from virtual_tape import is_virtual, start_device_process, wait_for_device_process
 
 
 class DecompressionZstdAgeV2:
@@ -18,8 +21,16 @@ class DecompressionZstdAgeV2:
     def __init__(self, test_mode=False):
         super().__init__()
         self.test_mode = test_mode
-
-    def do(self, config: RestoreConfig, archive_volume_no: ArchiveVolumeNumber) -> str:
+        self._device_process = None  # read end of a virtual tape
+
+    def do(
+            self, config: RestoreConfig, archive_volume_no: ArchiveVolumeNumber, tape_parts: int = 1,
+            change_tape=None
+    ) -> str:
+        """
+        :param tape_parts: number of tapes the volume spans (backup --span-tapes), the parts are concatenated
+        :param change_tape: called between the parts, returns when the next tape is loaded
+        """
         output_file = config.tempdir + "/%09i.tar" % archive_volume_no.volume_no
 
         if os.path.exists(output_file):
@@ -30,19 +41,20 @@ class DecompressionZstdAgeV2:
         if config.tape_dummy is not None:
             raise OSError("Unsupported.")
 
-        output_process = subprocess.Popen(
-            [MBUFFER, "-i", config.tape, "-l", mbuffer_log, "-q", "-s", "512k", "-o", "-"],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE
-        )
+        output_process = None
+        age_input = subprocess.PIPE
+        if tape_parts == 1:
+            output_process = self._start_tape_read(config, mbuffer_log)
+            age_input = output_process.stdout
 
         if self.test_mode: # we need the zstd file, as zstd -t doesn't support stdin for testing
             age_process = subprocess.Popen(
-                [AGE, "-d", "-i", config.password_file, "-o", output_file], stdin=output_process.stdout
+                [AGE, "-d", "-i", config.password_file, "-o", output_file], stdin=age_input
             )
 
         else:
             age_process = subprocess.Popen(
-                [AGE, "-d", "-i", config.password_file], stdin=output_process.stdout, stdout=subprocess.PIPE
+                [AGE, "-d", "-i", config.password_file], stdin=age_input, stdout=subprocess.PIPE
             )
 
             zstd_process = subprocess.Popen(
@@ -50,10 +62,51 @@ class DecompressionZstdAgeV2:
             )
 
         start_piping = time.time()
+        if output_process is not None:
+            self._wait_for_tape_read(output_process, mbuffer_log, start_piping)
+            return output_file
+
+        for part in range(tape_parts):
+            if part > 0:
+                change_tape()
+
+            output_process = self._start_tape_read(config, mbuffer_log)
+            pump = threading.Thread(
+                target=shutil.copyfileobj, args=(output_process.stdout, age_process.stdin, 1024 * 1024)
+            )
+            pump.start()
+            self._wait_for_tape_read(output_process, mbuffer_log, start_piping)
+            pump.join()
+
+        age_process.stdin.close()
+        return output_file
+
+    def _start_tape_read(self, config: RestoreConfig, mbuffer_log: str) -> subprocess.Popen:
+        if os.path.exists(mbuffer_log):
+            os.remove(mbuffer_log)
+
+        tape, stdin = config.tape, None
+        self._device_process = None
+        if is_virtual(config.tape):
+            stdin, write_fd = os.pipe()
+            self._device_process = start_device_process(config.tape, "read", stdout=write_fd)
+            os.close(write_fd)
+            tape = "-"
+
+        output_process = subprocess.Popen(
+            [MBUFFER, "-i", tape, "-l", mbuffer_log, "-q", "-s", "512k", "-o", "-"],
+            stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        if self._device_process is not None:
+            os.close(stdin)
+        return output_process
+
+    def _wait_for_tape_read(self, output_process: subprocess.Popen, mbuffer_log: str, start_piping: float):
         last_report_time = start_piping
+        log = MBufferLogReader(mbuffer_log)
 
         while True:
-            bytes_written, _ = self.parse_mbuffer_progress_log(mbuffer_log)
+            bytes_written, _ = log.read().progress()
 
             if time.time() - last_report_time >= 1 and bytes_written > 0:
                 last_report_time = time.time()
@@ -64,79 +117,17 @@ class DecompressionZstdAgeV2:
             if output_process.poll() is not None:
                 break
 
-        output_stdout, output_stderr = output_process.communicate()
+        # stdout belongs to age (or the pump), communicate() would read from it
+        output_stderr = output_process.stderr.read()
+        output_process.wait()
 
         if output_process.returncode != 0:
             raise OSError(output_stderr)
+        wait_for_device_process(self._device_process)
 
+        bytes_written, _ = log.read().progress()
         logging.info("C/E/xxx done with " + report_performance_bytes(start_piping, bytes_written))
 
-        return output_file
-
-    def parse_mbuffer_progress_log(self, mbuffer_log: str) -> (int, int):
-        # mbuffer: in @  164 MiB/s, out @  164 MiB/s, 3102 MiB total, buffer  99% full
-        # summary: 5119 MiByte in 37.0sec - average of  138 MiB/s
-        try:
-            with open(mbuffer_log, "r") as f:
-                lines = f.readlines()
-
-            if len(lines) <= 0:
-                return -1, -1
-
-            for line in reversed(lines):
-                if "buffer" in line:
-                    s = re.search(
-                        ", +(\\d+) +MiB total, buffer +(\\d+)% full", line, re.IGNORECASE
-                    )
-                    if s:
-                        bytes_written = int(s.group(1)) * 1000 * 1000
-                        buffer_percent = int(s.group(2))
-                        # done_percent = int(s.group(3))
-
-                        return bytes_written, buffer_percent
-        except:
-            pass
-
-        return -1, -1
-
-    def parse_mbuffer_md5(self, mbuffer_log: str) -> (str):
-        # MD5 hash: 289067bcd5472f102e946f8b71c7729b
-        try:
-            with open(mbuffer_log, "r") as f:
-                lines = f.readlines()
-
-                for line in lines:
-                    if line.startswith("MD5 hash:"):
-                        return line.replace("MD5 hash:", "").strip()
-        except:
-            pass
-
-        return None
-
-    def parse_mbuffer_summary_log(self, mbuffer_log: str) -> int:
-        # mbuffer: in @  164 MiB/s, out @  164 MiB/s, 3102 MiB total, buffer  99% full
-        # summary: 5119 MiByte in 37.0sec - average of  138 MiB/s
-        try:
-            with open(mbuffer_log, "r") as f:
-                temp = f.readlines()
-
-            if len(temp) <= 0:
-                return -1
-
-            last_line = temp[-1]
-
-            if "summary" in last_line:
-                s = re.search(
-                    "summary: +(\\d+) +MiByte in", last_line, re.IGNORECASE
-                )
-                if s:
-                    bytes_written = int(s.group(1)) * 1000 * 1000
-                    return bytes_written
-        except:
-            pass
-
-        return -1
-
     def overall_compression_ratio(self) -> float:
         return self.all_bytes_read / float(self.all_bytes_written)
 
@@ -14,6 +14,7 @@ if sys.platform == "linux":
     AGE = "/usr/bin/age"
     TEE = "/usr/bin/tee"
     MD5SUM = "/usr/bin/md5sum"
+    STDBUF = "/usr/bin/stdbuf"
 elif sys.platform == "darwin":
     TAR = "/opt/homebrew/bin/gtar"
     SEVEN_Z = "/usr/local/bin/7z"
@@ -28,6 +29,7 @@ elif sys.platform == "darwin":
     AGE = "/opt/homebrew/bin/age"
     TEE = "/usr/bin/tee"
     MD5SUM = "/usr/local/bin/md5sum"
+    STDBUF = "/opt/homebrew/bin/gstdbuf"
 elif sys.platform == "darwin" and False:
     TAR = "/usr/local/bin/gtar"
     SEVEN_Z = "/usr/local/bin/7z"
@@ -42,3 +44,4 @@ elif sys.platform == "darwin" and False:
     AGE = "/usr/local/bin/age"
     TEE = "/usr/bin/tee"
     MD5SUM = "/usr/local/bin/md5sum"
+    STDBUF = "/usr/local/bin/gstdbuf"
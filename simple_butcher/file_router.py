@@ -0,0 +1,93 @@
+import math
+import os
+from collections import Counter
+
+# already compressed formats, zstd can't do anything with them
+INCOMPRESSIBLE_EXTENSIONS = {
+    "jpg", "jpeg", "png", "gif", "webp", "heic", "heif", "avif", "jxl",
+    "mp4", "m4v", "mkv", "mov", "avi", "webm", "wmv", "mts", "m2ts",
+    "mp3", "m4a", "aac", "ogg", "oga", "opus", "flac", "wma",
+    "zip", "gz", "tgz", "bz2", "tbz2", "xz", "txz", "zst", "lz4", "lzma", "7z", "rar", "br", "age", "gpg",
+    "jar", "apk", "docx", "xlsx", "pptx", "odt", "ods", "odp", "epub",
+}
+SAMPLE_MIN_FILE_SIZE = 1024 * 1024  # smaller files are only routed by extension
+SAMPLE_SIZE = 16 * 1024
+SAMPLES = 3  # start, middle and end of the file
+INCOMPRESSIBLE_ENTROPY = 7.8  # bits per byte
+
+
+class FileRouter:
+    """
+    Splits the files of a backup into compressible files and files that are already compressed (by extension or
+    sampled entropy). Both lists are written NUL separated for tar --null --files-from. Directories go into the
+    compressible list, so tar (with --no-recursion) still archives them with their metadata.
+    """
+
+    def __init__(self, compressible_list: str, incompressible_list: str):
+        self.compressible_list = compressible_list
+        self.incompressible_list = incompressible_list
+        self.compressible_files = 0
+        self.incompressible_files = 0
+        self.incompressible_bytes = 0
+
+    def route_null_file_list(self, file_list: str):
+        """
+        Routes the NUL separated file list of the source scan or the file state index
+        """
+        def read():
+            with open(file_list, "rb") as f:
+                rest = b""
+                for data in iter(lambda: f.read(1024 * 1024), b""):
+                    *paths, rest = (rest + data).split(b"\0")
+                    for path in paths:
+                        if path:
+                            yield path.decode("UTF-8", errors="surrogateescape")
+
+        self.route(read())
+
+    def route(self, paths):
+        with open(self.compressible_list, "wb") as compressible, \
+                open(self.incompressible_list, "wb") as incompressible:
+            for path in paths:
+                entry = path.encode("UTF-8", errors="surrogateescape") + b"\0"
+                if self.is_incompressible(path):
+                    incompressible.write(entry)
+                    self.incompressible_files += 1
+                    self.incompressible_bytes += os.path.getsize(path)
+                else:
+                    compressible.write(entry)
+                    self.compressible_files += 1
+
+    def is_incompressible(self, path: str) -> bool:
+        if os.path.islink(path) or not os.path.isfile(path):
+            return False
+
+        extension = os.path.splitext(path)[1][1:].lower()
+        if extension in INCOMPRESSIBLE_EXTENSIONS:
+            return True
+
+        try:
+            size = os.path.getsize(path)
+            if size < SAMPLE_MIN_FILE_SIZE:
+                return False
+
+            return sampled_entropy(path, size) >= INCOMPRESSIBLE_ENTROPY
+        except OSError:
+            return False  # tar will report it
+
+
+def sampled_entropy(path: str, size: int) -> float:
+    """
+    Shannon entropy in bits per byte of a few samples spread over the file
+    """
+    counts = Counter()
+    with open(path, "rb") as f:
+        for i in range(SAMPLES):
+            f.seek((size - SAMPLE_SIZE) * i // max(1, SAMPLES - 1))
+            counts.update(f.read(SAMPLE_SIZE))
+
+    total = sum(counts.values())
+    if total == 0:
+        return 0
+
+    return -sum(c / total * math.log2(c / total) for c in counts.values())
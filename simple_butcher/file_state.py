@@ -0,0 +1,109 @@
+import logging
+import os
+import subprocess
+from dataclasses import dataclass
+
+from exe_paths import ZSTD
+from filesystem import sorted_walk
+
+READ_SIZE = 1024 * 1024
+
+
+@dataclass
+class FileState:
+    path: bytes
+    size: int
+    mtime_ns: int
+    ctime_ns: int
+    inode: int
+
+    def key(self) -> [bytes]:
+        return self.path.split(b"/")
+
+    def changed(self, other: "FileState") -> bool:
+        return (self.size, self.mtime_ns, self.ctime_ns, self.inode) != \
+            (other.size, other.mtime_ns, other.ctime_ns, other.inode)
+
+    def to_bytes(self) -> bytes:
+        return self.path + b"\0" + f"{self.size} {self.mtime_ns} {self.ctime_ns} {self.inode}".encode() + b"\0"
+
+
+class FileStateIndex:
+    """
+    Per repository index of (path, size, mtime_ns, ctime_ns, inode) of every backed up file, stored zstd compressed
+    and sorted like filesystem.sorted_walk() returns the files. diff() walks the source and merges it with the
+    previous index in one streaming pass, every new or changed file goes into the tar file list. Unlike find -mtime
+    this also catches files with an old mtime (moved, restored, changed metadata) and doesn't include unchanged files.
+
+    The new index is only written to <state_file>.new, commit() replaces the old one once the backup is complete.
+    """
+
+    def __init__(self, state_file: str):
+        self.state_file = state_file
+        self.new_state_file = state_file + ".new"
+        self.changed_files = 0
+        self.changed_bytes = 0
+        self.all_files = 0
+
+    def diff(self, source: str, changed_list: str, excludes: [str] = None):
+        """
+        :param excludes: patterns like tar --exclude, excluded files are neither backed up nor kept in the index
+        """
+        writer = subprocess.Popen(
+            [ZSTD, "-q", "-f", "-3", "-o", self.new_state_file], stdin=subprocess.PIPE
+        )
+
+        old_states = self._read_states()
+        old = next(old_states, None)
+        with open(changed_list, "wb") as changed:
+            for path, st in sorted_walk(source, excludes):
+                new = FileState(os.fsencode(path), st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino)
+                writer.stdin.write(new.to_bytes())
+                self.all_files += 1
+
+                key = new.key()
+                while old is not None and old.key() < key:  # removed since the last backup
+                    old = next(old_states, None)
+
+                if old is not None and old.key() == key and not old.changed(new):
+                    continue
+
+                changed.write(new.path + b"\0")
+                self.changed_files += 1
+                self.changed_bytes += new.size
+
+        old_states.close()
+        writer.stdin.close()
+        if writer.wait() != 0:
+            raise OSError(f"Writing {self.new_state_file} failed")
+
+        logging.info(
+            f"{self.changed_files} of {self.all_files} files are new or changed since the last backup."
+        )
+
+    def commit(self):
+        os.replace(self.new_state_file, self.state_file)
+
+    def _read_states(self):
+        if not os.path.exists(self.state_file):
+            return
+
+        reader = subprocess.Popen([ZSTD, "-q", "-d", "-c", self.state_file], stdout=subprocess.PIPE)
+        try:
+            rest = b""
+            while True:
+                data = reader.stdout.read(READ_SIZE)
+                if not data:
+                    break
+
+                fields = (rest + data).split(b"\0")
+                complete = len(fields) - 1
+                complete -= complete % 2  # path and stats always come in pairs
+                for i in range(0, complete, 2):
+                    size, mtime_ns, ctime_ns, inode = (int(v) for v in fields[i + 1].split(b" "))
+                    yield FileState(fields[i], size, mtime_ns, ctime_ns, inode)
+                rest = b"\0".join(fields[complete:])
+        finally:
+            reader.stdout.close()
+            reader.kill()
+            reader.wait()
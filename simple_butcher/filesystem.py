@@ -1,4 +1,10 @@
+import fnmatch
+import logging
 import os
+import queue
+import stat
+import threading
+from dataclasses import dataclass
 
 
 class Filesystem:
@@ -26,5 +32,154 @@ def walk(level: int, max_level: int, directory: str) -> int:
     return ret
 
 
+def sorted_walk(directory: str, excludes: [str] = None):
+    """
+    Yields (path, stat) of all files and symlinks below directory, depth first with the entries of every directory
+    sorted by name. Paths compare in that order when split into their components, which allows merging two walks
+    without holding them in memory. Symlinks to directories are not followed, excluded subtrees are not entered.
+    """
+    try:
+        with os.scandir(directory) as it:
+            entries = sorted(it, key=lambda e: os.fsencode(e.name))
+    except (PermissionError, FileNotFoundError) as e:
+        logging.warning(f"Skipping {directory}: {e}")
+        return
+
+    for entry in entries:
+        try:
+            if excludes and is_excluded(entry.path, excludes):
+                continue
+
+            st = entry.stat(follow_symlinks=False)
+        except OSError as e:
+            logging.warning(f"Skipping {entry.path}: {e}")
+            continue
+
+        if stat.S_ISDIR(st.st_mode):
+            yield from sorted_walk(entry.path, excludes)
+        elif stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode):
+            yield entry.path, st
+
+
+def is_excluded(path: str, excludes: [str]) -> bool:
+    """
+    Unanchored like tar --exclude: the pattern may match the whole path or any trailing part of it.
+    """
+    parts = path.split("/")
+    for pattern in excludes:
+        for i in range(len(parts)):
+            if fnmatch.fnmatchcase("/".join(parts[i:]), pattern):
+                return True
+    return False
+
+
+@dataclass
+class ScanResult:
+    files: int = 0
+    directories: int = 0
+    bytes: int = 0
+
+
+class ParallelScanner:
+    """
+    Walks a directory tree with a pool of threads, each one lists a directory with os.scandir, which costs one
+    round trip per directory instead of one per file on network shares. Excluded subtrees are never entered.
+    All paths are written NUL separated (for tar --null --files-from) and summed up, so the backup knows how many
+    bytes are coming before tar starts.
+
+    With modified_after only regular files with a newer mtime are listed (like find -type f -mtime), otherwise
+    directories are listed as well, so tar (with --no-recursion) archives them with their metadata.
+    """
+
+    def __init__(self, workers: int = 8, excludes: [str] = None, modified_after: float = None):
+        self.workers = max(1, workers)
+        self.excludes = excludes or []
+        self.modified_after = modified_after
+        self.result = ScanResult()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._out = None
+
+    def scan(self, source: str, file_list: str) -> ScanResult:
+        self.result = ScanResult()
+        with open(file_list, "wb") as self._out:
+            if self.modified_after is None:
+                self._write([os.fsencode(source)], ScanResult(directories=1))
+
+            threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(self.workers)]
+            for t in threads:
+                t.start()
+
+            self._queue.put(source)
+            self._queue.join()
+
+            for _ in threads:
+                self._queue.put(None)
+            for t in threads:
+                t.join()
+
+        return self.result
+
+    def is_excluded(self, path: str) -> bool:
+        return is_excluded(path, self.excludes)
+
+    def _worker(self):
+        while True:
+            directory = self._queue.get()
+            if directory is None:
+                return
+
+            try:
+                self._scan_directory(directory)
+            except Exception as e:
+                logging.warning(f"Scanning {directory} failed: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _scan_directory(self, directory: str):
+        paths = []
+        result = ScanResult()
+        try:
+            with os.scandir(directory) as it:
+                entries = list(it)
+        except (PermissionError, FileNotFoundError) as e:
+            logging.warning(f"Skipping {directory}: {e}")
+            return
+
+        for entry in entries:
+            try:
+                if self.excludes and self.is_excluded(entry.path):
+                    continue
+
+                st = entry.stat(follow_symlinks=False)  # cached by DirEntry
+            except OSError as e:
+                logging.warning(f"Skipping {entry.path}: {e}")
+                continue
+
+            if stat.S_ISDIR(st.st_mode):
+                self._queue.put(entry.path)
+                if self.modified_after is not None:
+                    continue
+                result.directories += 1
+            elif self.modified_after is not None and \
+                    (not stat.S_ISREG(st.st_mode) or st.st_mtime <= self.modified_after):
+                continue
+            else:
+                result.files += 1
+                result.bytes += st.st_size
+
+            paths.append(os.fsencode(entry.path))
+
+        self._write(paths, result)
+
+    def _write(self, paths: [bytes], result: ScanResult):
+        with self._lock:
+            for path in paths:
+                self._out.write(path + b"\0")
+            self.result.files += result.files
+            self.result.directories += result.directories
+            self.result.bytes += result.bytes
+
+
 if __name__ == '__main__':
     print(walk(0, -1, "/Users/augunrik/Downloads"))
@@ -0,0 +1,74 @@
+import math
+
+MIN_SAMPLES = 2  # volumes observed before the ratio is trusted
+MAX_RATIO = 1.01  # incompressible data, zstd and age add a little framing
+
+
+class RatioStats:
+    """
+    Running mean and variance (Welford) of the compression ratios of the volumes written with one setting
+    """
+
+    def __init__(self):
+        self.samples = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+
+    def observe(self, ratio: float):
+        self.samples += 1
+        delta = ratio - self._mean
+        self._mean += delta / self.samples
+        self._m2 += delta * (ratio - self._mean)
+
+    def ratio(self, confidence: float) -> float:
+        if self.samples < MIN_SAMPLES:
+            return MAX_RATIO
+
+        return min(MAX_RATIO, self._mean + confidence * self.deviation())
+
+    def deviation(self) -> float:
+        if self.samples < 2:
+            return 0.0
+        return math.sqrt(self._m2 / (self.samples - 1))
+
+
+class TapeFitPredictor:
+    """
+    Predicts the compressed size of a tar chunk before it is compressed from the compression ratios of the volumes
+    written so far: mean ratio plus confidence * standard deviation, never more than the incompressible worst case.
+    Until enough volumes are observed it assumes the worst case, like before.
+
+    The ratios are kept apart per archive set and zstd level, the incompressible files of another archive set or a
+    faster level say nothing about the next chunk. A level without enough volumes (--adaptive-zstd changes it often)
+    uses the ratios of all levels of its archive set.
+
+    The reserve is left free at the end of every tape for the early warning zone of the drive.
+    """
+
+    def __init__(self, reserve_bytes: int, confidence: float = 3.0):
+        self.reserve_bytes = reserve_bytes
+        self.confidence = confidence
+        self._stats = dict()  # (archive set, zstd level) -> RatioStats, zstd level None for all levels of the set
+
+    def observe(self, bytes_read: int, bytes_written: int, archive_set: int = 0, zstd_level: int = None):
+        if bytes_read <= 0:
+            return
+
+        ratio = bytes_written / bytes_read
+        self._stats.setdefault((archive_set, zstd_level), RatioStats()).observe(ratio)
+        if zstd_level is not None:
+            self._stats.setdefault((archive_set, None), RatioStats()).observe(ratio)
+
+    def ratio(self, archive_set: int = 0, zstd_level: int = None) -> float:
+        stats = self._stats.get((archive_set, zstd_level))
+        if stats is None or stats.samples < MIN_SAMPLES:
+            stats = self._stats.get((archive_set, None))
+        if stats is None:
+            return MAX_RATIO
+        return stats.ratio(self.confidence)
+
+    def predict(self, uncompressed_bytes: int, archive_set: int = 0, zstd_level: int = None) -> int:
+        return int(uncompressed_bytes * self.ratio(archive_set, zstd_level))
+
+    def fits(self, needed_bytes: int, remaining_bytes: int) -> bool:
+        return needed_bytes + self.reserve_bytes < remaining_bytes
@@ -0,0 +1,117 @@
+import hashlib
+import logging
+import threading
+from dataclasses import dataclass
+
+from tarindex import TarContentHasher, TarIndexError
+
+HASH_ALGORITHMS = ["blake2b", "sha256", "sha512", "sha1", "md5"]
+PUMP_BLOCK_SIZE = 1024 * 1024
+
+
+@dataclass
+class VolumeHashes:
+    plain: dict = None  # algorithm -> hex digest of the uncompressed tar chunk
+    archive: dict = None  # algorithm -> hex digest of the compressed and encrypted data on tape
+    files: dict = None  # offset of the member inside the tar chunk -> hex digest of its content
+    file_names: dict = None  # offset of the hashed members -> member name
+
+
+class MultiHash:
+    """
+    Several hashes of the same data, updated together
+    """
+
+    def __init__(self, algorithms: [str]):
+        self._hashes = {algorithm: hashlib.new(algorithm) for algorithm in algorithms or []}
+
+    def __bool__(self):
+        return bool(self._hashes)
+
+    def update(self, data):
+        for h in self._hashes.values():
+            h.update(data)
+
+    def hexdigests(self) -> dict:
+        return {algorithm: h.hexdigest() for algorithm, h in self._hashes.items()}
+
+
+class HashingPump:
+    """
+    Copies source into dest in a thread and hashes the data on the way, so the stream is read only once. Sits between
+    two processes of the pipeline (or a file and a process) where the data would otherwise flow through a pipe.
+
+    With file_hash the source is a tar chunk and the content of every file in it is hashed as well.
+    """
+
+    def __init__(self, source, dest, algorithms: [str], file_hash: str = None):
+        """
+        :param source: path or file object, closed at the end
+        :param dest: file object, closed at the end so the process behind sees the end of the stream
+        """
+        self.source = source
+        self.dest = dest
+        self.hash = MultiHash(algorithms)
+        self.file_hasher = TarContentHasher(file_hash) if file_hash is not None else None
+        self.bytes = 0
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> "HashingPump":
+        self._thread.start()
+        return self
+
+    def join(self):
+        self._thread.join()
+        if self._error is not None:
+            raise OSError(f"Hashing the stream failed: {self._error}")
+
+    def hashes(self) -> dict:
+        return self.hash.hexdigests()
+
+    def file_hashes(self) -> dict:
+        return self.file_hasher.hashes if self.file_hasher is not None else None
+
+    def file_names(self) -> dict:
+        return self.file_hasher.names if self.file_hasher is not None else None
+
+    def _run(self):
+        try:
+            source = open(self.source, "rb") if isinstance(self.source, str) else self.source
+            with source:
+                while True:
+                    block = source.read(PUMP_BLOCK_SIZE)
+                    if not block:
+                        break
+
+                    self.hash.update(block)
+                    self._hash_files(block)
+                    self.dest.write(block)
+                    self.bytes += len(block)
+        except BaseException as e:
+            self._error = e
+        finally:
+            try:
+                self.dest.close()
+            except OSError:
+                pass  # the process behind is already gone, its return code tells why
+
+    def _hash_files(self, block: bytes):
+        if self.file_hasher is None:
+            return
+
+        try:
+            self.file_hasher.feed(block)
+        except TarIndexError as e:
+            # the hasher ignores the rest of the chunk, only the file hashes are incomplete
+            logging.warning(f"Hashing the files stopped: {e}")
+
+
+def hash_file(file: str, algorithms: [str]) -> dict:
+    hashes = MultiHash(algorithms)
+    with open(file, "rb") as f:
+        while True:
+            block = f.read(PUMP_BLOCK_SIZE)
+            if not block:
+                return hashes.hexdigests()
+            hashes.update(block)
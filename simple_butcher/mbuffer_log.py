@@ -0,0 +1,90 @@
+import os
+import re
+
+# in @  164 MiB/s, out @  164 MiB/s, 3102 MiB total, buffer  99% full, 50% done
+STATUS_LINE = re.compile(
+    "in @ +([\\d.]+) ([kMGT]i)?B/s, out @ +([\\d.]+) ([kMGT]i)?B/s, +([\\d.]+) ([kMGT]i)?B total, "
+    "buffer +(\\d+)% full(?:, +(\\d+)% done)?", re.IGNORECASE
+)
+# summary: 5119 MiByte in 37.0sec - average of  138 MiB/s
+SUMMARY_LINE = re.compile("summary: +([\\d.]+) ([kMGT]i)?Byte in +([\\d.]+) ?sec", re.IGNORECASE)
+MD5_LINE = "MD5 hash:"
+
+UNITS = {None: 1, "ki": 1024, "mi": 1024 ** 2, "gi": 1024 ** 3, "ti": 1024 ** 4}
+
+
+class MBufferLogReader:
+    """
+    Follows the log of one mbuffer run (-l): every read() parses only what was appended since the last call. A new
+    log file (mbuffer started again) is detected by its inode and read from the beginning.
+
+    mbuffer reports binary units (kiB, MiB, GiB, TiB), all values are converted to bytes.
+    """
+
+    def __init__(self, mbuffer_log: str):
+        self.mbuffer_log = mbuffer_log
+        self._offset = 0
+        self._inode = None
+        self._rest = ""
+        self.reset()
+
+    def reset(self):
+        self.bytes_total = -1
+        self.buffer_percent = -1
+        self.done_percent = -1
+        self.in_rate = -1  # bytes/s
+        self.out_rate = -1
+        self.summary_bytes = -1
+        self.summary_seconds = -1
+        self.md5 = None
+
+    def read(self) -> "MBufferLogReader":
+        try:
+            with open(self.mbuffer_log, "r") as f:
+                st = os.fstat(f.fileno())
+                if st.st_ino != self._inode or st.st_size < self._offset:
+                    self._inode, self._offset, self._rest = st.st_ino, 0, ""
+                    self.reset()
+
+                f.seek(self._offset)
+                data = f.read()
+                self._offset = f.tell()
+        except OSError:
+            return self
+
+        *lines, self._rest = (self._rest + data).replace("\r", "\n").split("\n")
+        for line in lines:
+            self._parse(line)
+        return self
+
+    def progress(self) -> (int, int):
+        """
+        :return: bytes written (-1 if unknown) and fill level of the buffer in percent (-1 if unknown)
+        """
+        if self.summary_bytes >= 0:
+            return self.summary_bytes, self.buffer_percent
+        return self.bytes_total, self.buffer_percent
+
+    def _parse(self, line: str):
+        s = STATUS_LINE.search(line)
+        if s:
+            self.in_rate = _to_bytes(s.group(1), s.group(2))
+            self.out_rate = _to_bytes(s.group(3), s.group(4))
+            self.bytes_total = _to_bytes(s.group(5), s.group(6))
+            self.buffer_percent = int(s.group(7))
+            if s.group(8) is not None:
+                self.done_percent = int(s.group(8))
+            return
+
+        s = SUMMARY_LINE.search(line)
+        if s:
+            self.summary_bytes = _to_bytes(s.group(1), s.group(2))
+            self.summary_seconds = float(s.group(3))
+            return
+
+        if line.startswith(MD5_LINE):
+            self.md5 = line.replace(MD5_LINE, "").strip()
+
+
+def _to_bytes(value: str, unit: str) -> int:
+    return int(float(value) * UNITS[unit.lower() if unit else None])
@@ -1,3 +1,4 @@
+import shlex
 import subprocess
 import logging
 import threading
@@ -5,62 +6,90 @@ import os
 import time
 
 from tqdm import tqdm
-import re
 
 from base_wrapper import Wrapper
 from config import BackupConfig
 from common import ArchiveVolumeNumber, report_performance
 from database import BackupRecord
 from exe_paths import MBUFFER
+from mbuffer_log import MBufferLogReader
+from metrics import PipelineMetrics
+from tape_writer import TapeWriter
+from virtual_tape import is_virtual, start_device_process, wait_for_device_process
 
-WRITE_TO_TAPE_OPTS = "{cmd} -i {in_file} -P 90 -l {logfile} -q -o {tape}  -s {blocksize}"
+WRITE_TO_TAPE_OPTS = "{cmd} -i {in_file} -P {start_percent} -l {logfile} -q -m {memory} -o {tape} -s {blocksize} " \
+                     "--md5 --tapeaware {autoload_opts}"
 
 
 class MBufferWrapper(Wrapper):
     def __init__(self, config: BackupConfig):
         super().__init__()
         self.config = config
-
-    def write(self, archive_file):
+        self.autoload_opts = []  # to continue on the next tape at the end of the tape
+        self.metrics = PipelineMetrics()
+        self.tape_writer = None  # with config.tape_writer == "native", created on first use
+        self.on_end_of_medium = None  # called by the native tape writer to continue on the next tape
+
+    def write(self, archive_file, stats=None) -> (str, str):
+        """
+        Writes the (already compressed and encrypted) archive file to tape and removes it afterwards.
+        :param stats: PipelineStats that get the buffer fill samples
+        :return: (hash_type, hash) of the data written to tape
+        """
         if self.config.tape_dummy is not None:
-            return
+            return "None", "-"
 
         mbuffer_log = self.config.tempdir + "/mbuffer.log"
+        tape, stdout, device_process = self.config.tape, subprocess.PIPE, None
+        if is_virtual(self.config.tape):
+            read_fd, stdout = os.pipe()
+            device_process = start_device_process(self.config.tape, "write", stdin=read_fd)
+            os.close(read_fd)
+            tape = "-"
+
+        if self.config.tape_writer == "native":
+            output = stdout if device_process is not None else self.config.tape
+            return self.write_native(archive_file, output, device_process, stats)
+
         cmd = WRITE_TO_TAPE_OPTS.format(
             cmd=MBUFFER,
             in_file=archive_file,
-            tape=self.config.tape,
+            tape=tape,
+            start_percent=self.config.write_buffer_start,
             blocksize="512K",
-            logfile=mbuffer_log
+            memory=f"{self.config.write_buffer}G",
+            logfile=mbuffer_log,
+            autoload_opts=" ".join(shlex.quote(opt) for opt in self.autoload_opts)
         )
 
+        if os.path.exists(mbuffer_log):
+            os.remove(mbuffer_log)
+
         mbuffer_process = subprocess.Popen(
-            cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=1,
+            cmd, shell=True, stdout=stdout, stderr=subprocess.PIPE, bufsize=1,
             universal_newlines=True
         )
+        if device_process is not None:
+            os.close(stdout)
 
         logging.info(f"Start writing file {archive_file} to tape {self.config.tape}")
         start_time = time.time()
         # with create_tqdm(total=100, unit="%", leave=False) as pbar:
+        log = MBufferLogReader(mbuffer_log)
         last_percentage = -1
+        last_sample = start_time
         while True:
-            try:
-                with open(mbuffer_log, "r") as f:
-                    temp = f.readlines()
-                    if len(temp) > 0:
-                        last_line = temp[-1]
-                        if last_line and "%" in last_line:
-                            s = re.search("(\\d+)% done", last_line, re.IGNORECASE)
-                            if s:
-                                cur_percentage = int(s.group(1))
-                                if last_percentage != cur_percentage:
-                                    logging.info(f"Writing to tape... {cur_percentage}%")
-                                    last_percentage = cur_percentage
-                                # pbar.update(int(s.group(1)) - pbar.n)
-            except:
-                pass
-
-            time.sleep(2)
+            log.read()
+            if stats is not None:
+                stats.add_buffer_sample(log.buffer_percent)
+            self.metrics.tape_sample(log.buffer_percent, log.out_rate, time.time() - last_sample)
+            last_sample = time.time()
+            if log.done_percent >= 0 and last_percentage != log.done_percent:
+                logging.info(f"Writing to tape... {log.done_percent}%")
+                last_percentage = log.done_percent
+                # pbar.update(int(s.group(1)) - pbar.n)
+
+            time.sleep(0.5)
 
             if mbuffer_process.poll() is not None:
                 break
@@ -70,9 +99,57 @@ class MBufferWrapper(Wrapper):
         s_out, s_err = mbuffer_process.communicate()
         if mbuffer_process.returncode != 0:
             raise OSError(s_err)
+        wait_for_device_process(device_process)
+
+        os.remove(archive_file)
+
+        if log.read().md5 is None:
+            return "None", "-"
+
+        return "md5sum", log.md5.replace(" *-", "")
+
+    def write_native(self, archive_file, output, device_process, stats=None) -> (str, str):
+        """
+        Same as write() with the TapeWriter instead of mbuffer
+        :param output: tape device or the (write end of the) pipe to a virtual tape
+        """
+        if self.tape_writer is None:
+            self.tape_writer = TapeWriter.from_config(self.config)
+        writer = self.tape_writer
+        writer.on_end_of_medium = self.on_end_of_medium
 
+        file_size = os.path.getsize(archive_file)
+        last_sample, last_bytes, last_percentage = time.time(), 0, -1
+
+        def on_progress(w: TapeWriter):
+            nonlocal last_sample, last_bytes, last_percentage
+            seconds = max(time.time() - last_sample, 0.001)
+            self.metrics.tape_sample(w.buffer_percent(), int((w.bytes_written - last_bytes) / seconds), seconds)
+            last_sample, last_bytes = time.time(), w.bytes_written
+
+            done_percent = w.bytes_written * 100 // max(1, file_size)
+            if done_percent != last_percentage:
+                logging.info(f"Writing to tape... {done_percent}%")
+                last_percentage = done_percent
+
+        writer.on_progress = on_progress
+
+        logging.info(f"Start writing file {archive_file} to tape {self.config.tape}")
+        start_time = time.time()
+        try:
+            with open(archive_file, "rb", buffering=0) as f:
+                writer.write(f, output)
+        finally:
+            writer.on_progress = None
+        logging.info(f"Finished writing to tape for {report_performance(start_time, archive_file)}")
+        wait_for_device_process(device_process)
+
+        if stats is not None:
+            stats.add_tape_writer(writer)
         os.remove(archive_file)
 
+        return "md5sum", writer.md5
+
 
 if __name__ == '__main__':
     config = BackupConfig(
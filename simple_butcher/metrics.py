@@ -0,0 +1,143 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+PREFIX = "simple_butcher_"
+# name: (prometheus type, help)
+METRICS = {
+    "bytes_in_total": ("counter", "Bytes the stage read"),
+    "bytes_out_total": ("counter", "Bytes the stage wrote"),
+    "stall_seconds_total": ("counter", "Seconds the stage waited for its input or for room in its output"),
+    "volumes_total": ("counter", "Volumes the stage finished"),
+    "buffer_empty_events_total": ("counter", "Times the mbuffer in front of the tape ran empty (drive underruns)"),
+    "buffer_fill_percent": ("gauge", "Fill level of the mbuffer in front of the tape"),
+    "rate_bytes": ("gauge", "Current throughput in bytes/s"),
+    "compression_ratio": ("gauge", "Compressed / uncompressed bytes of the volumes so far"),
+    "queue_depth": ("gauge", "Chunks waiting in front of the stage"),
+    "zstd_level": ("gauge", "zstd level of the current volume"),
+}
+
+
+class PipelineMetrics:
+    """
+    Counters and gauges per pipeline stage (scan, tar, compress, tape, ...). A background thread publishes them every
+    interval as a Prometheus textfile (for the node_exporter textfile collector) and as a line of a JSON lines file,
+    events (e.g. a finished volume) are appended to the JSON lines file right away.
+
+    Without textfile and JSON lines file nothing is published, the calls are cheap enough to stay in the pipeline.
+    """
+
+    def __init__(self, textfile: str = None, jsonl_file: str = None, labels: dict = None, interval: float = 10):
+        self.textfile = textfile
+        self.jsonl_file = jsonl_file
+        self.labels = labels if labels is not None else dict()
+        self.interval = interval
+        self._values = dict()  # stage -> name -> value
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def enabled(self) -> bool:
+        return self.textfile is not None or self.jsonl_file is not None
+
+    def add(self, stage: str, name: str, value: float):
+        with self._lock:
+            stage_values = self._values.setdefault(stage, dict())
+            stage_values[name] = stage_values.get(name, 0) + value
+
+    def set(self, stage: str, name: str, value: float):
+        with self._lock:
+            self._values.setdefault(stage, dict())[name] = value
+
+    @contextmanager
+    def stall(self, stage: str):
+        """
+        Counts the time spent in the block as stall of the stage
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, "stall_seconds_total", time.time() - start)
+
+    def tape_sample(self, buffer_percent: int, rate: int, seconds: float):
+        """
+        Fill level of the mbuffer in front of the tape. If it is empty the drive waits for data, the time since the
+        last sample counts as stall of the tape.
+        """
+        if buffer_percent < 0:
+            return
+
+        self.set("tape", "buffer_fill_percent", buffer_percent)
+        self.set("tape", "rate_bytes", rate)
+        if buffer_percent == 0:
+            self.add("tape", "stall_seconds_total", seconds)
+
+    def event(self, event_type: str, **fields):
+        if self.jsonl_file is None:
+            return
+
+        self._append_jsonl({"time": time.time(), "type": event_type, **self.labels, **fields})
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {stage: dict(values) for stage, values in self._values.items()}
+
+    def start(self):
+        if not self.enabled():
+            return
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.enabled():
+            self.publish()
+
+    def publish(self):
+        values = self.snapshot()
+        try:
+            if self.textfile is not None:
+                self._write_textfile(values)
+            if self.jsonl_file is not None:
+                self._append_jsonl({"time": time.time(), "type": "sample", **self.labels, "stages": values})
+        except OSError as e:
+            logging.warning(f"Publishing metrics failed: {e}")
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.publish()
+
+    def _write_textfile(self, values: dict):
+        lines = []
+        for name, (metric_type, metric_help) in METRICS.items():
+            samples = [(stage, stage_values[name]) for stage, stage_values in values.items() if name in stage_values]
+            if not samples:
+                continue
+
+            lines.append(f"# HELP {PREFIX}{name} {metric_help}")
+            lines.append(f"# TYPE {PREFIX}{name} {metric_type}")
+            for stage, value in samples:
+                labels = ",".join(f'{k}="{_escape(v)}"' for k, v in {**self.labels, "stage": stage}.items())
+                lines.append(f"{PREFIX}{name}{{{labels}}} {value}")
+
+        # the collector must never see a half written file
+        with open(self.textfile + ".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(self.textfile + ".tmp", self.textfile)
+
+    def _append_jsonl(self, record: dict):
+        with self._lock:
+            with open(self.jsonl_file, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
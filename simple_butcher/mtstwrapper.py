@@ -12,6 +12,7 @@ from config import BackupConfig
 from common import ArchiveVolumeNumber, report_performance
 from database import BackupRecord
 from exe_paths import MT_ST
+from virtual_tape import is_virtual, tool_cmd
 
 CMD = "{exe} -f {tape} {cmd}"
 
@@ -27,17 +28,7 @@ class MTSTWrapper(Wrapper):
             return -1, -1, -1
 
         output = self._exec("status")
-        output_lines = output.decode("UTF-8").split(os.linesep)
-
-        for line in output_lines:
-            # File number=1, block number=0, partition=0
-            s = re.search(
-                "File number=(\\d+), block number=(\\d+), partition=(\\d+)", line, re.IGNORECASE
-            )
-            if s:
-                return int(s.group(1)), int(s.group(2)), int(s.group(3))
-
-        return -1, -1, -1
+        return parse_position(output.decode("UTF-8"))
 
     def move_to_file(self, file_no: int):
         if self._tape_dummy is not None:
@@ -49,15 +40,47 @@ class MTSTWrapper(Wrapper):
         logging.info(f"Moving head to the beginning of {file_no} ...")
         self._exec(f"fsf {file_no}")
 
+    def skip_to_file(self, file_no: int):
+        """
+        Like move_to_file, but without rewinding if the file is ahead of the current position (fsf from there)
+        """
+        if self._tape_dummy is not None:
+            return
+
+        current_file, current_block, _ = self.current_position()
+        if current_file == file_no and current_block == 0:
+            return
+
+        if 0 <= current_file < file_no:
+            logging.info(f"Moving head {file_no - current_file} files forward to the beginning of {file_no} ...")
+            self._exec(f"fsf {file_no - current_file}")
+            return
+
+        self.move_to_file(file_no)
+
     def _exec(self, mtst_cmd) -> str:
         cmd = CMD.format(
             exe=MT_ST,
             tape=self._tape,
             cmd=mtst_cmd
         )
+        if is_virtual(self._tape):
+            cmd = tool_cmd(self._tape, mtst_cmd)
 
         return subprocess.check_output(cmd, shell=True)
 
 
+def parse_position(mt_status_output: str) -> (int, int, int):
+    for line in mt_status_output.split(os.linesep):
+        # File number=1, block number=0, partition=0
+        s = re.search(
+            "File number=(\\d+), block number=(\\d+), partition=(\\d+)", line, re.IGNORECASE
+        )
+        if s:
+            return int(s.group(1)), int(s.group(2)), int(s.group(3))
+
+    return -1, -1, -1
+
+
 if __name__ == '__main__':
     print(MTSTWrapper("/dev/nst0", None).current_position())
@@ -1,4 +1,6 @@
+import logging
 import os
+import socket
 import time
 
 # import zmq
@@ -45,3 +47,75 @@ class SimpleMq:
 
     def signal_tar_to_continue(self):
         os.remove(self.communication_file)
+
+
+class SocketMq:
+    """
+    Same interface as SimpleMq, but the communication file is a unix domain socket. archive_finalizer.py connects,
+    sends the volume number tar is about to start and blocks until it is acknowledged, so neither side polls.
+    """
+
+    def __init__(self, communication_file: str, timeout: float = 1.0, message_type: str = "VOLUME"):
+        self.communication_file = communication_file
+        self.timeout = timeout
+        self.message_type = message_type
+        self.volume_no = None
+        self._server = None
+        self._connection = None
+
+    def cleanup(self):
+        self.close()
+
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self.communication_file)
+        self._server.listen(1)
+
+    def wait_for_signal(self) -> bool:
+        """
+        Blocks at most timeout seconds, so the caller can check if tar is still alive in between.
+        """
+        if self._connection is not None:
+            return True
+
+        self._server.settimeout(self.timeout)
+        try:
+            connection, _ = self._server.accept()
+        except socket.timeout:
+            return False
+
+        connection.settimeout(None)
+        message = connection.makefile("r").readline().split()
+        if len(message) != 2 or message[0] != self.message_type:
+            logging.warning(f"Unexpected message from archive finalizer: {message}")
+            connection.close()
+            return False
+
+        self.volume_no = message[1]
+        self._connection = connection
+        logging.debug(f"tar finished volume, next is {self.volume_no}")
+        return True
+
+    def signal_tar_to_continue(self):
+        connection, self._connection = self._connection, None
+        try:
+            connection.sendall(f"ACK {self.volume_no}\n".encode("UTF-8"))
+        finally:
+            connection.close()
+
+    def reject(self):
+        """
+        Closes the connection without acknowledging, the finalizer exits with an error.
+        """
+        connection, self._connection = self._connection, None
+        if connection is not None:
+            connection.close()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        if os.path.exists(self.communication_file):
+            os.remove(self.communication_file)
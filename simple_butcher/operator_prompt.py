@@ -0,0 +1,54 @@
+import queue
+import threading
+from dataclasses import dataclass, field
+
+
+@dataclass
+class PromptRequest:
+    message: str
+    answered: threading.Event = field(default_factory=threading.Event)
+    answer: str = None
+    error: BaseException = None
+
+
+class MainThreadPrompt:
+    """
+    input() for worker threads: the span listener and the tape writer threads can reach the end of the tape while
+    the main thread waits for the pipeline. They queue their question and block, the main thread answers it with
+    serve() from its polling loops. Ctrl+C at the prompt ends up in the main thread as usual.
+    """
+
+    def __init__(self):
+        self._requests = queue.Queue()
+
+    def ask(self, message: str) -> str:
+        if threading.current_thread() is threading.main_thread():
+            return input(message)
+
+        request = PromptRequest(message)
+        self._requests.put(request)
+        request.answered.wait()
+        if request.error is not None:
+            raise OSError(f"Prompt was not answered: {request.error!r}")
+        return request.answer
+
+    def serve(self):
+        """
+        Answers all waiting questions, does nothing outside of the main thread.
+        """
+        if threading.current_thread() is not threading.main_thread():
+            return
+
+        while True:
+            try:
+                request = self._requests.get_nowait()
+            except queue.Empty:
+                return
+
+            try:
+                request.answer = input(request.message)
+            except BaseException as e:
+                request.error = e
+                raise
+            finally:
+                request.answered.set()
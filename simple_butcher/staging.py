@@ -0,0 +1,143 @@
+import shutil
+import threading
+import time
+from dataclasses import dataclass
+
+from database import BackupRecord
+from hashing import VolumeHashes
+
+FREE_SPACE_RECHECK_SECONDS = 5
+
+
+@dataclass
+class StagedChunk:
+    volume_no: int
+    tar_file: str
+    tar_file_size: int
+    compressed_file: str = None
+    compressed_file_size: int = 0
+    records: [BackupRecord] = None
+    zstd_level: int = None
+    compression_duration: float = 0
+    hashes: VolumeHashes = None
+
+
+class StagingQueue:
+    """
+    Bounded queue of tar chunks staged in the tempdir. Chunks move from tar (producer) to the compressor and from
+    there to the tape writer, which gets them strictly in volume order.
+
+    wait_for_room() is the backpressure for tar: it blocks while the configured number of chunks is already staged
+    or the scratch drive doesn't have enough free space for the next chunk.
+    """
+
+    def __init__(self, tempdir: str, max_chunks: int, required_free_bytes: int):
+        self.tempdir = tempdir
+        self.max_chunks = max(1, max_chunks)
+        self.required_free_bytes = required_free_bytes
+        self._cond = threading.Condition()
+        self._staged = list()
+        self._compressed = dict()
+        self._compressing = 0
+        self._in_flight = 0
+        self._next_volume_no = None
+        self._closed = False
+        self._error = None
+
+    def put(self, chunk: StagedChunk):
+        with self._cond:
+            if self._next_volume_no is None:
+                self._next_volume_no = chunk.volume_no
+            self._staged.append(chunk)
+            self._in_flight += 1
+            self._cond.notify_all()
+
+    def wait_for_room(self, timeout: float = None) -> bool:
+        """
+        :return: False if there is still no room after timeout seconds
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._error is None:
+                wait_seconds = None if deadline is None else deadline - time.time()
+                if wait_seconds is not None and wait_seconds <= 0:
+                    return False
+                if len(self._staged) >= self.max_chunks:
+                    self._cond.wait(timeout=wait_seconds)
+                # if nothing is in flight, nobody will free space for us, so let tar try anyway
+                elif self._in_flight > 0 and self.free_bytes() < self.required_free_bytes:
+                    self._cond.wait(timeout=min(wait_seconds or FREE_SPACE_RECHECK_SECONDS, FREE_SPACE_RECHECK_SECONDS))
+                else:
+                    break
+        self.raise_if_failed()
+        return True
+
+    def depth(self) -> (int, int):
+        """
+        :return: chunks waiting for the compressor, compressed chunks waiting for the tape writer
+        """
+        with self._cond:
+            return len(self._staged), len(self._compressed)
+
+    def get(self) -> StagedChunk:
+        """
+        Next chunk for the compressor, None if tar is done and all chunks are taken.
+        """
+        with self._cond:
+            while not self._staged and not self._closed and self._error is None:
+                self._cond.wait()
+
+            if not self._staged or self._error is not None:
+                return None
+
+            self._compressing += 1
+            chunk = self._staged.pop(0)
+            self._cond.notify_all()
+            return chunk
+
+    def put_compressed(self, chunk: StagedChunk):
+        with self._cond:
+            self._compressing -= 1
+            self._compressed[chunk.volume_no] = chunk
+            self._cond.notify_all()
+
+    def get_compressed(self) -> StagedChunk:
+        """
+        Next compressed chunk in volume order for the tape writer, None if everything has been written.
+        """
+        with self._cond:
+            while self._error is None:
+                if self._next_volume_no in self._compressed:
+                    chunk = self._compressed.pop(self._next_volume_no)
+                    self._next_volume_no += 1
+                    return chunk
+
+                if self._closed and not self._staged and self._compressing == 0 and not self._compressed:
+                    return None
+
+                self._cond.wait()
+
+            return None
+
+    def done(self, chunk: StagedChunk):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def fail(self, error: BaseException):
+        with self._cond:
+            if self._error is None:
+                self._error = error
+            self._cond.notify_all()
+
+    def raise_if_failed(self):
+        if self._error is not None:
+            raise OSError("Staged backup pipeline failed") from self._error
+
+    def free_bytes(self) -> int:
+        return shutil.disk_usage(self.tempdir).free
@@ -0,0 +1,58 @@
+import logging
+import threading
+from dataclasses import dataclass, field
+
+from myzmq import SocketMq
+
+TAPE_BLOCK_SIZE = 512 * 1024  # mbuffer -s 512k
+AUTOLOAD_OPTS = ["-n", "0", "-A", 'python -S simple_butcher/archive_finalizer.py "{communication_file}" TAPE_FULL']
+
+
+@dataclass
+class TapeSpan:
+    tape_no: int  # tape the volume starts on
+    tape_file_number: int  # file number of the volume on that tape
+    tape_serials: [str] = field(default_factory=list)  # all tapes the volume is on, in order
+    split_bytes: [int] = field(default_factory=list)  # bytes of the volume on every tape but the last
+
+
+class TapeSpanListener:
+    """
+    Answers the autoload requests of mbuffer: with --tapeaware mbuffer writes until the early warning of the drive
+    and then calls the autoload command, which signals over the socket and blocks until on_tape_full() returns.
+    mbuffer continues the same tape file on the next tape afterwards.
+    """
+
+    def __init__(self, communication_file: str, on_tape_full):
+        self.com = SocketMq(communication_file, message_type="TAPE_FULL")
+        self.on_tape_full = on_tape_full
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def autoload_opts(self) -> [str]:
+        return [opt.format(communication_file=self.com.communication_file) for opt in AUTOLOAD_OPTS]
+
+    def start(self):
+        self.com.cleanup()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.com.close()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            if not self.com.wait_for_signal():
+                continue
+
+            try:
+                self.on_tape_full()
+            except BaseException as e:
+                logging.error(f"Tape change failed: {e}")
+                self.com.reject()  # mbuffer aborts
+                continue
+
+            self.com.signal_tar_to_continue()
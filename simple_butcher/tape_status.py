@@ -0,0 +1,162 @@
+import logging
+import os
+import subprocess
+
+from exe_paths import SG_LOGS, MT_ST
+from mtstwrapper import parse_position
+from tapeinfowrapper import SizeInfo, parse_size_statistics, parse_volume_serial
+from virtual_tape import VirtualTape, is_virtual, virtual_directory
+
+VOLUME_STATISTICS_PAGE = "0x17"  # volume serial number
+TAPE_CAPACITY_PAGE = "0x31"  # remaining and maximum capacity
+
+LOG_PAGES_CMD = '{cmd} --page={page} {tape}'
+STATUS_CMD = '{cmd} -f {tape} status'
+
+
+class CommandTapeBackend:
+    """
+    Queries the drive with sg_logs and mt-st. Only the needed log pages are read, both in one shell call.
+    """
+
+    def __init__(self, tape: str):
+        self.tape = tape
+
+    def log_pages(self, pages: [str]) -> str:
+        cmd = "; ".join(LOG_PAGES_CMD.format(cmd=SG_LOGS, page=page, tape=self.tape) for page in pages)
+        return subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout.decode("UTF-8")
+
+    def status(self) -> str:
+        cmd = STATUS_CMD.format(cmd=MT_ST, tape=self.tape)
+        return subprocess.check_output(cmd, shell=True).decode("UTF-8")
+
+
+class FixtureTapeBackend:
+    """
+    Returns recorded outputs (sg_logs.txt, mt_status.txt) from a directory, the files can be replaced while running.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.queries = 0
+
+    def log_pages(self, pages: [str]) -> str:
+        return self._read("sg_logs.txt")
+
+    def status(self) -> str:
+        return self._read("mt_status.txt")
+
+    def _read(self, name: str) -> str:
+        self.queries += 1
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):
+            return ""
+        with open(path, "r") as f:
+            return f.read()
+
+
+class VirtualTapeBackend:
+    """
+    Asks the virtual tape (--tape virtual:<directory>) directly, without starting the stand-in commands.
+    """
+
+    def __init__(self, tape: str):
+        self.virtual_tape = VirtualTape(virtual_directory(tape))
+
+    def log_pages(self, pages: [str]) -> str:
+        return self.virtual_tape.sg_logs()
+
+    def status(self) -> str:
+        return self.virtual_tape.status()
+
+
+class TapeStatus:
+    """
+    Cached view of the loaded tape. The serial is kept until the tape changes, capacity and position are refreshed
+    from the drive only at the start, after a tape change and if a decision depends on them (tape nearly full,
+    block position at the end of the tape). In between they are estimated from the bytes the pipeline wrote.
+
+    Without a backend (tape dummy) everything is unknown, like the wrappers report it.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend
+        self._serial = None
+        self._size = None
+        self._position = None
+
+    @staticmethod
+    def from_config(config) -> "TapeStatus":
+        if config.tape_dummy is not None:
+            return TapeStatus()
+        if getattr(config, "tape_fixture", None):
+            return TapeStatus(FixtureTapeBackend(config.tape_fixture))
+        if is_virtual(config.tape):
+            return TapeStatus(VirtualTapeBackend(config.tape))
+        return TapeStatus(CommandTapeBackend(config.tape))
+
+    def refresh(self):
+        if self.backend is None:
+            return
+
+        logs = self.backend.log_pages([VOLUME_STATISTICS_PAGE, TAPE_CAPACITY_PAGE])
+        self._serial = parse_volume_serial(logs)
+        self._size = parse_size_statistics(logs)
+        self._position = parse_position(self.backend.status())
+
+    def refresh_capacity(self):
+        if self.backend is None:
+            return
+
+        self._size = parse_size_statistics(self.backend.log_pages([TAPE_CAPACITY_PAGE]))
+
+    def volume_serial(self, refresh: bool = False) -> str:
+        if self.backend is None:
+            return ""
+        if refresh or self._serial is None:
+            self.refresh()
+        return self._serial
+
+    def size_statistics(self) -> SizeInfo:
+        if self.backend is None:
+            return SizeInfo()
+        if self._size is None:
+            self.refresh()
+        return self._size
+
+    def remaining_bytes(self, refresh_below: int = 0) -> int:
+        """
+        :param refresh_below: asks the drive if the estimate is below, the decision is close
+        """
+        size = self.size_statistics()
+        if self.backend is not None and size.remaining_bytes < refresh_below:
+            self.refresh_capacity()
+            size = self._size
+        return size.remaining_bytes
+
+    def position(self, refresh: bool = False) -> (int, int, int):
+        """
+        :return: file number, block number, partition
+        """
+        if self.backend is None:
+            return -1, -1, -1
+        if refresh or self._position is None:
+            self._position = parse_position(self.backend.status())
+        return self._position
+
+    def file_written(self, bytes_on_tape: int):
+        """
+        A tape file was written (and closed with a file mark) by the pipeline.
+        """
+        if self.backend is None:
+            return
+
+        if self._position is not None and self._position[0] >= 0:  # unknown stays unknown, asked after the write
+            self._position = (self._position[0] + 1, 0, self._position[2])
+
+        size = self._size
+        if size is not None and size.remaining_bytes >= 0:
+            self._size = SizeInfo(
+                max(0, size.remaining_bytes - bytes_on_tape), size.written_bytes + bytes_on_tape, size.maximum_bytes
+            )
+        logging.debug(f"Estimated tape status: position={self._position}, {self._size}")
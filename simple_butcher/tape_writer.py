@@ -0,0 +1,319 @@
+import errno
+import hashlib
+import logging
+import mmap
+import os
+import stat
+import threading
+import time
+
+from config import BackupConfig
+from hashing import MultiHash
+
+DEFAULT_BLOCK_SIZE = 512 * 1024  # like mbuffer -s 512k
+PROGRESS_INTERVAL = 0.1  # seconds between two on_progress calls
+
+
+class RingBuffer:
+    """
+    Fixed size blocks in one page aligned (mmap) memory area. The reader fills free blocks, the writer takes filled
+    blocks in order. Memory is only committed by the OS when a block is used the first time.
+    """
+
+    def __init__(self, size: int, block_size: int):
+        self.block_size = block_size
+        self.blocks = max(2, size // block_size)
+        self._memory = mmap.mmap(-1, self.blocks * block_size)
+        self._view = memoryview(self._memory)
+        self._lengths = [0] * self.blocks
+        self._cond = threading.Condition()
+        self.reset()
+
+    def reset(self):
+        with self._cond:
+            self._head = 0  # next block the reader fills
+            self._tail = 0  # next block the writer takes
+            self._count = 0
+            self._eof = False
+            self._error = None
+
+    def fill_percent(self) -> int:
+        return self._count * 100 // self.blocks
+
+    def ended(self) -> bool:
+        return self._eof
+
+    def is_empty(self) -> bool:
+        """
+        True if no block is buffered and more are still to come
+        """
+        with self._cond:
+            return self._count == 0 and not self._eof
+
+    def acquire_free(self) -> memoryview:
+        with self._cond:
+            while self._count >= self.blocks and self._error is None:
+                self._cond.wait()
+            self._raise_if_failed()
+            return self._view[self._head * self.block_size:(self._head + 1) * self.block_size]
+
+    def commit(self, length: int):
+        with self._cond:
+            self._lengths[self._head] = length
+            self._head = (self._head + 1) % self.blocks
+            self._count += 1
+            self._cond.notify_all()
+
+    def acquire_filled(self, min_blocks: int) -> memoryview:
+        """
+        Waits until at least min_blocks are filled (or the input ended), None if everything was taken.
+        """
+        with self._cond:
+            while self._count < min_blocks and not self._eof and self._error is None:
+                self._cond.wait()
+            self._raise_if_failed()
+            if self._count == 0:
+                return None
+
+            start = self._tail * self.block_size
+            return self._view[start:start + self._lengths[self._tail]]
+
+    def release(self):
+        with self._cond:
+            self._tail = (self._tail + 1) % self.blocks
+            self._count -= 1
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._eof = True
+            self._cond.notify_all()
+
+    def fail(self, error: BaseException):
+        with self._cond:
+            if self._error is None:
+                self._error = error
+            self._cond.notify_all()
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise self._error
+
+
+class TapeWriter:
+    """
+    Writes a stream to the tape in fixed size blocks, replaces mbuffer in the pipeline. A reader thread fills the
+    ring buffer, writing starts when it is filled to start_percent (and again after it ran empty), so the drive
+    streams instead of stopping and repositioning.
+
+    Bytes written, fill level, md5 and the hashes are counted exactly while writing. on_progress(writer) is called
+    every PROGRESS_INTERVAL, on_end_of_medium(writer) when the drive reports the end of the tape: the tape file is
+    closed, the callback returns once the next tape is loaded and the rest of the stream goes into a new tape file on
+    it. Without callback the end of the tape is an error.
+    """
+
+    def __init__(
+            self, buffer_bytes: int, block_size: int = DEFAULT_BLOCK_SIZE, start_percent: int = 90,
+            on_progress=None, on_end_of_medium=None, hash_algorithms: [str] = None
+    ):
+        self.ring = RingBuffer(buffer_bytes, block_size)
+        self.block_size = block_size
+        self.start_blocks = max(1, self.ring.blocks * start_percent // 100)
+        self.on_progress = on_progress
+        self.on_end_of_medium = on_end_of_medium
+        self.hash_algorithms = hash_algorithms  # besides md5, e.g. sha256
+        self._reset()
+
+    @classmethod
+    def from_config(cls, config: BackupConfig) -> "TapeWriter":
+        return cls(
+            config.write_buffer * 1024 * 1024 * 1024, start_percent=config.write_buffer_start,
+            hash_algorithms=config.hashes
+        )
+
+    def _reset(self):
+        self.bytes_written = 0
+        self.tape_bytes = 0  # on the current tape
+        self.split_bytes = []  # bytes on every full tape, if the stream continued on the next tape
+        self.buffer_fill_min = -1
+        self.buffer_fill_avg = -1
+        self.buffer_fill_samples = 0
+        self.underruns = 0  # the buffer ran empty while the input wasn't finished
+        self.md5 = None
+        self.hashes = None  # algorithm -> hex digest
+        self.duration = 0
+        self._md5 = hashlib.md5()
+        self._hashes = MultiHash(self.hash_algorithms)
+        self._fd = None
+
+    def buffer_percent(self) -> int:
+        return self.ring.fill_percent()
+
+    def write(self, source, output) -> "TapeWriter":
+        """
+        :param source: file object or file descriptor, read until EOF
+        :param output: path of the tape device (or a file), or an open file descriptor that is closed afterwards.
+            Only a path can be opened again on the next tape.
+        """
+        self._reset()
+        self.ring.reset()
+        start = time.time()
+
+        reader = threading.Thread(target=self._read, args=(source,), daemon=True)
+        reader.start()
+
+        self._fd = output if isinstance(output, int) else _open_output(output)
+        try:
+            self._write_blocks(output)
+        except BaseException as e:
+            self.ring.fail(e)  # unblocks the reader
+            raise
+        finally:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            reader.join()
+
+        self.md5 = self._md5.hexdigest()
+        self.hashes = self._hashes.hexdigests()
+        self.duration = time.time() - start
+        self._progress()
+        return self
+
+    def _write_blocks(self, output):
+        last_progress = 0
+        min_blocks = self.start_blocks
+        emptied = False
+        while True:
+            block = self.ring.acquire_filled(min_blocks)
+            if block is None:
+                return
+            if emptied:
+                self.underruns += 1  # the buffer ran empty while more data was still to come
+
+            self._sample_fill()
+            self._write_block(output, block)
+            self._md5.update(block)
+            self._hashes.update(block)
+            self.bytes_written += len(block)
+            self.ring.release()
+
+            # after an underrun let the buffer fill up again instead of writing every block as it arrives
+            emptied = self.ring.is_empty()
+            min_blocks = self.start_blocks if emptied else 1
+
+            if time.time() - last_progress >= PROGRESS_INTERVAL:
+                last_progress = time.time()
+                self._progress()
+
+    def _write_block(self, output, block: memoryview):
+        written = 0
+        while written < len(block):
+            try:
+                n = os.write(self._fd, block[written:])
+            except OSError as e:
+                if e.errno != errno.ENOSPC:
+                    raise
+                n = 0
+
+            if n > 0:
+                written += n
+                self.tape_bytes += n
+                continue
+
+            self._end_of_medium(output)
+
+    def _end_of_medium(self, output):
+        if self.on_end_of_medium is None or isinstance(output, int):
+            raise OSError(errno.ENOSPC, f"End of medium after {self.bytes_written} bytes")
+
+        logging.info(f"End of medium after {self.tape_bytes} bytes on this tape")
+        os.close(self._fd)  # writes the file mark
+        self._fd = None
+        self.split_bytes.append(self.tape_bytes)
+        self.tape_bytes = 0
+        self.on_end_of_medium(self)
+        self._fd = _open_output(output)
+
+    def _read(self, source):
+        try:
+            while True:
+                block = self.ring.acquire_free()
+                n = _read_full(source, block)
+                if n > 0:
+                    self.ring.commit(n)
+                if n < len(block):
+                    break
+            self.ring.close()
+        except BaseException as e:
+            self.ring.fail(e)
+
+    def _sample_fill(self):
+        fill = self.ring.fill_percent()
+        if self.buffer_fill_samples == 0 or fill < self.buffer_fill_min:
+            self.buffer_fill_min = fill
+        self.buffer_fill_avg = (self.buffer_fill_avg * self.buffer_fill_samples + fill) / (self.buffer_fill_samples + 1)
+        self.buffer_fill_samples += 1
+
+    def _progress(self):
+        if self.on_progress is not None:
+            self.on_progress(self)
+
+
+class TapeWriterProcess:
+    """
+    Runs a TapeWriter in a thread behind the subset of the subprocess.Popen interface the pipeline uses for mbuffer
+    (poll, communicate, returncode), the writer itself is available for progress and statistics.
+    """
+
+    def __init__(self, writer: TapeWriter, source, output):
+        self.writer = writer
+        self.returncode = None
+        self._source = source
+        self._error = None
+        self._thread = threading.Thread(target=self._run, args=(output,), daemon=True)
+        self._thread.start()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        self._thread.join()
+        return self.returncode
+
+    def communicate(self) -> (bytes, bytes):
+        self.wait()
+        return b"", self._error
+
+    def _run(self, output):
+        try:
+            self.writer.write(self._source, output)
+            self.returncode = 0
+        except BaseException as e:
+            self._error = str(e).encode("UTF-8")
+            self.returncode = 1
+        finally:
+            self._source.close()  # the process in front gets SIGPIPE if we failed
+
+
+def _open_output(output: str) -> int:
+    flags = os.O_WRONLY
+    if not os.path.exists(output) or not stat.S_ISCHR(os.stat(output).st_mode):
+        flags |= os.O_CREAT | os.O_TRUNC  # a regular file instead of a tape
+    return os.open(output, flags, 0o644)
+
+
+def _read_full(source, block: memoryview) -> int:
+    """
+    Reads until the block is full or the source ended, pipes return less than asked for.
+    """
+    read = 0
+    while read < len(block):
+        if isinstance(source, int):
+            n = os.readv(source, [block[read:]])
+        else:
+            n = source.readinto(block[read:])
+        if not n:
+            break
+        read += n
+    return read
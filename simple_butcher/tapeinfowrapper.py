@@ -8,6 +8,7 @@ from config import BackupConfig
 from common import ArchiveVolumeNumber
 from database import BackupRecord
 from exe_paths import SG_LOGS, TAPEINFO
+from virtual_tape import is_virtual, tool_cmd
 
 TAPE_CMD = '{cmd} -f {tape}'
 LOG_CMD = '{cmd} -a {tape}'
@@ -38,6 +39,8 @@ class TapeinfoWrapper(Wrapper):
             cmd=TAPEINFO,
             tape=self.config.tape
         )
+        if is_virtual(self.config.tape):
+            cmd = tool_cmd(self.config.tape, "tapeinfo")
         tape_process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         s_out, s_err = tape_process.communicate()
 
@@ -56,42 +59,51 @@ class TapeinfoWrapper(Wrapper):
             cmd=SG_LOGS,
             tape=self.config.tape
         )
+        if is_virtual(self.config.tape):
+            cmd = tool_cmd(self.config.tape, "sg_logs")
         tape_process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         s_out, s_err = tape_process.communicate()
 
-        needle = "Volume serial number:"
-        lines = s_out.decode("UTF-8").split(os.linesep)
-        for line in lines:
-            if needle in line:
-                return str(line).replace(needle, "").strip()
-
-        return ""
+        return parse_volume_serial(s_out.decode("UTF-8"))
 
     def size_statistics(self) -> SizeInfo:
         if self.config.tape_dummy:
             return SizeInfo()
 
-        remaining_capa_line = "Main partition remaining capacity (in MiB): "
-        maximum_size_line = "Main partition maximum capacity (in MiB): "
-
         cmd = LOG_CMD.format(
             cmd=SG_LOGS,
             tape=self.config.tape
         )
+        if is_virtual(self.config.tape):
+            cmd = tool_cmd(self.config.tape, "sg_logs")
         log_process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         s_out, s_err = log_process.communicate()
 
-        remaining_bytes = -1
-        maximum_bytes = -1
-        lines = s_out.decode("UTF-8").split(os.linesep)
-        for line in lines:
-            if remaining_capa_line in line:
-                remaining_bytes = int(line.replace(remaining_capa_line, "")) * 1024 * 1024
-            if maximum_size_line in line:
-                maximum_bytes = int(line.replace(maximum_size_line, "")) * 1024 * 1024
+        return parse_size_statistics(s_out.decode("UTF-8"))
+
+
+def parse_volume_serial(sg_logs_output: str) -> str:
+    needle = "Volume serial number:"
+    for line in sg_logs_output.split(os.linesep):
+        if needle in line:
+            return str(line).replace(needle, "").strip()
+
+    return ""
+
+
+def parse_size_statistics(sg_logs_output: str) -> SizeInfo:
+    remaining_capa_line = "Main partition remaining capacity (in MiB): "
+    maximum_size_line = "Main partition maximum capacity (in MiB): "
+
+    remaining_bytes = -1
+    maximum_bytes = -1
+    for line in sg_logs_output.split(os.linesep):
+        if remaining_capa_line in line:
+            remaining_bytes = int(line.replace(remaining_capa_line, "")) * 1024 * 1024
+        if maximum_size_line in line:
+            maximum_bytes = int(line.replace(maximum_size_line, "")) * 1024 * 1024
 
-        ret = SizeInfo(remaining_bytes, maximum_bytes - remaining_bytes, maximum_bytes)
-        return ret
+    return SizeInfo(remaining_bytes, maximum_bytes - remaining_bytes, maximum_bytes)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,466 @@
+import functools
+import hashlib
+import re
+import time
+from dataclasses import dataclass
+
+BLOCK_SIZE = 512
+
+# types without data blocks, even if size says otherwise
+NO_DATA_TYPES = "123456"
+# first character of the tar tvf mode string
+TYPE_CHARS = {
+    "0": "-", "\0": "-", "7": "-", "1": "h", "2": "l", "3": "c", "4": "b", "5": "d", "6": "p",
+    "D": "d", "M": "M", "V": "V", "S": "-",
+}
+
+QUOTE_CHARS = {0x07: "a", 0x08: "b", 0x0C: "f", 0x0A: "n", 0x0D: "r", 0x09: "t", 0x0B: "v"}
+UNQUOTE_CHARS = {v: k for k, v in QUOTE_CHARS.items()}
+NEEDS_QUOTING = re.compile(r"[^\x20-\x5b\x5d-\x7e]")  # anything but printable ASCII without backslash
+# -rw-r--r-- user/group 1234 2023-01-31 12:34 name
+TAR_LINE = re.compile(r"^(.)(.{9}) (\S+)/(\S+) +(\d+|\d+,\d+) (\d{4}-\d\d-\d\d \d\d:\d\d) (.*)$")
+
+
+class TarIndexError(Exception):
+    pass
+
+
+@dataclass
+class TarMember:
+    offset: int  # of the first header (including long name / pax headers) inside the chunk
+    type: str
+    name: str
+    size: int
+    mode: int
+    mtime: float
+    uid: int
+    gid: int
+    uname: str
+    gname: str
+    link_name: str = ""
+    continued_at: int = -1  # GNU multi-volume continuation (M) headers: offset inside the file
+    devmajor: int = 0
+    devminor: int = 0
+
+
+class TarIndexer:
+    """
+    Builds the catalog of a tar chunk by reading only the 512 byte headers and seeking past the file data, so the
+    I/O is O(files) instead of O(bytes). Understands GNU (long names, multi-volume, sparse, labels) and POSIX/pax
+    archives. tar_line() formats a member like tar tvf does.
+    """
+
+    def __init__(self):
+        self._ugswidth = 19  # tar grows the owner/size column the same way
+
+    def index(self, tar_file: str) -> [TarMember]:
+        with open(tar_file, "rb") as f:
+            return list(self.iter_members(f))
+
+    def iter_members(self, f):
+        offset = 0
+        long_name = None
+        long_link = None
+        pax = dict()
+        global_pax = dict()
+        member_offset = None
+
+        while True:
+            f.seek(offset)
+            header = f.read(BLOCK_SIZE)
+            if len(header) < BLOCK_SIZE or header == b"\0" * BLOCK_SIZE:
+                return  # end of archive, or the chunk ends (-L) in the middle of a member
+
+            if not _checksum_ok(header):
+                raise TarIndexError(f"Invalid header checksum at offset {offset}")
+
+            if member_offset is None:
+                member_offset = offset
+
+            type_flag = chr(header[156]) if header[156] else "\0"
+            size = _number(header[124:136])
+            data_offset = offset + BLOCK_SIZE
+
+            if type_flag == "S" and header[482]:  # old GNU sparse format, extension headers follow
+                while True:
+                    f.seek(data_offset)
+                    extension = f.read(BLOCK_SIZE)
+                    data_offset += BLOCK_SIZE
+                    if len(extension) < BLOCK_SIZE or not extension[504]:
+                        break
+
+            if type_flag in ("L", "K", "x", "g"):
+                f.seek(data_offset)
+                data = f.read(size)
+                if type_flag == "L":
+                    long_name = _string(data)
+                elif type_flag == "K":
+                    long_link = _string(data)
+                elif type_flag == "x":
+                    pax.update(_parse_pax(data))
+                else:
+                    global_pax.update(_parse_pax(data))
+                offset = data_offset + _round_up(size)
+                continue
+
+            values = dict(global_pax)
+            values.update(pax)
+
+            next_offset = data_offset
+            if type_flag not in NO_DATA_TYPES:
+                next_offset += _round_up(int(values.get("size", size)))  # pax size for members over 8 GiB
+
+            name = _header_name(header)
+            member = TarMember(
+                offset=member_offset,
+                type=type_flag,
+                name=values.get("GNU.sparse.name", values.get("path", long_name or name)),
+                size=int(values.get(
+                    "GNU.sparse.realsize", values.get("GNU.sparse.size", values.get("size", size))
+                )),
+                mode=_number(header[100:108]),
+                mtime=float(values.get("mtime", _number(header[136:148]))),
+                uid=int(values.get("uid", _number(header[108:116]))),
+                gid=int(values.get("gid", _number(header[116:124]))),
+                uname=values.get("uname", _string(header[265:297])),
+                gname=values.get("gname", _string(header[297:329])),
+                link_name=values.get("linkpath", long_link or _string(header[157:257])),
+                devmajor=_number(header[329:337]) if type_flag in "34" else 0,
+                devminor=_number(header[337:345]) if type_flag in "34" else 0,
+            )
+            if type_flag == "M":
+                member.continued_at = _number(header[369:381])
+            if type_flag == "S":
+                member.size = _number(header[483:495])  # real size, not the stored size
+
+            yield member
+
+            long_name, long_link, pax, member_offset = None, None, dict(), None
+            offset = next_offset
+
+    def tar_line(self, member: TarMember) -> str:
+        modes = TYPE_CHARS.get(member.type, "?") + _mode_string(member.mode)
+        if member.type in ("M", "V"):
+            modes = member.type + "-" * 9
+
+        user = member.uname or str(member.uid)
+        group = member.gname or str(member.gid)
+        if member.type in ("M", "V"):
+            user, group = "0", "0"
+
+        size = str(member.size)
+        if member.type in ("3", "4"):
+            size = f"{member.devmajor},{member.devminor}"
+
+        pad = len(user) + 1 + len(group) + 1 + len(size)
+        if pad > self._ugswidth:
+            self._ugswidth = pad
+
+        date = time.strftime("%Y-%m-%d %H:%M", time.localtime(member.mtime))
+
+        line = f"{modes} {user}/{group} {size:>{self._ugswidth - pad + len(size)}} {date} {_quote(member.name)}"
+        if member.type == "2":
+            line += " -> " + _quote(member.link_name)
+        elif member.type == "1":
+            line += " link to " + _quote(member.link_name)
+        elif member.type == "M":
+            line += f"--Continued at byte {member.continued_at}--"
+        elif member.type == "V":
+            line += "--Volume Header--"
+
+        return line
+
+
+class TarContentHasher:
+    """
+    Hashes the content of the regular files of a tar chunk while it streams by, feed() takes blocks of any size.
+    hashes maps the offset of the member (like TarMember.offset) to the hex digest, names the offset to the member
+    name for listings without offsets (tar -vv). Members cut by the end of the chunk, multi-volume continuations and
+    sparse files are not hashed, their content isn't complete in the chunk.
+    """
+
+    def __init__(self, algorithm: str):
+        self.algorithm = algorithm
+        self.hashes = dict()
+        self.names = dict()
+        self._offset = 0  # in the chunk, of the next byte fed
+        self._header = bytearray()
+        self._state = "header"  # header, extension, meta, data, skip, end
+        self._remaining = 0  # bytes of the current state
+        self._padding = 0  # after data / meta
+        self._meta_type = None
+        self._meta = bytearray()
+        self._pax = dict()
+        self._global_pax = dict()
+        self._long_name = None
+        self._member_offset = None
+        self._hash = None
+        self._hash_offset = None
+
+    def feed(self, data):
+        view = memoryview(data)
+        while view and self._state != "end":
+            if self._state in ("header", "extension"):
+                n = min(len(view), BLOCK_SIZE - len(self._header))
+                self._header += view[:n]
+                if len(self._header) == BLOCK_SIZE:
+                    header, self._header = bytes(self._header), bytearray()
+                    self._consume(n)
+                    if self._state == "header":
+                        self._parse_header(header)
+                    elif not header[504]:  # last sparse extension header
+                        self._start_skip(self._remaining)
+                else:
+                    self._consume(n)
+            else:
+                n = min(len(view), self._remaining)
+                if self._state == "data":
+                    self._hash.update(view[:n])
+                elif self._state == "meta":
+                    self._meta += view[:n]
+                self._consume(n)
+                if self._remaining == 0:
+                    self._end_of_block_run()
+            view = view[n:]
+
+    def _consume(self, n: int):
+        self._offset += n
+        if self._state not in ("header", "extension"):
+            self._remaining -= n
+
+    def _parse_header(self, header: bytes):
+        if header == b"\0" * BLOCK_SIZE:
+            self._state = "end"
+            return
+        if not _checksum_ok(header):
+            self._state = "end"
+            raise TarIndexError(f"Invalid header checksum at offset {self._offset - BLOCK_SIZE}")
+
+        if self._member_offset is None:
+            self._member_offset = self._offset - BLOCK_SIZE
+
+        type_flag = chr(header[156]) if header[156] else "\0"
+        size = _number(header[124:136])
+
+        if type_flag in ("L", "K", "x", "g"):
+            self._meta_type, self._meta = type_flag, bytearray()
+            self._start(("meta", size))
+            return
+
+        values = dict(self._global_pax)
+        values.update(self._pax)
+        member_offset = self._member_offset
+        name = values.get("path", self._long_name or _header_name(header))
+        self._pax, self._long_name, self._member_offset = dict(), None, None
+
+        if type_flag in NO_DATA_TYPES:
+            self._state = "header"
+        elif type_flag == "S" and header[482]:  # old GNU sparse format, extension headers follow
+            self._state, self._remaining = "extension", _round_up(size)
+        elif type_flag in ("0", "\0", "7") and not any(k.startswith("GNU.sparse") for k in values):
+            self._hash = hashlib.new(self.algorithm)
+            self._hash_offset = member_offset
+            self.names[member_offset] = name
+            self._start(("data", int(values.get("size", size))))
+        else:
+            self._start_skip(_round_up(size))
+
+    def _start(self, state: (str, int)):
+        self._state, self._remaining = state
+        self._padding = _round_up(self._remaining) - self._remaining
+        if self._remaining == 0:
+            self._end_of_block_run()
+
+    def _start_skip(self, size: int):
+        self._state, self._remaining, self._padding = "skip", size, 0
+        if size == 0:
+            self._state = "header"
+
+    def _end_of_block_run(self):
+        if self._state == "data":
+            self.hashes[self._hash_offset] = self._hash.hexdigest()
+            self._hash = None
+        elif self._state == "meta":
+            if self._meta_type == "x":
+                self._pax.update(_parse_pax(bytes(self._meta)))
+            elif self._meta_type == "g":
+                self._global_pax.update(_parse_pax(bytes(self._meta)))
+            elif self._meta_type == "L":
+                self._long_name = _string(bytes(self._meta))
+            self._meta = bytearray()
+        self._start_skip(self._padding)
+
+
+def parse_tar_line(line: str) -> TarMember:
+    """
+    The reverse of TarIndexer.tar_line(), for listings of tar tvf / tar -vv. None if the line isn't a member.
+    The offset isn't part of the line, mtime has only minutes.
+    """
+    s = TAR_LINE.match(line)
+    if not s:
+        return None
+
+    type_char, modes, user, group, size, date, rest = s.groups()
+    type_flag = {"-": "0", "h": "1", "l": "2", "c": "3", "b": "4", "d": "5", "p": "6"}.get(type_char, type_char)
+    member = TarMember(
+        offset=-1, type=type_flag, name=rest, size=0, mode=_parse_mode_string(modes),
+        mtime=_parse_date(date),
+        uid=int(user) if user.isdigit() else 0, gid=int(group) if group.isdigit() else 0,
+        uname="" if user.isdigit() else user, gname="" if group.isdigit() else group,
+    )
+    if "," in size:
+        member.devmajor, member.devminor = (int(n) for n in size.split(","))
+    else:
+        member.size = int(size)
+
+    if type_flag == "2" and " -> " in rest:
+        member.name, member.link_name = rest.split(" -> ", 1)
+    elif type_flag == "1" and " link to " in rest:
+        member.name, member.link_name = rest.split(" link to ", 1)
+    elif type_flag == "M" and rest.endswith("--"):
+        member.name, _, continued_at = rest[:-2].rpartition("--Continued at byte ")
+        member.continued_at = int(continued_at)
+    elif type_flag == "V":
+        member.name = rest.replace("--Volume Header--", "")
+
+    member.name = unquote(member.name)
+    member.link_name = unquote(member.link_name)
+    return member
+
+
+def unquote(name: str) -> str:
+    """
+    The reverse of the quoting of names in tar listings
+    """
+    if "\\" not in name:
+        return name
+
+    ret = bytearray()
+    data = name.encode("UTF-8", errors="surrogateescape")
+    i = 0
+    while i < len(data):
+        if data[i] == 0x5C and i + 1 < len(data):
+            escaped = chr(data[i + 1])
+            if escaped == "\\":
+                ret.append(0x5C)
+                i += 2
+                continue
+            if escaped in UNQUOTE_CHARS:
+                ret.append(UNQUOTE_CHARS[escaped])
+                i += 2
+                continue
+            if data[i + 1:i + 4].isdigit():
+                ret.append(int(data[i + 1:i + 4], 8))
+                i += 4
+                continue
+        ret.append(data[i])
+        i += 1
+    return ret.decode("UTF-8", errors="surrogateescape")
+
+
+def _quote(name: str) -> str:
+    """
+    Escapes names like tar does in its listings: non printable and non ASCII bytes as octal.
+    """
+    if not NEEDS_QUOTING.search(name):
+        return name
+
+    ret = ""
+    for b in name.encode("UTF-8", errors="surrogateescape"):
+        if b == 0x5C:
+            ret += "\\\\"
+        elif b in QUOTE_CHARS:
+            ret += "\\" + QUOTE_CHARS[b]
+        elif b < 0x20 or b >= 0x7F:
+            ret += "\\%03o" % b
+        else:
+            ret += chr(b)
+    return ret
+
+
+def _round_up(size: int) -> int:
+    return (size + BLOCK_SIZE - 1) // BLOCK_SIZE * BLOCK_SIZE
+
+
+def _header_name(header: bytes) -> str:
+    name = _string(header[0:100])
+    if header[257:263] == b"ustar\0" and header[345]:  # POSIX prefix, GNU uses this space for other fields
+        name = _string(header[345:500]) + "/" + name
+    return name
+
+
+def _string(data: bytes) -> str:
+    return data.split(b"\0", 1)[0].decode("UTF-8", errors="surrogateescape")
+
+
+def _number(data: bytes) -> int:
+    if data and data[0] & 0x80:  # GNU base-256 encoding for large values
+        value = data[0] & 0x3F
+        for b in data[1:]:
+            value = value << 8 | b
+        return -value if data[0] & 0x40 else value
+
+    data = data.split(b"\0", 1)[0].strip()
+    return int(data, 8) if data else 0
+
+
+def _checksum_ok(header: bytes) -> bool:
+    expected = _number(header[148:156])
+    unsigned = sum(header[:148]) + 8 * 32 + sum(header[156:])
+    return expected == unsigned
+
+
+def _parse_pax(data: bytes) -> dict:
+    ret = dict()
+    pos = 0
+    while pos < len(data):
+        space = data.find(b" ", pos)
+        if space == -1:
+            break
+        length = int(data[pos:space])
+        if length <= 0:
+            break
+        key, _, value = data[space + 1:pos + length - 1].partition(b"=")
+        ret[key.decode("UTF-8")] = value.decode("UTF-8", errors="surrogateescape")
+        pos += length
+    return ret
+
+
+@functools.lru_cache(maxsize=4096)  # listings repeat the same minutes and modes
+def _parse_date(date: str) -> float:
+    return time.mktime(time.strptime(date, "%Y-%m-%d %H:%M"))
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_mode_string(modes: str) -> int:
+    mode = 0
+    for i, (who, special, special_char) in enumerate(((6, 0o4000, "s"), (3, 0o2000, "s"), (0, 0o1000, "t"))):
+        r, w, x = modes[i * 3:i * 3 + 3]
+        mode |= (4 if r == "r" else 0) << who | (2 if w == "w" else 0) << who
+        if x in (special_char, special_char.upper()):
+            mode |= special
+        if x in ("x", special_char):
+            mode |= 1 << who
+    return mode
+
+
+@functools.lru_cache(maxsize=256)
+def _mode_string(mode: int) -> str:
+    ret = ""
+    for who, special, special_char in ((6, 0o4000, "s"), (3, 0o2000, "s"), (0, 0o1000, "t")):
+        bits = (mode >> who) & 7
+        ret += "r" if bits & 4 else "-"
+        ret += "w" if bits & 2 else "-"
+        if mode & special:
+            ret += special_char if bits & 1 else special_char.upper()
+        else:
+            ret += "x" if bits & 1 else "-"
+    return ret
+
+
+if __name__ == '__main__':
+    import sys
+
+    indexer = TarIndexer()
+    for m in indexer.index(sys.argv[1]):
+        print(m.offset, indexer.tar_line(m))
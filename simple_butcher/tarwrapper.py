@@ -2,6 +2,7 @@ import subprocess
 import logging
 import threading
 import os
+import re
 import time
 
 from tqdm import tqdm
@@ -10,22 +11,31 @@ from base_wrapper import Wrapper
 from config import BackupConfig, RestoreConfig
 from common import ArchiveVolumeNumber, file_size_format, get_safe_file_size
 from database import BackupRecord, BackupDatabase
-from exe_paths import TAR, FIND
+from exe_paths import TAR, STDBUF
+from filesystem import ParallelScanner, ScanResult
 from progressbar import ProgressDisplay, ByteTask
+from tarindex import TarIndexer, TarIndexError
 
 COMPRESS_TAR_BACKUP_FULL_CMD = \
-    '{cmd} cvM {excludes} -L{chunk_size}G ' \
-    '--new-volume-script="python simple_butcher/archive_finalizer.py \"{communication_file}\"" ' \
+    '{cmd} cvM {streaming_stuff} {excludes} -L{chunk_size}G ' \
+    '--new-volume-script="python -S simple_butcher/archive_finalizer.py \"{communication_file}\"" ' \
     '--label="{backup_name}" ' \
     ' {tar_incremental_stuff} ' \
     ' {incremental_stuff} ' \
     ' -f {output_file} ' \
-    ' {source} > {tar_log_file} 2>&1 '
-
-INCREMENTAL_STUFF = '--files-from={input_file_list}'
-FIND_CMD = '{cmd} {source} -type f -mtime -{days} > {input_file_list} '
+    ' {source} >> {tar_log_file} 2>&1 '
 
+# NUL separated list including directories, e.g. of the FileRouter
+FILES_FROM_STUFF = '--null --no-recursion --files-from={input_file_list}'
+# -vv lists the files like tar tvf does, --totals reports the size of the last volume
+STREAMING_STUFF = '-v --totals'
+STREAMING_CMD = '{stdbuf} -oL {cmd}'
 LIST_CMD = '{cmd} tvf {tar_file}'
+# NUL separated member names, exactly as in the archive
+MEMBERS_STUFF = '--null --verbatim-files-from --no-recursion --files-from={members_file}'
+
+TAR_LISTING_LINE = re.compile("^[-hdlcbpsDMV][rwxsStT-]{9} ")
+TAR_TOTALS_LINE = re.compile("^Total bytes written: (\\d+)")
 
 
 class TarWrapper(Wrapper):
@@ -34,26 +44,30 @@ class TarWrapper(Wrapper):
         self.pd = pd
 
     def main_backup_full(
-            self, config: BackupConfig, backup_bar, communication_file: str, database: BackupDatabase
+            self, config: BackupConfig, backup_bar, communication_file: str, database: BackupDatabase,
+            files_from: str = None
     ) -> (str, subprocess.Popen, threading.Thread):
-        tar_output_file = config.tempdir + "/tar_output"
+        tar_output_file = config.tempdir + ("/tar_stream" if config.streaming else "/tar_output")
 
         if os.path.exists(tar_output_file):
             os.remove(tar_output_file)
 
-        tar_incremental_stuff = ""  # f" --listed-incremental={database.tar_incremental_file()} "
+        cmd = TAR
+        streaming_stuff = ""
+        if config.streaming:
+            # tar writes every volume into the fifo, which is read by the compression pipeline
+            os.mkfifo(tar_output_file)
+            cmd = STREAMING_CMD.format(stdbuf=STDBUF, cmd=TAR)
+            streaming_stuff = STREAMING_STUFF
+
+        tar_incremental_stuff = ""
+        if config.listed_incremental:
+            tar_incremental_stuff = f"--listed-incremental={database.tar_incremental_file()}"
         incremental_stuff = ""
         source = config.source
-        if config.incremental_time is not None:
-            logging.info(f"Incremental backup.")
-            logging.info(f"Creating list of files that have changed in the last {config.incremental_time} days")
-            input_file_list = self._build_incremental_file_list(config, database)
-
-            found_files = buf_count_newlines_gen(input_file_list)
-            logging.info(f"Found {found_files} changed files.")
-
+        if files_from is not None:
             source = ""
-            incremental_stuff = INCREMENTAL_STUFF.format(input_file_list=input_file_list)
+            incremental_stuff = FILES_FROM_STUFF.format(input_file_list=files_from)
 
         excludes = ""
         if config.excludes:
@@ -62,7 +76,8 @@ class TarWrapper(Wrapper):
 
         tar_log_file = database.tar_log_file()
         tar_cmd = COMPRESS_TAR_BACKUP_FULL_CMD.format(
-            cmd=TAR,
+            cmd=cmd,
+            streaming_stuff=streaming_stuff,
             excludes=excludes,
             chunk_size=config.chunk_size,
             backup_name=config.backup_name,
@@ -80,7 +95,7 @@ class TarWrapper(Wrapper):
 
         tar_thread = threading.Thread(
             target=self._wait_for_process_finish_full_backup,
-            args=(tar_process, backup_bar, tar_log_file, tar_output_file, config.chunk_size)
+            args=(tar_process, backup_bar, tar_log_file, tar_output_file, config.chunk_size, config.streaming)
         )
         tar_thread.start()
 
@@ -92,7 +107,7 @@ class TarWrapper(Wrapper):
         # tar_cmd.append(f'')
 
         tar_cmd = f"{TAR} xvM -f {tar_input_file} --directory {config.dest} " \
-                  f'--new-volume-script="python simple_butcher/archive_finalizer.py \"{communication_file}\""'
+                  f'--new-volume-script="python -S simple_butcher/archive_finalizer.py \"{communication_file}\""'
 
         tar_process = subprocess.Popen(tar_cmd, shell=True)
         tar_thread = threading.Thread(
@@ -103,30 +118,52 @@ class TarWrapper(Wrapper):
 
         return tar_thread
 
+    def restore_members(
+            self, config: RestoreConfig, communication_file: str, tar_input_file: str, members_file: str
+    ) -> subprocess.Popen:
+        """
+        Like restore_full, but only the members in members_file are extracted. tar exits with an error when it is
+        stopped after the last selected volume (or the first one starts with the continuation of a file), so the
+        caller waits for the process itself and checks the restored files instead.
+        """
+        tar_cmd = f"{TAR} xvM -f {tar_input_file} --directory {config.dest} " \
+                  f"{MEMBERS_STUFF.format(members_file=members_file)} " \
+                  f'--new-volume-script="python -S simple_butcher/archive_finalizer.py \"{communication_file}\""'
+
+        return subprocess.Popen(tar_cmd, shell=True)
+
     def _wait_for_process_finish_restore(self, process: subprocess.Popen):
         _, s_err = process.communicate()
         if process.returncode != 0:
             raise OSError(s_err)
 
-    def _build_incremental_file_list(self, config: BackupConfig, database: BackupDatabase) -> str:
-        find_cmd = FIND_CMD.format(
-            cmd=FIND,
-            source=config.source,
-            days=config.incremental_time,
-            input_file_list=database.tar_input_file_list()
-        )
-
-        logging.debug(f"find cmd: {find_cmd}")
-
-        subprocess.check_call(find_cmd, shell=True)
+    def build_incremental_file_list(self, config: BackupConfig, database: BackupDatabase) -> ScanResult:
+        """
+        Files modified in the last incremental_time days (like find -type f -mtime -n)
+        """
+        modified_after = time.time() - config.incremental_time * 24 * 60 * 60
+        return self.build_file_list(config, database, modified_after)
 
-        return database.tar_input_file_list()
+    def build_file_list(
+            self, config: BackupConfig, database: BackupDatabase, modified_after: float = None
+    ) -> ScanResult:
+        """
+        Scans the source into the NUL separated database.tar_input_file_list()
+        """
+        excludes = [exclude[0] for exclude in config.excludes] if config.excludes else []
+        scanner = ParallelScanner(config.scan_workers, excludes, modified_after)
+        result = scanner.scan(config.source, database.tar_input_file_list())
+        logging.info(
+            f"Found {result.files} files ({file_size_format(result.bytes)}) in {result.directories} directories."
+        )
+        return result
 
     def _wait_for_process_finish_full_backup(
             self, process: subprocess.Popen, backup_bar, tar_log_file: str, output_file: str,
-            chunk_size: int
+            chunk_size: int, streaming: bool = False
     ):
-        self._update_tar_progressbar(backup_bar, process, tar_log_file, output_file, chunk_size)
+        if not streaming:  # the fifo has no size to report
+            self._update_tar_progressbar(backup_bar, process, tar_log_file, output_file, chunk_size)
 
         _, s_err = process.communicate()
         if process.returncode != 0:
@@ -172,6 +209,31 @@ class TarWrapper(Wrapper):
             return file_name[0:prefix_length] + "..." + file_name[-(prefix_length + postfix_length + 1):]
 
     def get_contents(self, archive_volume_no: ArchiveVolumeNumber, tar_file: str) -> [BackupRecord]:
+        """
+        Gets the contents of the tar archive by walking the tar headers, the file data isn't read.
+        """
+        indexer = TarIndexer()
+        try:
+            members = indexer.index(tar_file)
+        except TarIndexError as e:
+            logging.warning(f"Indexing {tar_file} failed ({e}), falling back to tar tvf.")
+            return self.get_contents_tar(archive_volume_no, tar_file)
+
+        ret = []
+        for member in members:
+            ret.append(BackupRecord(
+                tape_no=archive_volume_no.tape_no,
+                volume_no=archive_volume_no.volume_no,
+                tar_line=indexer.tar_line(member),
+                archive_hash=None,
+                hash_type=None,
+                offset=member.offset,
+                member=member
+            ))
+
+        return ret
+
+    def get_contents_tar(self, archive_volume_no: ArchiveVolumeNumber, tar_file: str) -> [BackupRecord]:
         """
         Gets the contents of the tar archive
         """
@@ -202,19 +264,42 @@ class TarWrapper(Wrapper):
         return ret
 
 
-def buf_count_newlines_gen(fname):
+class TarLogReader:
     """
-    Fastest method by https://stackoverflow.com/a/68385697
-    :param fname:
-    :return:
+    Reads the verbose (-vv) output of the running tar incrementally. Everything written since the last call belongs
+    to the volume tar has just finished, so the volume doesn't need to be read again with tar tvf.
+    A file that spans two volumes is only listed in the volume it starts in.
     """
 
-    def _make_gen(reader):
-        b = reader(2 ** 16)
-        while b:
-            yield b
-            b = reader(2 ** 16)
+    def __init__(self, tar_log_file: str, offset: int = 0):
+        self.tar_log_file = tar_log_file
+        self.offset = offset
+        self.total_bytes_written = None
+
+    def get_contents(self, archive_volume_no: ArchiveVolumeNumber) -> [BackupRecord]:
+        with open(self.tar_log_file, "rb") as f:
+            f.seek(self.offset)
+            data = f.read()
+
+        complete = data.rfind(b"\n") + 1  # tar might be in the middle of a line
+        self.offset += complete
+
+        ret = []
+        for line in data[:complete].decode("UTF-8", errors="replace").split("\n"):
+            s = TAR_TOTALS_LINE.search(line)
+            if s:
+                self.total_bytes_written = int(s.group(1))
+                continue
 
-    with open(fname, "rb") as f:
-        count = sum(buf.count(b"\n") for buf in _make_gen(f.raw.read))
-    return count
+            if not TAR_LISTING_LINE.search(line):
+                continue
+
+            ret.append(BackupRecord(
+                tape_no=archive_volume_no.tape_no,
+                volume_no=archive_volume_no.volume_no,
+                tar_line=line,
+                archive_hash=None,
+                hash_type=None
+            ))
+
+        return ret
@@ -0,0 +1,247 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Virtual tape drive backed by a directory, for benchmarks and tests without a drive. Use --tape virtual:<directory>.
+# Every cartridge is a sub directory, every tape file (between file marks) a file in it. mbuffer writes to / reads
+# from this script through a pipe, which throttles to the native speed of the emulated generation and fails at the
+# end of the medium. Kept to the standard library, so it can be started with python -S.
+#
+#   python simple_butcher/virtual_tape.py <directory> init --generation LTO-6 [--cartridges 3]
+#   python simple_butcher/virtual_tape.py <directory> load <serial>
+#   python simple_butcher/virtual_tape.py <directory> status|rewind|fsf <n>|sg_logs|tapeinfo|write|read
+
+VIRTUAL_PREFIX = "virtual:"
+BLOCK_SIZE = 512 * 1024
+EARLY_WARNING_BYTES = 20 * 1000 * 1000 * 1000  # before the end of the medium
+DEFAULT_GENERATION = "LTO-6"
+# native capacity (bytes) and speed (bytes/s)
+GENERATIONS = {
+    "LTO-5": (1500 * 1000 ** 3, 140 * 1000 ** 2),
+    "LTO-6": (2500 * 1000 ** 3, 160 * 1000 ** 2),
+    "LTO-7": (6000 * 1000 ** 3, 300 * 1000 ** 2),
+    "LTO-8": (12000 * 1000 ** 3, 360 * 1000 ** 2),
+    "LTO-9": (18000 * 1000 ** 3, 400 * 1000 ** 2),
+}
+
+STATUS_OUTPUT = "SCSI 2 tape drive:\nFile number={file}, block number={block}, partition=0.\n"
+SG_LOGS_OUTPUT = \
+    "    VIRTUAL   {generation}\n" \
+    "Volume statistics page  [0x17]\n" \
+    "  Volume serial number: {serial}\n" \
+    "Tape capacity page  [0x31]\n" \
+    "  Main partition remaining capacity (in MiB): {remaining}\n" \
+    "  Alternate partition remaining capacity (in MiB): 0\n" \
+    "  Main partition maximum capacity (in MiB): {maximum}\n" \
+    "  Alternate partition maximum capacity (in MiB): 0\n"
+TAPEINFO_OUTPUT = "Product Type: Tape Drive\nVendor ID: 'VIRTUAL '\nProduct ID: '{generation}'\n" \
+                  "BOT: {bot}\nBlock Position: {block}\n"
+
+
+def is_virtual(tape: str) -> bool:
+    return tape is not None and tape.startswith(VIRTUAL_PREFIX)
+
+
+def virtual_directory(tape: str) -> str:
+    return tape[len(VIRTUAL_PREFIX):]
+
+
+def tool_cmd(tape: str, command: str) -> str:
+    """
+    Shell command of the stand-in for mt-st / sg_logs / tapeinfo
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "virtual_tape.py")
+    return f'"{sys.executable}" -S "{script}" "{virtual_directory(tape)}" {command}'
+
+
+def start_device_process(tape: str, command: str, stdin=None, stdout=None) -> subprocess.Popen:
+    """
+    The write or read end of the virtual drive, mbuffer is connected to it through a pipe.
+    """
+    return subprocess.Popen(tool_cmd(tape, command), shell=True, stdin=stdin, stdout=stdout, stderr=subprocess.PIPE)
+
+
+def wait_for_device_process(process: subprocess.Popen):
+    if process is None:
+        return
+
+    _, s_err = process.communicate()
+    if process.returncode != 0:
+        raise OSError(s_err)
+
+
+class VirtualTape:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.drive_file = os.path.join(directory, "drive.json")
+
+    def init(self, generation: str, cartridges: int):
+        capacity, speed = GENERATIONS[generation]
+        os.makedirs(self.directory, exist_ok=True)
+        for i in range(cartridges):
+            serial = "VT%04i%s" % (i, generation[-1])
+            os.makedirs(os.path.join(self.directory, serial), exist_ok=True)
+        self._save({
+            "generation": generation, "capacity": capacity, "speed": speed, "loaded": "VT0000" + generation[-1],
+            "file": 0, "block": 0,
+        })
+
+    def load(self, serial: str):
+        drive = self._drive()
+        os.makedirs(os.path.join(self.directory, serial), exist_ok=True)
+        drive.update(loaded=serial, file=0, block=0)
+        self._save(drive)
+
+    def status(self) -> str:
+        drive = self._drive()
+        return STATUS_OUTPUT.format(file=drive["file"], block=drive["block"])
+
+    def rewind(self):
+        drive = self._drive()
+        drive.update(file=0, block=0)
+        self._save(drive)
+
+    def fsf(self, count: int):
+        drive = self._drive()
+        if drive["file"] + count > len(self._files(drive)):
+            raise OSError("Input/output error, no file mark")
+        drive.update(file=drive["file"] + count, block=0)
+        self._save(drive)
+
+    def sg_logs(self) -> str:
+        drive = self._drive()
+        used = sum(os.path.getsize(f) for f in self._files(drive))
+        return SG_LOGS_OUTPUT.format(
+            generation=drive["generation"], serial=drive["loaded"],
+            remaining=max(0, drive["capacity"] - used) // (1024 * 1024), maximum=drive["capacity"] // (1024 * 1024)
+        )
+
+    def tapeinfo(self) -> str:
+        drive = self._drive()
+        block = sum(os.path.getsize(f) for f in self._files(drive)[:drive["file"]]) // BLOCK_SIZE + drive["block"]
+        return TAPEINFO_OUTPUT.format(generation=drive["generation"], bot="yes" if block == 0 else "no", block=block)
+
+    def write(self, source, err):
+        """
+        Writes a tape file at the current position, everything after it is lost (like on a real tape).
+        """
+        drive = self._drive()
+        files = self._files(drive)
+        for f in files[drive["file"]:]:
+            os.remove(f)
+        used = sum(os.path.getsize(f) for f in files[:drive["file"]])
+
+        throttle = _Throttle(drive["speed"])
+        early_warning = False
+        with open(self._file_name(drive, drive["file"]), "wb") as out:
+            while True:
+                data = source.read(BLOCK_SIZE)
+                if not data:
+                    break
+
+                if used + len(data) > drive["capacity"]:
+                    drive["block"] = out.tell() // BLOCK_SIZE
+                    self._save(drive)
+                    err.write("No space left on device (end of medium)\n")
+                    return 1
+                if not early_warning and used + len(data) > drive["capacity"] - EARLY_WARNING_BYTES:
+                    early_warning = True
+                    err.write("Early warning, end of medium is near\n")
+
+                out.write(data)
+                used += len(data)
+                throttle.wait(len(data))
+
+        drive.update(file=drive["file"] + 1, block=0)  # file mark
+        self._save(drive)
+        return 0
+
+    def read(self, target, err):
+        drive = self._drive()
+        files = self._files(drive)
+        if drive["file"] >= len(files):
+            err.write("Input/output error, end of data\n")
+            return 1
+
+        throttle = _Throttle(drive["speed"])
+        with open(files[drive["file"]], "rb") as f:
+            for data in iter(lambda: f.read(BLOCK_SIZE), b""):
+                target.write(data)
+                throttle.wait(len(data))
+        target.flush()
+
+        drive.update(file=drive["file"] + 1, block=0)
+        self._save(drive)
+        return 0
+
+    def _files(self, drive: dict) -> [str]:
+        ret = []
+        while os.path.exists(self._file_name(drive, len(ret))):
+            ret.append(self._file_name(drive, len(ret)))
+        return ret
+
+    def _file_name(self, drive: dict, file_no: int) -> str:
+        return os.path.join(self.directory, drive["loaded"], "file_%06i" % file_no)
+
+    def _drive(self) -> dict:
+        with open(self.drive_file, "r") as f:
+            return json.load(f)
+
+    def _save(self, drive: dict):
+        with open(self.drive_file + ".tmp", "w") as f:
+            json.dump(drive, f)
+        os.replace(self.drive_file + ".tmp", self.drive_file)
+
+
+class _Throttle:
+    def __init__(self, speed: int):
+        self.speed = speed
+        self.start = time.time()
+        self.bytes = 0
+
+    def wait(self, count: int):
+        self.bytes += count
+        ahead = self.bytes / self.speed - (time.time() - self.start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+def main(argv: [str]) -> int:
+    tape = VirtualTape(argv[1])
+    command = argv[2]
+
+    if command == "init":
+        generation = argv[argv.index("--generation") + 1] if "--generation" in argv else DEFAULT_GENERATION
+        cartridges = int(argv[argv.index("--cartridges") + 1]) if "--cartridges" in argv else 1
+        tape.init(generation, cartridges)
+    elif command == "load":
+        tape.load(argv[3])
+    elif command == "status":
+        sys.stdout.write(tape.status())
+    elif command == "rewind":
+        tape.rewind()
+    elif command == "fsf":
+        tape.fsf(int(argv[3]))
+    elif command == "sg_logs":
+        sys.stdout.write(tape.sg_logs())
+    elif command == "tapeinfo":
+        sys.stdout.write(tape.tapeinfo())
+    elif command == "write":
+        return tape.write(sys.stdin.buffer, sys.stderr)
+    elif command == "read":
+        return tape.read(sys.stdout.buffer, sys.stderr)
+    else:
+        sys.stderr.write(f"Unknown command {command}\n")
+        return 2
+
+    return 0
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main(sys.argv))
+    except OSError as e:
+        sys.stderr.write(f"{e}\n")
+        sys.exit(1)
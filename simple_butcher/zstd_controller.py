@@ -0,0 +1,56 @@
+import logging
+
+from compression_zstdage_v2 import PipelineStats
+
+LOW_BUFFER_FILL = 30  # % average, mbuffer is drained faster than zstd/age can fill it
+EMPTY_BUFFER_FILL = 5  # % minimum, the drive most likely stopped streaming
+HIGH_BUFFER_FILL = 90  # % average, the drive is the bottleneck
+
+
+class AdaptiveLevelController:
+    """
+    Chooses the zstd level of the next chunk from the mbuffer fill level and tape write rate of the last chunk.
+    If the buffer runs low or the tape falls below its minimum streaming speed, zstd is the bottleneck and the level
+    goes down (into the --fast levels if necessary). If the buffer stays full, the drive is the bottleneck and the
+    spare CPU time is used for a higher level.
+    """
+
+    def __init__(self, start_level: int, min_level: int, max_level: int, min_tape_speed: int):
+        """
+        :param min_tape_speed: bytes/s, 0 to only look at the buffer fill
+        """
+        self.min_level = min_level
+        self.max_level = max_level
+        self.min_tape_speed = min_tape_speed
+        self.level = min(max(start_level, min_level), max_level)
+
+    def next_level(self, stats: PipelineStats) -> int:
+        if stats.buffer_fill_samples <= 0:
+            return self.level  # nothing observed (e.g. no tape), keep the level
+
+        too_slow = 0 < stats.write_rate() < self.min_tape_speed
+
+        step = 0
+        if stats.buffer_fill_min <= EMPTY_BUFFER_FILL and stats.buffer_fill_avg < LOW_BUFFER_FILL:
+            step = -2
+        elif stats.buffer_fill_avg < LOW_BUFFER_FILL or too_slow:
+            step = -1
+        elif stats.buffer_fill_avg >= HIGH_BUFFER_FILL and stats.buffer_fill_min > EMPTY_BUFFER_FILL:
+            step = 1
+
+        level = self._step(self.level, step)
+        if level != self.level:
+            logging.info(
+                f"zstd level {self.level} -> {level} "
+                f"(buffer avg={stats.buffer_fill_avg:.0f}% min={stats.buffer_fill_min}%, "
+                f"tape={stats.write_rate() / 1024 / 1024:.0f} MiB/s)"
+            )
+        self.level = level
+        return level
+
+    def _step(self, level: int, step: int) -> int:
+        for _ in range(abs(step)):
+            level += 1 if step > 0 else -1
+            if level == 0:  # there is no level 0, next to 1 are the --fast=1 levels
+                level += 1 if step > 0 else -1
+        return min(max(level, self.min_level), self.max_level)